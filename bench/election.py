@@ -0,0 +1,70 @@
+# Runs a complete ring election between simulated nodes in one process. Election messages are passed
+# through an in-memory queue instead of the network, so the result is the time spent routing and
+# handling them.
+#
+#   python bench/election.py [nodes]
+import contextlib
+import io
+import logging
+import os
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "server"))
+
+import api
+from control_plane import ControlPlane
+from election import Election
+from network import Message, OpCode
+from node import Node
+
+IP = "10.0.0.1"
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    nodes = [Node(IP, 10000 + i) for i in range(count)]
+    planes: dict[int, ControlPlane] = {}
+    elections: dict[int, Election] = {}
+    for node in nodes:
+        cp = ControlPlane()
+        cp.node = node
+        cp.nodes = set(nodes)
+        for other in nodes:
+            cp.register_heartbeat(f"{other.ip}:{other.port}")
+        planes[node.port] = cp
+        elections[node.port] = Election(cp)
+
+    # Every node routes its messages into this queue instead of sending them
+    pending: deque[tuple[Message, int]] = deque()
+    results = []
+    Message.send = lambda message, ip, port: pending.append((message, port))
+    Message.broadcast = lambda message, timeout=0: results.append(message)
+    api.defer = lambda delay, callback: callback()
+
+    started = time.monotonic()
+    handled = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for node in nodes:
+            elections[node.port].initiate_election()
+
+        while pending:
+            message, port = pending.popleft()
+            message = Message.unmarshal(message.marshal(), IP)
+            api.election_handler(message, IP, planes[port], elections[port], None)
+            handled += 1
+    elapsed = time.monotonic() - started
+
+    winners = {message.port for message in results if message.opcode is OpCode.ELECTION_RESULT}
+    expected = max(nodes, key=lambda node: node.uuid).port
+    print(f"{count} nodes: {handled} election messages in {elapsed:.3f}s ({handled / elapsed:,.0f} messages/s)")
+    print(f"Elected {sorted(winners)}, expected {expected}")
+    if winners != {expected}:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
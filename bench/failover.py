@@ -0,0 +1,115 @@
+# Measures how long a local cluster needs to elect a new leader after the leader was killed. Starts
+# the servers as separate processes, kills the leader once everyone agrees on it and waits until all
+# remaining servers have appointed a new one.
+#
+# Runs once per heartbeat delay, the default also covers slow heartbeats of more than a second.
+#
+#   python bench/failover.py [servers] [detector] [delays] [extra server arguments...]
+#   python bench/failover.py 3 phi 0.1,2.5 --phi-threshold 8 --election-delay 0.2
+#   python bench/failover.py 3 phi 0.1 --election bully
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+from threading import Thread, Lock
+
+SERVER_DIR = os.path.join(os.path.dirname(__file__), "..", "server")
+BASE_PORT = 6100
+APPOINTED = re.compile(r"Node (\S+):(\d+) has been appointed the new leader")
+
+
+class Server:
+    def __init__(self, port: int, arguments: list[str]):
+        self.port = port
+        self.leader: int | None = None
+        self.changed = 0.0
+        self.crashed = False
+        self._lock = Lock()
+        self.process = subprocess.Popen(
+            [sys.executable, "main.py", "--port", str(port), *arguments],
+            cwd=SERVER_DIR,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        Thread(target=self._read_target, daemon=True).start()
+
+    def _read_target(self):
+        for line in self.process.stderr:
+            # An exception in a thread of the server, e.g. the heartbeat thread, leaves the process running
+            if line.startswith("Traceback"):
+                self.crashed = True
+            match = APPOINTED.search(line)
+            if match:
+                with self._lock:
+                    self.leader = int(match.group(2))
+                    self.changed = time.monotonic()
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGKILL)
+        self.process.wait()
+
+
+def wait_for(condition, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def run(count: int, detector: str, delay: str, extra: list[str]):
+    arguments = ["--delay", delay, "--failure-detector", detector, *extra]
+
+    servers = []
+    try:
+        for i in range(count):
+            servers.append(Server(BASE_PORT + i, arguments))
+            # Join one after another like in a real deployment
+            time.sleep(1)
+
+        # Let the heartbeats settle, so the detectors have learned the heartbeat rate. Servers that join
+        # an existing leader only log an appointment if they took part in an election.
+        time.sleep(max(3, 4 * float(delay)))
+        appointed = [server for server in servers if server.leader is not None]
+        if not appointed:
+            print("No leader was appointed")
+            sys.exit(1)
+
+        # A server whose heartbeat thread crashed would still look alive to the others for a while
+        crashed = [server.port for server in servers if server.crashed or server.process.poll() is not None]
+        if crashed:
+            print(f"Servers {crashed} crashed before the leader was killed")
+            sys.exit(1)
+
+        leader_port = max(appointed, key=lambda server: server.changed).leader
+        leader = next(server for server in servers if server.port == leader_port)
+        remaining = [server for server in servers if server is not leader]
+        killed = time.monotonic()
+        leader.stop()
+
+        if not wait_for(lambda: all(server.leader not in (None, leader.port) for server in remaining), 60):
+            print(f"No new leader after 60s: {[server.leader for server in remaining]}")
+            sys.exit(1)
+
+        failover = max(server.changed for server in remaining) - killed
+        print(f"{count} servers, {detector} detector, {delay}s heartbeats: new leader {remaining[0].leader} after {failover:.3f}s")
+    finally:
+        for server in servers:
+            server.stop()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    detector = sys.argv[2] if len(sys.argv) > 2 else "phi"
+    delays = sys.argv[3] if len(sys.argv) > 3 else "0.1,2.5"
+
+    for delay in delays.split(","):
+        run(count, detector, delay, sys.argv[4:])
+
+if __name__ == "__main__":
+    main()
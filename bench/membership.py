@@ -0,0 +1,107 @@
+# Stress test for the membership store of the control plane: writer threads join and remove nodes and
+# register heartbeats while reader threads scan heartbeats and look up neighbours, the way the heartbeat
+# and election handlers do. Fails if a reader sees an inconsistent snapshot or any thread raises.
+#
+#   python bench/membership.py [seconds] [writers] [readers]
+import logging
+import os
+import random
+import sys
+import time
+from threading import Thread, Event
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "server"))
+
+from control_plane import ControlPlane
+from node import Node
+
+NODES = 64
+
+
+def writer_target(cp: ControlPlane, stop: Event, errors: list, counts: list, index: int):
+    operations = 0
+    try:
+        while not stop.is_set():
+            port = random.randint(1, NODES)
+            socket = f"10.0.0.1:{port}"
+            node = cp.get_node_from_socket(socket)
+            action = random.random()
+            if node is None:
+                cp.register_node(Node("10.0.0.1", port))
+                cp.register_heartbeat(socket)
+            elif action < 0.05:
+                try:
+                    cp.remove_node(node)
+                except KeyError:
+                    # Another writer removed it first
+                    pass
+            elif action < 0.1:
+                cp.expire_nodes(time.monotonic() - random.random() * 2)
+            else:
+                cp.register_heartbeat(socket)
+                cp.count_heartbeats_sent(socket)
+                cp.update_heartbeats_received(socket, random.randint(0, 1000))
+            operations += 1
+    except Exception as e:
+        errors.append(e)
+    counts[index] = operations
+
+
+def reader_target(cp: ControlPlane, stop: Event, errors: list, counts: list, index: int):
+    reads = 0
+    try:
+        while not stop.is_set():
+            membership = cp.membership
+            # Iterating a snapshot must never see it change
+            size = len(membership.heartbeats)
+            for socket, hb in membership.heartbeats.items():
+                membership.received.get(socket)
+            if size != len(membership.heartbeats):
+                raise RuntimeError("Snapshot changed while it was read")
+
+            sockets = sorted(membership.heartbeats)
+            if sockets:
+                sockets[(random.randrange(len(sockets)) + 1) % len(sockets)]
+            reads += 1
+    except Exception as e:
+        errors.append(e)
+    counts[index] = reads
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    writers = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    readers = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+
+    cp = ControlPlane()
+    cp.node = Node("10.0.0.1", 0)
+    cp.register_node(cp.node)
+
+    stop = Event()
+    errors = []
+    write_counts = [0] * writers
+    read_counts = [0] * readers
+    threads = [Thread(target=writer_target, args=(cp, stop, errors, write_counts, i)) for i in range(writers)]
+    threads += [Thread(target=reader_target, args=(cp, stop, errors, read_counts, i)) for i in range(readers)]
+
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    print(f"{writers} writers: {sum(write_counts) / seconds:,.0f} updates/s")
+    print(f"{readers} readers: {sum(read_counts) / seconds:,.0f} snapshot scans/s")
+    print(f"{len(cp.nodes)} nodes, {len(cp.heartbeats)} heartbeats at the end")
+
+    if errors:
+        for error in errors:
+            logging.error(repr(error))
+        sys.exit(1)
+    print("No errors")
+
+
+if __name__ == "__main__":
+    main()
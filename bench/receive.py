@@ -0,0 +1,84 @@
+# Measures how many datagrams per second a receiving thread reads and parses, once with a recvfrom call
+# and a new bytes object per datagram like the receive loops did before, once with the batched receiver.
+# Every round queues a burst of vote datagrams on the socket and times how long reading them takes, so
+# the sender does not compete with the receiver for the CPU. The receive buffer has to hold a whole burst.
+#
+#   python bench/receive.py [messages] [burst] [json|binary]
+import json
+import logging
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "server"))
+
+from network import INTERFACE, Message, OpCode
+from receiver import BatchReceiver
+
+
+def vote(i: int) -> Message:
+    data = json.dumps({
+        "question_uuid": "7971d734-513a-4ab5-819d-abe9da6f8cb0",
+        "socket": f"192.0.2.{i % 250}:{3000 + i % 1000}",
+        "seq": i,
+        "request_id": f"{i:032x}",
+    })
+    return Message(opcode=OpCode.VOTE, port=9765, data=data)
+
+
+def recvfrom_loop(listen_socket: socket.socket, count: int) -> int:
+    received = 0
+    while received < count:
+        data, (ip, _) = listen_socket.recvfrom(65535)
+        if data:
+            Message.unmarshal(data, ip)
+            received += 1
+    return received
+
+
+def batched(receiver: BatchReceiver, count: int) -> int:
+    received = 0
+    while received < count:
+        for data, ip in receiver.receive():
+            Message.unmarshal(data, ip)
+            received += 1
+    return received
+
+
+def measure(name: str, receive, payloads: list[bytes], burst: int, listen_socket: socket.socket):
+    send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    target = listen_socket.getsockname()
+    elapsed = 0.0
+    received = 0
+    for start in range(0, len(payloads), burst):
+        sent = 0
+        for payload in payloads[start:start + burst]:
+            send_socket.sendto(payload, target)
+            sent += 1
+        started = time.perf_counter()
+        received += receive(sent)
+        elapsed += time.perf_counter() - started
+    print(f"{name:>12}: {received} datagrams in {elapsed:.3f}s ({received / elapsed:,.0f}/s)")
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    burst = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    binary = len(sys.argv) > 3 and sys.argv[3] == "binary"
+
+    payloads = [vote(i).marshal(binary) for i in range(messages)]
+    print(f"{messages} {'binary' if binary else 'json'} votes of {len(payloads[0])} bytes in bursts of {burst}")
+
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+    listen_socket.bind((INTERFACE.ip.compressed, 0))
+
+    measure("recvfrom", lambda count: recvfrom_loop(listen_socket, count), payloads, burst, listen_socket)
+    receiver = BatchReceiver(listen_socket)
+    measure("batched", lambda count: batched(receiver, count), payloads, burst, listen_socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# Measures how long a server needs to recover its application state from the data directory:
+# replaying a write-ahead log of 1M operations, and loading a snapshot followed by a short log tail.
+#
+#   python bench/recovery.py [operations] [questions]
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "server"))
+
+from application_state import ApplicationState, Question, Vote
+from storage import Storage
+
+
+def write_operations(storage: Storage, app_state: ApplicationState, operations: int, questions: int, snapshot_at: int | None):
+    uuids = []
+    for seq in range(1, operations + 1):
+        if len(uuids) < questions:
+            question = Question(f"Question number {seq}")
+            app_state.add_question(question)
+            uuids.append(question.uuid)
+            opcode, data = "question", json.dumps({**question.to_dict(), "seq": seq})
+        else:
+            vote = Vote(f"10.0.{random.randint(0, 255)}.{random.randint(0, 255)}:3678", random.choice(uuids))
+            app_state.get_question_from_uuid(vote.question_uuid).toggle_vote(vote)
+            opcode, data = "vote", json.dumps({**vote.__dict__, "seq": seq})
+
+        app_state.seq = seq
+        storage.append(seq, opcode, data)
+        if seq == snapshot_at:
+            storage.snapshot(app_state)
+
+
+def drain(storage: Storage):
+    while not storage._queue.empty():
+        time.sleep(0.01)
+    # Let the writer thread finish its last batch
+    time.sleep(0.1)
+
+
+def run(operations: int, questions: int, snapshot_at: int | None):
+    with tempfile.TemporaryDirectory() as path:
+        storage = Storage(path, snapshot_interval=operations + 1)
+        storage.start(0)
+
+        started = time.monotonic()
+        write_operations(storage, ApplicationState(), operations, questions, snapshot_at)
+        drain(storage)
+        written = time.monotonic() - started
+
+        size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+        recovered = ApplicationState()
+        started = time.monotonic()
+        Storage(path).recover(recovered)
+        recovery = time.monotonic() - started
+
+        tail = operations - (snapshot_at or 0)
+        label = "log only" if snapshot_at is None else f"snapshot + {tail} op tail"
+        print(
+            f"{label:<28} write {operations / written:>10.0f} ops/s   recovery {recovery:>7.3f}s "
+            f"({operations / recovery:>9.0f} ops/s)   {size / 2**20:>7.1f} MiB on disk   seq {recovered.seq}"
+        )
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    questions = int(sys.argv[2]) if len(sys.argv) > 2 else 10_000
+
+    run(operations, questions, None)
+    run(operations, questions, operations - operations // 100)
+
+
+if __name__ == "__main__":
+    main()
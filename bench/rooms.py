@@ -0,0 +1,105 @@
+# Measures the write throughput of a local cluster with questions spread over rooms. Starts the servers
+# as separate processes, posts questions to the leaders of their rooms with a window of requests in
+# flight and counts the acknowledgements. With one room, every question goes through a single leader.
+#
+#   python bench/rooms.py [servers] [rooms] [questions] [window]
+#   python bench/rooms.py 3 1 5000 && python bench/rooms.py 3 30 5000
+import json
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "server"))
+
+from network import INTERFACE, Message, OpCode
+
+SERVER_DIR = os.path.join(os.path.dirname(__file__), "..", "server")
+BASE_PORT = 6500
+CLIENT_PORT = 6599
+RETRY_TIMEOUT = 1.0
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    rooms = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    questions = int(sys.argv[3]) if len(sys.argv) > 3 else 5000
+    window = int(sys.argv[4]) if len(sys.argv) > 4 else 64
+
+    servers = []
+    try:
+        for i in range(count):
+            servers.append(subprocess.Popen(
+                [sys.executable, "main.py", "--port", str(BASE_PORT + i), "--delay", "0.2", "--loglevel", "WARNING",
+                 "--delivery", "best-effort"],
+                cwd=SERVER_DIR,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            ))
+            time.sleep(1)
+        # Let the cluster settle, so every server agrees on the members and the leader
+        time.sleep(3)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((INTERFACE.ip.compressed, CLIENT_PORT))
+        sock.settimeout(0.05)
+        ip = INTERFACE.ip.compressed
+
+        # Requests go to the first server until a redirect names the leader of their room
+        leaders: dict[str, tuple[str, int]] = {}
+        pending: dict[str, tuple[dict, float]] = {}
+        acknowledged: Counter[tuple[str, int]] = Counter()
+        next_question = 0
+
+        def send(request: dict):
+            target = leaders.get(request["room"], (ip, BASE_PORT))
+            pending[request["request_id"]] = (request, time.monotonic())
+            data = json.dumps(request)
+            sock.sendto(Message(opcode=OpCode.QUESTION_REQUEST, port=CLIENT_PORT, data=data).marshal(False), target)
+
+        started = time.monotonic()
+        while next_question < questions or pending:
+            while next_question < questions and len(pending) < window:
+                room = f"room-{next_question % rooms}"
+                send({"text": f"Question {next_question}", "room": room, "request_id": f"bench-{next_question}"})
+                next_question += 1
+
+            try:
+                data, (sender_ip, _) = sock.recvfrom(65535)
+                for reply in Message.unmarshal_datagram(data, sender_ip):
+                    entry = pending.get(reply.data["request_id"])
+                    if entry is None:
+                        continue
+                    request, _ = entry
+                    if reply.opcode is OpCode.REQUEST_ACK:
+                        del pending[request["request_id"]]
+                        acknowledged[(sender_ip, reply.port)] += 1
+                    elif reply.opcode is OpCode.NOT_LEADER and reply.data["leader"] is not None:
+                        leaders[request["room"]] = tuple(reply.data["leader"])
+                        send(request)
+            except socket.timeout:
+                pass
+
+            now = time.monotonic()
+            for request, sent in list(pending.values()):
+                if sent + RETRY_TIMEOUT < now:
+                    leaders.pop(request["room"], None)
+                    send(request)
+
+        elapsed = time.monotonic() - started
+        print(f"{count} servers, {rooms} rooms: {questions} questions in {elapsed:.2f}s ({questions / elapsed:.0f}/s)")
+        for (leader_ip, leader_port), acks in sorted(acknowledged.items()):
+            print(f"  {leader_ip}:{leader_port} acknowledged {acks}")
+    finally:
+        for server in servers:
+            server.send_signal(signal.SIGKILL)
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+# Compares the JSON and the binary wire format per opcode: encode and decode time and bytes on the wire.
+#
+#   python bench/wire.py [iterations]
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "server"))
+
+from network import Message, OpCode
+from application_state import ApplicationState, Question, Vote
+from node import Node
+import api
+
+
+def sample_messages() -> list[Message]:
+    question = Question("How does the leader election work if two nodes start at the same time?")
+    for i in range(20):
+        question.toggle_vote(Vote(f"10.0.0.{i}:3678", question.uuid))
+
+    app_state = ApplicationState([Question(f"Question number {i}") for i in range(10)])
+    nodes = [Node(f"10.0.0.{i}", 9765, uuid=None) for i in range(5)]
+    counters = {f"10.0.0.{i}:9765": 1000 + i for i in range(5)}
+
+    return [
+        Message(OpCode.HELLO, port=9765, data=json.dumps(nodes[0].__dict__)),
+        Message(OpCode.HELLO_SERVER, port=3678),
+        Message(OpCode.HELLO_REPLY, port=9765, data=[node.__dict__ for node in nodes]),
+        Message(OpCode.HEARTBEAT, port=9765, data={"sent": counters, "received": counters}),
+        Message(OpCode.QUESTION_REQUEST, port=3678, data=json.dumps({"text": question.text})),
+        Message(OpCode.QUESTION, port=9765, data=json.dumps(question.to_dict())),
+        Message(OpCode.VOTE_REQUEST, port=3678, data=json.dumps(Vote("10.0.0.1:3678", question.uuid).__dict__)),
+        Message(OpCode.VOTE, port=9765, data=json.dumps(Vote("10.0.0.1:3678", question.uuid).__dict__)),
+        Message(OpCode.APPLICATION_STATE, port=9765, data=json.dumps(app_state, cls=api.CustomEncoder)),
+    ]
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    print(f"{'opcode':<18} {'format':<7} {'bytes':>7} {'encode us':>10} {'decode us':>10}")
+    for message in sample_messages():
+        for binary in (False, True):
+            payload = message.marshal(binary)
+            encode = timeit.timeit(lambda: message.marshal(binary), number=iterations) / iterations
+            decode = timeit.timeit(lambda: Message.unmarshal(payload), number=iterations) / iterations
+            print(
+                f"{message.opcode.value:<18} {'binary' if binary else 'json':<7} {len(payload):>7} "
+                f"{encode * 1e6:>10.2f} {decode * 1e6:>10.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
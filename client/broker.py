@@ -0,0 +1,79 @@
+import json
+import queue
+from collections import deque
+from threading import Lock
+from uuid import uuid4
+
+
+class Subscription:
+    def __init__(self, size: int):
+        self.queue: queue.Queue[bytes] = queue.Queue(maxsize=size)
+        self.closed = False
+
+    def next(self, timeout: float) -> bytes | None:
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+# Fan-out of state deltas to all streaming HTTP clients. Every event is encoded exactly once
+# and the same bytes are handed to every subscriber. Recent events are kept in a backlog so
+# that reconnecting clients can resume from the last version they have seen.
+class Broker:
+    def __init__(self, backlog: int = 1024, queue_size: int = 256):
+        self.queue_size = queue_size
+        # Event ids are prefixed with an epoch, since versions start at zero again after a restart
+        self.epoch = uuid4().hex[:8]
+        self._backlog: deque[tuple[int, bytes]] = deque(maxlen=backlog)
+        self._subscribers: set[Subscription] = set()
+        self._lock = Lock()
+
+    def publish(self, version: int, event: str, data):
+        frame = self.encode_event(version, event, data)
+
+        with self._lock:
+            self._backlog.append((version, frame))
+            subscribers = list(self._subscribers)
+
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(frame)
+            except queue.Full:
+                # A subscriber that cannot keep up is disconnected, it resumes from the backlog on reconnect
+                self.unsubscribe(subscription)
+
+    # Returns the subscription and the events after `since`, or None if the backlog no longer
+    # reaches back to `since` and the subscriber has to start from a snapshot
+    def subscribe(self, since: int | None) -> tuple[Subscription, list[bytes] | None]:
+        subscription = Subscription(self.queue_size)
+
+        with self._lock:
+            self._subscribers.add(subscription)
+            if since is None or not self._backlog or self._backlog[0][0] > since + 1:
+                return subscription, None
+            return subscription, [frame for version, frame in self._backlog if version > since]
+
+    def unsubscribe(self, subscription: Subscription):
+        subscription.closed = True
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    def encode_event(self, version: int, event: str, data) -> bytes:
+        return f"id: {self.epoch}-{version}\nevent: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode("UTF-8")
+
+    # Accepts plain versions as well as event ids, event ids of another epoch are not resumable
+    def parse_cursor(self, cursor: str | None) -> int | None:
+        if not cursor:
+            return None
+        epoch, _, version = cursor.rpartition("-")
+        if epoch and epoch != self.epoch:
+            return None
+        try:
+            return int(version)
+        except ValueError:
+            return None
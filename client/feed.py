@@ -0,0 +1,83 @@
+import logging
+import os
+import socket
+import struct
+import time
+from threading import Lock
+from network import Message
+
+# Frame header: length of the sender ip and length of the marshalled message
+HEADER = struct.Struct("!HI")
+
+
+def encode_frame(message: Message, ip: str | None) -> bytes:
+    ip_b = (ip or "").encode("UTF-8")
+    # Workers always run the same code as the ingest process, so the compact format is always understood
+    payload = message.marshal(binary=True)
+    return HEADER.pack(len(ip_b), len(payload)) + ip_b + payload
+
+
+# Local replication of the UDP ingest to the HTTP worker processes in production mode.
+# Only the ingest process listens on the UDP ports. It applies every message to its own state and
+# forwards it to all connected workers, which apply the same messages to their own replica.
+class FeedServer:
+    def __init__(self, path: str, handshake):
+        # Returns the frames a new worker needs to catch up with the current state
+        self.handshake = handshake
+        self.path = path
+        self._connections: list[socket.socket] = []
+        self._lock = Lock()
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(path)
+        self._socket.listen()
+
+    def serve(self):
+        while True:
+            connection, _ = self._socket.accept()
+            connection.settimeout(1)
+            # Taking the handshake and registering happen under the lock, so no message is missed or applied twice
+            with self._lock:
+                if self._send(connection, b"".join(self.handshake())):
+                    self._connections.append(connection)
+            logging.info("HTTP worker connected to the state feed")
+
+    # Apply a message locally and forward it to all workers as one step
+    def ingest(self, message: Message, ip: str, apply):
+        frame = encode_frame(message, ip)
+        with self._lock:
+            apply()
+            for connection in list(self._connections):
+                if not self._send(connection, frame):
+                    self._connections.remove(connection)
+
+    def _send(self, connection: socket.socket, frame: bytes) -> bool:
+        try:
+            connection.sendall(frame)
+            return True
+        except OSError:
+            # The worker reconnects and catches up through a new handshake
+            logging.info("Dropping HTTP worker from the state feed")
+            connection.close()
+            return False
+
+
+def feed_target(callback, path: str, application_state, cp):
+    while True:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as feed_socket:
+                feed_socket.connect(path)
+                stream = feed_socket.makefile("rb")
+                while True:
+                    header = stream.read(HEADER.size)
+                    if len(header) < HEADER.size:
+                        break
+                    ip_length, payload_length = HEADER.unpack(header)
+                    ip = stream.read(ip_length).decode("UTF-8") or None
+                    msg = Message.unmarshal(stream.read(payload_length))
+                    callback(msg, ip, application_state, cp)
+        except OSError as e:
+            logging.info(f"State feed unavailable: {e}")
+        time.sleep(1)
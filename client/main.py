@@ -1,14 +1,62 @@
 import json
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Response, g, jsonify, request, send_from_directory
 from flask_cors import CORS
 import socket
 from threading import Thread
 import logging
-from network import Message, INTERFACE, BROADCAST_PORT, OpCode
+from network import Message, INTERFACE, BROADCAST_PORT, DATA_GROUP, OpCode, WIRE_FORMATS, TRANSPORTS, configure_wire_format, configure_transport, configure_reliable, configure_buffers, configure_sender
 import argparse
+import mimetypes
+import os
 from application_state import ApplicationState, Question, Vote
+from snapshot import SnapshotCache, summarize
+from broker import Broker
+from feed import FeedServer, encode_frame, feed_target
+import network
+import transfer
+import time
+from reliable import ReliableChannel
+from sender import OutboundSender
+from receiver import BatchReceiver
+from reads import Replicas, ReadClient, ReadError
+from request_manager import RequestManager, RequestError, RequestRejected
+import metrics
 
 app = Flask(__name__)
+broker = Broker()
+
+# Unwraps messages that were sent through the reliable layer and acknowledges them
+reliable: ReliableChannel | None = None
+
+# Servers the questions can be read from, and the reads waiting for their reply
+replicas = Replicas()
+reads: ReadClient | None = None
+
+# Sends questions and votes to the leader until they are acknowledged
+request_manager: RequestManager | None = None
+
+# Minimum time between two requests for missing operations
+SYNC_REQUEST_INTERVAL = 1
+
+MESSAGES_HANDLED = metrics.counter("qhub_client_messages_total", "Messages handled by type", ("opcode",))
+# The clocks of leader and client are compared, so the delays are only as exact as their synchronisation
+PROPAGATION_DELAY = metrics.histogram(
+    "qhub_client_propagation_seconds",
+    "Time from the leader broadcasting an operation until the client received it",
+    (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+    ("opcode",),
+)
+HTTP_LATENCY = metrics.histogram(
+    "qhub_http_request_seconds",
+    "Time the web app took to answer a request",
+    (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+    ("route", "method", "status"),
+)
+STATE_QUESTIONS = metrics.gauge("qhub_state_questions", "Questions in all rooms")
+STATE_VOTES = metrics.gauge("qhub_state_votes", "Votes in all rooms")
+STATE_ROOMS = metrics.gauge("qhub_state_rooms", "Rooms besides the default room")
+
+STATIC_DIR = '../qhub-ui/dist'
 
 
 CORS(app)
@@ -37,19 +85,132 @@ def find_available_port(start_port, max_attempts=10):
 
     raise Exception(f"Could not find an available port in the range {start_port} to {start_port + max_attempts}")    
 
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def observe_latency(response):
+    # Routes instead of paths, so every static file or room does not get its own series
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    HTTP_LATENCY.observe(time.perf_counter() - g.started, route, request.method, str(response.status_code))
+    return response
+
+# Prometheus metrics of this process. Every gunicorn worker has its own, just like its own replica.
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 @app.route('/', defaults={"path": "index.html"})
 @app.route('/<path:path>') 
 def serve_static(path):
-    print(path, flush=True)
-    return send_from_directory('../qhub-ui/dist', path)
+    logging.debug(f"Serving static file {path}")
+    static_dir = os.path.join(app.root_path, STATIC_DIR)
+
+    # Serve the variants precompressed at build time if the browser accepts them
+    for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if request.accept_encodings[encoding] > 0 and os.path.isfile(os.path.join(static_dir, f"{path}{suffix}")):
+            response = send_from_directory(STATIC_DIR, f"{path}{suffix}", mimetype=mimetypes.guess_type(path)[0])
+            response.headers["Content-Encoding"] = encoding
+            response.headers.pop("Content-Disposition", None)
+            break
+    else:
+        response = send_from_directory(STATIC_DIR, path)
+
+    response.vary.add("Accept-Encoding")
+    # Vite adds a content hash to the names of all files in assets/, so they never change
+    if path.startswith("assets/"):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
 
 
 # GET All Questions
 @app.route('/api/get', methods=['GET'])
 def get_data():
+    room = request.args.get("room")
+    app_state = app.config["application_state"].find_room(room)
+    if app_state is None:
+        # Rooms only exist once a question was posted to them, looking at one does not create it
+        return jsonify([])
+
+    offset = max(request.args.get("offset", default=0, type=int), 0)
+    limit = request.args.get("limit", type=int)
+    if limit is not None:
+        limit = max(limit, 0)
+
+    # Questions are already ranked by votes, so only the requested page is serialized once per state version
+    snapshot_cache = snapshot_cache_of(room)
+    version, body = snapshot_cache.get(app_state, offset, limit)
+    etag = snapshot_cache.etag(version)
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+# Stream question and vote updates as server-sent events.
+# Reconnecting clients resume after the event id they have seen last, all others start with a snapshot.
+@app.route('/api/stream', methods=['GET'])
+def stream():
     app_state = app.config["application_state"]
 
-    return json.dumps(app_state.questions, default = lambda x: {"uuid": x.uuid, "text": x.text, "votes": len(x.votes)})
+    since = broker.parse_cursor(request.args.get("since") or request.headers.get("Last-Event-ID"))
+    subscription, backlog = broker.subscribe(since)
+
+    def events():
+        try:
+            if backlog is None:
+                yield broker.encode_event(app_state.version, "snapshot", [summarize(question) for question in app_state.ranking.page()])
+            else:
+                yield from backlog
+
+            while not subscription.closed:
+                frame = subscription.next(timeout=15)
+                yield b": keepalive\n\n" if frame is None else frame
+        finally:
+            broker.unsubscribe(subscription)
+
+    return Response(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Read the questions from the servers instead of the local replica. Bounded reads are spread across all
+# servers and accept a state that is at most `max_staleness` seconds old and contains everything this client
+# has seen. Lease reads are answered by the leader only.
+@app.route('/api/read', methods=['GET'])
+def read_data():
+    room = request.args.get("room")
+    app_state = app.config["application_state"].find_room(room)
+    cp = app.config["cp"]
+
+    consistency = request.args.get("consistency", default="bounded")
+    if consistency not in ("bounded", "lease"):
+        return jsonify({'success': False, 'message': f"Unknown consistency {consistency}"}), 400
+    offset = max(request.args.get("offset", default=0, type=int), 0)
+    limit = request.args.get("limit", type=int)
+    if limit is not None:
+        limit = max(limit, 0)
+    max_staleness = request.args.get("max_staleness", default=app.config["max_staleness"], type=float)
+
+    leader = request_manager.leader(room, cp)
+    try:
+        reply, (ip, port) = reads.read(consistency, leader, max_staleness, 0 if app_state is None else app_state.seq, offset, limit, room)
+    except ReadError as e:
+        return jsonify({'success': False, 'message': str(e)}), 503
+
+    response = jsonify(reply["questions"])
+    response.headers["X-QHub-Seq"] = str(reply["seq"])
+    if reply["staleness"] is not None:
+        response.headers["X-QHub-Staleness"] = f"{reply['staleness']:.3f}"
+    response.headers["X-QHub-Replica"] = f"{ip}:{port}"
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
 # Vote Up
 @app.route('/api/vote_up', methods=['POST'])
@@ -58,6 +219,7 @@ def change_order():
         # Get the id from the request
         print(request.data)
         question_uuid = request.json['uuid']
+        room = request.json.get('room')
 
         # Find the message with the given id
         # message = next((item for item in data if item['id'] == message_id), None)
@@ -81,12 +243,15 @@ def change_order():
         #     else:
         #         return jsonify({'success': False, 'message': 'Question not found'})
         logging.info(f"Sending vote {vote.__dict__}")
-        Message(opcode=OpCode.VOTE_REQUEST, port=cp.port, data=json.dumps(vote.__dict__)).send(cp.leader_ip, cp.leader_port)
-
-        # Return a simple "OK" message
-        return jsonify({'success': True, 'message': 'Vote posted successfully'}), 202
+        data = vote.__dict__ if room is None else {**vote.__dict__, "room": room}
+        seq, latency = request_manager.submit(OpCode.VOTE_REQUEST, data, cp)
 
+        return jsonify({'success': True, 'message': 'Vote posted successfully', 'seq': seq, 'latency_ms': round(latency * 1000, 3)}), 200
 
+    except RequestRejected as e:
+        return jsonify({'success': False, 'message': str(e)}), 404
+    except RequestError as e:
+        return jsonify({'success': False, 'message': str(e)}), 503
     except Exception as e:
         print(e)
         return jsonify({'success': False, 'message': str(e)}), 400
@@ -102,16 +267,18 @@ def add_question():
         new_question = {
             'text': data_json['text'],
         }
+        if data_json.get('room') is not None:
+            new_question['room'] = data_json['room']
 
         # Append the new question to the data array
         cp = app.config["cp"]
 
-        # TODO: Send message to server
         print(f"{cp.leader_ip}:{cp.leader_port}")
-        Message(opcode=OpCode.QUESTION_REQUEST, port=cp.port, data=json.dumps(new_question)).send(cp.leader_ip, cp.leader_port)
+        seq, latency = request_manager.submit(OpCode.QUESTION_REQUEST, new_question, cp)
 
-        # Return a simple "OK" message
-        return jsonify({'success': True, 'message': 'Question posted successfully'}), 202
+        return jsonify({'success': True, 'message': 'Question posted successfully', 'seq': seq, 'latency_ms': round(latency * 1000, 3)}), 200
+    except RequestError as e:
+        return jsonify({'success': False, 'message': str(e)}), 503
     except Exception as e:
         print(e)
         return jsonify({'success': False, 'message': str(e)}), 500
@@ -122,47 +289,125 @@ class ControlPlane:
         self.leader_port = leader_port
         self.ip = ip  
         self.port = port 
+        # Time of the last request for missing operations
+        self.sync_requested = 0.0
 
-def http_target(host, port, application_state: ApplicationState, cp: ControlPlane):
-    print(f"Server running on http://{host}:{port}/")
+def configure_app(application_state: ApplicationState, cp: ControlPlane, max_staleness: float):
     app.config["cp"] = cp
+    app.config["max_staleness"] = max_staleness
     app.config['application_state'] = application_state
+    # One cache per room, the versions of the rooms are counted separately
+    app.config['snapshot_caches'] = {}
+    metrics.on_collect(lambda: collect_state_size(application_state))
+
+def collect_state_size(application_state: ApplicationState):
+    rooms = [application_state, *list(application_state.rooms.values())]
+    STATE_QUESTIONS.set(sum(len(room.questions) for room in rooms))
+    STATE_VOTES.set(sum(question.vote_count for room in rooms for question in list(room.questions)))
+    STATE_ROOMS.set(len(rooms) - 1)
+
+def propagated(msg: dict, opcode: OpCode):
+    # Only live broadcasts are stamped, operations replayed from the log are not
+    if "at" in msg:
+        PROPAGATION_DELAY.observe(max(time.time() - msg["at"], 0.0), opcode.value)
+
+def snapshot_cache_of(room: str | None) -> SnapshotCache:
+    caches = app.config['snapshot_caches']
+    cache = caches.get(room)
+    if cache is None:
+        cache = caches.setdefault(room, SnapshotCache())
+    return cache
+
+def http_target(host, port, application_state: ApplicationState, cp: ControlPlane, max_staleness: float):
+    print(f"Server running on http://{host}:{port}/")
+    configure_app(application_state, cp, max_staleness)
     app.run(host=host, port=port, debug=True, use_reloader=False)
 
+# Serve the app with multiple gunicorn worker processes. Each worker keeps its own replica of the
+# application state, which is fed by the UDP ingest running in this process through a unix socket.
+def production_target(host, port, workers: int, threads: int, feed_path: str, cp: ControlPlane, send_reliable: bool, max_staleness: float):
+    from gunicorn.app.base import BaseApplication
+
+    def post_fork(server, worker):
+        # Every worker sends its own requests, so it needs its own session for the acknowledgements
+        global reliable
+        reliable = ReliableChannel(cp.port)
+        if send_reliable:
+            configure_reliable(reliable)
+        # The sending thread is not forked along with the process
+        if network.outbound_sender is not None:
+            network.outbound_sender.start()
+
+        worker_state = ApplicationState()
+        worker_cp = ControlPlane(None, None, cp.ip, cp.port)
+        configure_app(worker_state, worker_cp, max_staleness)
+        Thread(target=feed_target, args=(message_handler, feed_path, worker_state, worker_cp), daemon=True).start()
+
+    class ProductionServer(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{host}:{port}")
+            self.cfg.set("workers", workers)
+            # Threaded workers, since every open update stream occupies one thread
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("threads", threads)
+            self.cfg.set("post_fork", post_fork)
+
+        def load(self):
+            return app
+
+    print(f"Server running on http://{host}:{port}/ with {workers} workers")
+    ProductionServer().run()
+
 def broadcast_target(callback, application_state: ApplicationState, cp: ControlPlane):
-    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    listen_socket.bind(("", BROADCAST_PORT))
+    # Clients only join the data group, heartbeats and elections stay among the servers
+    if network.transport == "multicast":
+        listen_socket = network.multicast_socket([DATA_GROUP])
+    else:
+        listen_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        network.apply_receive_buffer(listen_socket)
+        listen_socket.bind(("", BROADCAST_PORT))
+    receiver = BatchReceiver(listen_socket)
 
     try:
         while True:
-            data, (ip, port) = listen_socket.recvfrom(2048)
-            if data:
-                msg = Message.unmarshal(data)
+            for data, ip in receiver.receive():
+                for msg in Message.unmarshal_datagram(data, ip):
 
-                logging.debug(f"Broadcast message received: {msg.opcode}")
+                    logging.debug(f"Broadcast message received: {msg.opcode}")
 
-                callback(msg, ip, application_state, cp)
+                    callback(msg, ip, application_state, cp)
     except KeyboardInterrupt:
         listen_socket.close()
         exit(0)
 
 def unicast_target(callback, lport: int, application_state: ApplicationState, cp: ControlPlane):
     listen_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    network.apply_receive_buffer(listen_socket)
     listen_socket.bind((INTERFACE.ip.compressed, lport))
+    receiver = BatchReceiver(listen_socket)
 
     try:
         while True:
-            data, (ip, port) = listen_socket.recvfrom(2048)
-            if data:
-                msg = Message.unmarshal(data)
-                logging.debug(f"Unicast message received: {msg.opcode}")
-                callback(msg, ip, application_state, cp)
+            for data, ip in receiver.receive():
+                for msg in Message.unmarshal_datagram(data, ip):
+                    logging.debug(f"Unicast message received: {msg.opcode}")
+                    callback(msg, ip, application_state, cp)
     except KeyboardInterrupt:
         listen_socket.close()
         exit(0)
 
+class CustomEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, ApplicationState):
+            # Serialize the ApplicationState object to a dictionary
+            return {'_type': 'ApplicationState', **obj.to_dict()}
+        if isinstance(obj, Question):
+            # Serialize the Question object to a dictionary
+            return {'_type': 'Question', **obj.to_dict()}
+        return json.JSONEncoder.default(self, obj)
+
 class CustomDecoder(json.JSONDecoder):
     def __init__(self, *args, **kwargs):
         json.JSONDecoder.__init__(self, object_hook=self.dict_to_object, *args, **kwargs)
@@ -182,38 +427,145 @@ class CustomDecoder(json.JSONDecoder):
             return Vote(**d)
         return d
 
+def load_state(message, application_state):
+    app_state = json.loads(message.data, cls=CustomDecoder)
+    room_state = application_state.room(app_state.room_id)
+    room_state.questions = app_state.questions
+    room_state.seq = app_state.seq
+    room_state.epoch = app_state.epoch
+    room_state.owner = app_state.owner
+    # The state of the default room comes with all other rooms, only those that are ahead replace ours. A room
+    # taken over by a new owner is ahead even if its sequence number is not, the owner reused ours.
+    for room, state in app_state.rooms.items():
+        current = application_state.room(room)
+        if (state.epoch, state.seq) > (current.epoch, current.seq):
+            application_state.rooms[room] = state
+    # Update streams only cover the default room
+    if room_state is application_state:
+        broker.publish(application_state.version, "snapshot", [summarize(question) for question in application_state.ranking.page()])
+
 # Set current application state to the application state received by the server
 def hello_reply_handler(message, ip, application_state, cp: ControlPlane):
     logging.info(f"Received this message data in hello reply {message.data}")
+    if ip is not None:
+        replicas.seen(ip, message.port)
     logging.info(message.data)
-    app_state = json.loads(message.data, cls=CustomDecoder)
-    application_state.questions = app_state.questions
+    load_state(message, application_state)
 
     cp.leader_ip = ip      
     cp.leader_port = message.port
 
     logging.info("Received hello reply")
 
+# Sent instead of the operations we requested if the server no longer has them
+def application_state_handler(message, ip, application_state, cp: ControlPlane):
+    load_state(message, application_state)
+    logging.info("Received application state")
+
+# Operations are applied in the order of the sequence numbers assigned by the leader. Duplicates are ignored,
+# and on a gap the operation is dropped and the missing operations are requested from the sender.
+def in_sequence(msg, ip, port, application_state, cp: ControlPlane):
+    seq = msg.get("seq")
+    if seq is None:
+        return True
+    if application_state.room_id is not None and not from_owner(msg, ip, port, application_state, cp):
+        return False
+    if seq <= application_state.seq:
+        return False
+    if seq > application_state.seq + 1:
+        request_sync(ip, port, application_state, cp)
+        return False
+    return True
+
+# Operations of a room are only applied if they come from the owner of the latest epoch we know of, like on the
+# servers. A new owner continues after the highest sequence number it found, so if we applied operations of the
+# previous owner that it never saw, our state diverged and is replaced by that of the new owner.
+def from_owner(msg, ip, port, application_state, cp: ControlPlane):
+    epoch, owner = msg.get("epoch", 0), msg.get("owner")
+    if epoch < application_state.epoch or (epoch == application_state.epoch and application_state.owner is not None and owner != application_state.owner):
+        logging.info(f"Dropping operation {msg['seq']} of room {application_state.room_id} from {owner}, which no longer owns it")
+        return False
+    if epoch > application_state.epoch and msg["seq"] <= application_state.seq:
+        request_sync(ip, port, application_state, cp, full=True)
+        return False
+    return True
+
+# Operations that are no longer logged are sent as the whole state, `full` asks for it right away
+def request_sync(ip, port, application_state, cp: ControlPlane, full=False):
+    now = time.monotonic()
+    if cp.sync_requested + SYNC_REQUEST_INTERVAL > now:
+        return
+    cp.sync_requested = now
+    logging.info(f"Missing operations of room {application_state.room_id} after {application_state.seq}, requesting them from {ip}:{port}")
+    request = {"seq": -1 if full else application_state.seq}
+    if application_state.room_id is not None:
+        request["room"] = application_state.room_id
+    Message(opcode=OpCode.SYNC_REQUEST, port=cp.port, data=request).send(ip, port)
+
+def applied(msg, application_state):
+    application_state.seq = msg.get("seq", application_state.seq)
+    if "epoch" in msg:
+        application_state.epoch, application_state.owner = msg["epoch"], msg["owner"]
+
 def question_handler(message, ip, application_state, cp: ControlPlane):
     msg = json.loads(message.data)
+    propagated(msg, message.opcode)
+    # With the multicast transport the clients do not receive heartbeats, the room leaders are the servers we know
+    replicas.seen(ip, message.port)
     logging.info(f"Question received {msg}")
-    question = Question(text=msg["text"], uuid=msg["uuid"])
-    application_state.add_question(question)
-    logging.info(f"Added question {question.__dict__} to application state")
+    room_state = application_state.room(msg.get("room"))
+    if not in_sequence(msg, ip, message.port, room_state, cp):
+        return
+    question = Question(text=msg["text"], uuid=msg["uuid"], room=msg.get("room"))
+    version = room_state.version
+    room_state.add_question(question)
+    applied(msg, room_state)
+    # Questions we already have (retransmits, replays after a sync) do not change the state
+    if room_state is application_state and room_state.version != version:
+        broker.publish(application_state.version, "question", summarize(question))
+    logging.info(f"Added question {question.to_dict()} to application state")
 
 def vote_handler(message, ip, application_state, cp: ControlPlane):
     msg = json.loads(message.data)
-    question = application_state.get_question_from_uuid(msg["question_uuid"])
+    propagated(msg, message.opcode)
+    replicas.seen(ip, message.port)
+    room_state = application_state.room(msg.get("room"))
+    if not in_sequence(msg, ip, message.port, room_state, cp):
+        return
+    question = room_state.get_question_from_uuid(msg["question_uuid"])
+    # The leader only sequences votes for questions it has, so our state diverged and is replaced as a whole
+    if question is None:
+        logging.info(f"Vote {msg.get('seq')} of room {room_state.room_id} is for the unknown question {msg['question_uuid']}")
+        if msg.get("seq") is not None:
+            request_sync(ip, message.port, room_state, cp, full=True)
+        return
     vote = Vote(msg["socket"], msg["question_uuid"])
-    question.toggle_vote(vote)
+    room_state.toggle_vote(question, vote)
+    applied(msg, room_state)
+    # Deltas carry the resulting vote count, so applying one twice is harmless
+    if room_state is application_state:
+        broker.publish(application_state.version, "vote", {"uuid": question.uuid, "votes": question.vote_count})
     logging.info(f"Added vote {vote.__dict__} to application state")
+
+def vote_batch_handler(message, ip, application_state, cp: ControlPlane):
+    batch = json.loads(message.data)
+    propagated(batch, message.opcode)
+    for vote in batch["votes"]:
+        vote_handler(Message(opcode=OpCode.VOTE, port=message.port, data=json.dumps(vote)), ip, application_state, cp)
+
+def operation_log_handler(message, ip, application_state, cp: ControlPlane):
+    logging.info(f"Replaying {len(message.data)} operations")
+    for seq, opcode, data in message.data:
+        message_handler(Message(opcode=OpCode(opcode), port=message.port, data=data), ip, application_state, cp)
     
 def election_result_handler(message, ip, application_state, cp):
+    replicas.seen(ip, message.port)
     cp.leader_ip = ip
     cp.leader_port = message.port
     logging.info(f"Switching leader to {cp.leader_ip}:{cp.leader_port}") 
 
 def message_handler(message: Message, ip: str, application_state: ApplicationState, cp: ControlPlane):
+    MESSAGES_HANDLED.inc(message.opcode.value)
     if message.opcode is OpCode.HELLO_REPLY:
         # TODO: the leader is implicitely the node we received the message from
         hello_reply_handler(message, ip, application_state, cp)
@@ -221,10 +573,65 @@ def message_handler(message: Message, ip: str, application_state: ApplicationSta
         question_handler(message, ip, application_state, cp)
     elif message.opcode is OpCode.VOTE:
         vote_handler(message, ip, application_state, cp)
+    elif message.opcode is OpCode.VOTE_BATCH:
+        vote_batch_handler(message, ip, application_state, cp)
     elif message.opcode is OpCode.ELECTION_RESULT:
         election_result_handler(message, ip, application_state, cp)
+    elif message.opcode is OpCode.HEARTBEAT:
+        replicas.seen(ip, message.port)
+    elif message.opcode is OpCode.READ_REPLY:
+        reads.reply_handler(message)
+    elif message.opcode in (OpCode.REQUEST_ACK, OpCode.REQUEST_REJECTED, OpCode.NOT_LEADER):
+        request_manager.reply_handler(message)
+    elif message.opcode is OpCode.APPLICATION_STATE:
+        application_state_handler(message, ip, application_state, cp)
+    elif message.opcode is OpCode.OPERATION_LOG:
+        operation_log_handler(message, ip, application_state, cp)
+    elif message.opcode is OpCode.STATE_CHUNK:
+        transfer.chunk_handler(message, ip, cp.port, lambda msg: message_handler(msg, ip, application_state, cp))
+    elif message.opcode is OpCode.RELIABLE_DATA:
+        for delivered in reliable.receive(message, ip):
+            message_handler(delivered, ip, application_state, cp)
+    elif message.opcode is OpCode.RELIABLE_ACK:
+        reliable.ack(message, ip)
     else:
         return  
+
+# Messages that change the state of the client and therefore are forwarded to the HTTP workers
+FEED_OPCODES = {
+    OpCode.HELLO_REPLY,
+    OpCode.QUESTION,
+    OpCode.VOTE,
+    OpCode.VOTE_BATCH,
+    OpCode.ELECTION_RESULT,
+    OpCode.APPLICATION_STATE,
+    OpCode.OPERATION_LOG,
+    # Tells the workers which servers they can read from
+    OpCode.HEARTBEAT,
+}
+
+def feed_handshake(application_state: ApplicationState, cp: ControlPlane) -> list[bytes]:
+    # New workers start with the state and the leader known to the ingest process
+    state = Message(opcode=OpCode.HELLO_REPLY, port=cp.leader_port, data=json.dumps(application_state, cls=CustomEncoder))
+    return [encode_frame(state, cp.leader_ip)]
+
+def ingest_handler(feed: FeedServer):
+    def handler(message: Message, ip: str, application_state: ApplicationState, cp: ControlPlane):
+        if message.opcode is OpCode.STATE_CHUNK:
+            # Chunks are reassembled here, workers only receive the complete message
+            transfer.chunk_handler(message, ip, cp.port, lambda msg: handler(msg, ip, application_state, cp))
+        elif message.opcode is OpCode.RELIABLE_DATA:
+            for delivered in reliable.receive(message, ip):
+                handler(delivered, ip, application_state, cp)
+        elif message.opcode is OpCode.RELIABLE_ACK:
+            # Requests are sent by the HTTP workers, so they need the acknowledgements
+            feed.ingest(message, ip, lambda: reliable.ack(message, ip))
+        elif message.opcode in (OpCode.READ_REPLY, OpCode.REQUEST_ACK, OpCode.REQUEST_REJECTED, OpCode.NOT_LEADER):
+            # Reads and requests are sent by the HTTP workers as well
+            feed.ingest(message, ip, lambda: None)
+        elif message.opcode in FEED_OPCODES:
+            feed.ingest(message, ip, lambda: message_handler(message, ip, application_state, cp))
+    return handler
     
 def init():
     parser = argparse.ArgumentParser(prog="Client")
@@ -232,9 +639,41 @@ def init():
     parser.add_argument("--port", default="3678", type=int)
     parser.add_argument("--frontend-port", default="8080", type=int)
     parser.add_argument("--loglevel", default="INFO", type=str)
+    parser.add_argument("--serve-mode", default="debug", choices=["debug", "production"])
+    parser.add_argument("--workers", default=4, type=int)
+    parser.add_argument("--threads", default=32, type=int)
+    parser.add_argument("--feed-socket", default=None, type=str)
+    parser.add_argument("--wire-format", default="auto", choices=WIRE_FORMATS)
+    parser.add_argument("--delivery", default="reliable", choices=["reliable", "best-effort"])
+    parser.add_argument("--request-window", default=64, type=int, help="requests in flight per process")
+    parser.add_argument("--request-timeout", default=0.5, type=float, help="seconds until the first retry")
+    parser.add_argument("--max-staleness", default=2.0, type=float, help="seconds, default for bounded reads")
+    parser.add_argument("--transport", default="broadcast", choices=TRANSPORTS)
+    parser.add_argument("--multicast-ttl", default=1, type=int, help="hops, multicast transport only")
+    parser.add_argument("--multicast-interface", default=None, type=str, help="address of the interface, multicast transport only")
+    parser.add_argument("--outbound", default="queued", choices=["direct", "queued"], help="send from the calling thread or from per destination queues")
+    parser.add_argument("--mtu", default=1400, type=int, help="bytes, queued messages are coalesced up to it")
+    parser.add_argument("--send-queue-size", default=1024, type=int, help="messages per destination")
+    parser.add_argument("--send-rate", default=0, type=float, help="datagrams per second and destination, 0 does not pace")
+    parser.add_argument("--sndbuf", default=0, type=int, help="bytes, 0 keeps the default of the operating system")
+    parser.add_argument("--rcvbuf", default=0, type=int, help="bytes, 0 keeps the default of the operating system")
 
     args = parser.parse_args()
     logging.basicConfig(level=args.loglevel)
+    configure_wire_format(args.wire_format)
+    configure_transport(args.transport, args.multicast_ttl, args.multicast_interface)
+    configure_buffers(args.sndbuf, args.rcvbuf)
+    if args.outbound == "queued":
+        sender = OutboundSender(args.mtu, args.send_queue_size, args.send_rate)
+        sender.start()
+        configure_sender(sender)
+
+    global reliable, reads, request_manager
+    reliable = ReliableChannel(args.port)
+    reads = ReadClient(args.port, replicas)
+    request_manager = RequestManager(args.port, args.request_window, args.request_timeout)
+    if args.delivery == "reliable":
+        configure_reliable(reliable)
 
     host = '0.0.0.0'
     http_port = find_available_port(start_port=args.frontend_port)
@@ -243,20 +682,35 @@ def init():
     application_state = ApplicationState()
     cp = ControlPlane(None, None, INTERFACE.ip.compressed, args.port)
 
-    http_thread = Thread(target=http_target, args=(host, http_port, application_state, cp))
-    threads.append(http_thread)
-    http_thread.start()
+    callback = message_handler
+
+    if args.serve_mode == "production":
+        feed_path = args.feed_socket or f"/tmp/qhub-client-{args.port}.sock"
+        feed = FeedServer(feed_path, lambda: feed_handshake(application_state, cp))
+        callback = ingest_handler(feed)
 
-    broadcast_thread = Thread(target=broadcast_target, args=(message_handler, application_state, cp))
+        feed_thread = Thread(target=feed.serve, daemon=True)
+        feed_thread.start()
+    else:
+        http_thread = Thread(target=http_target, args=(host, http_port, application_state, cp, args.max_staleness))
+        threads.append(http_thread)
+        http_thread.start()
+
+    broadcast_thread = Thread(target=broadcast_target, args=(callback, application_state, cp), daemon=args.serve_mode == "production")
     threads.append(broadcast_thread)
     broadcast_thread.start()
 
-    unicast_thread = Thread(target=unicast_target, args=(message_handler, args.port, application_state, cp))
+    unicast_thread = Thread(target=unicast_target, args=(callback, args.port, application_state, cp), daemon=args.serve_mode == "production")
     threads.append(unicast_thread)
     unicast_thread.start()
 
     Message(OpCode.HELLO_SERVER, port=args.port).broadcast(2)
 
+    if args.serve_mode == "production":
+        # gunicorn has to run on the main thread, it returns once the server is shut down
+        production_target(host, http_port, args.workers, args.threads, feed_path, cp, args.delivery == "reliable", args.max_staleness)
+        return
+
     for thread in threads:
         thread.join()
 
@@ -1,11 +1,15 @@
 from enum import Enum
 from ipaddress import IPv4Interface
 import netifaces
+import itertools
 import json
 import socket
+import struct
 import logging
+import metrics
 
 sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
 
 
 def is_valid(address: str, broadcast: str | None):
@@ -35,17 +39,226 @@ INTERFACE = get_network_interface()
 BROADCAST_PORT = 34567
 BROADCAST_IP = str(INTERFACE.network.broadcast_address)
 
+TRANSPORTS = ["broadcast", "multicast"]
+# Multicast groups in the organization-local scope. Servers join both, clients only the data group,
+# so they never receive heartbeats and election traffic.
+CONTROL_GROUP = "239.255.77.1"
+DATA_GROUP = "239.255.77.2"
+MULTICAST_PORT = 34568
+
 
 class OpCode(str, Enum):
     HELLO = "hello"
     HELLO_SERVER = "hello_server"
     HELLO_REPLY = "hello_reply"
     HEARTBEAT = "heartbeat"
-    VOTE_REQUEST = "vote_request"
-    VOTE = "vote"
+    HEARTBEAT_ACK = "heartbeat_ack"
+    HEARTBEAT_NEG_ACK = "heartbeat_neg_ack"
+    ELECTION_VOTE = "election_vote"
+    ELECTION_REPLY = "election_reply"
+    ELECTION_RESULT = "election_result"
     QUESTION_REQUEST = "question_request"
     QUESTION = "question"
-    ELECTION_RESULT = "election_result"
+    VOTE_REQUEST = "vote_request"
+    VOTE = "vote"
+    APPLICATION_STATE = "application_state"
+    STATE_CHUNK = "state_chunk"
+    STATE_CHUNK_REQUEST = "state_chunk_request"
+    SYNC_REQUEST = "sync_request"
+    OPERATION_LOG = "operation_log"
+    VOTE_BATCH = "vote_batch"
+    PING = "ping"
+    PING_REQ = "ping_req"
+    PING_ACK = "ping_ack"
+    RELIABLE_DATA = "reliable_data"
+    RELIABLE_ACK = "reliable_ack"
+    READ_REQUEST = "read_request"
+    READ_REPLY = "read_reply"
+    NOT_LEADER = "not_leader"
+    REQUEST_ACK = "request_ack"
+    REQUEST_REJECTED = "request_rejected"
+    ROOM_CLAIM = "room_claim"
+    ROOM_CLAIM_REPLY = "room_claim_reply"
+
+
+# Wire ids of the opcodes in the binary format. Ids must never be reused or renumbered.
+OPCODE_IDS = {
+    OpCode.HELLO: 1,
+    OpCode.HELLO_SERVER: 2,
+    OpCode.HELLO_REPLY: 3,
+    OpCode.HEARTBEAT: 4,
+    OpCode.HEARTBEAT_ACK: 5,
+    OpCode.HEARTBEAT_NEG_ACK: 6,
+    OpCode.ELECTION_VOTE: 7,
+    OpCode.ELECTION_REPLY: 8,
+    OpCode.ELECTION_RESULT: 9,
+    OpCode.QUESTION_REQUEST: 10,
+    OpCode.QUESTION: 11,
+    OpCode.VOTE_REQUEST: 12,
+    OpCode.VOTE: 13,
+    OpCode.APPLICATION_STATE: 14,
+    OpCode.STATE_CHUNK: 15,
+    OpCode.STATE_CHUNK_REQUEST: 16,
+    OpCode.SYNC_REQUEST: 17,
+    OpCode.OPERATION_LOG: 18,
+    OpCode.VOTE_BATCH: 19,
+    OpCode.PING: 20,
+    OpCode.PING_REQ: 21,
+    OpCode.PING_ACK: 22,
+    OpCode.RELIABLE_DATA: 23,
+    OpCode.RELIABLE_ACK: 24,
+    OpCode.READ_REQUEST: 25,
+    OpCode.READ_REPLY: 26,
+    OpCode.NOT_LEADER: 27,
+    OpCode.REQUEST_ACK: 28,
+    OpCode.REQUEST_REJECTED: 29,
+    OpCode.ROOM_CLAIM: 30,
+    OpCode.ROOM_CLAIM_REPLY: 31,
+}
+OPCODES_BY_ID = {opcode_id: opcode for opcode, opcode_id in OPCODE_IDS.items()}
+# Looking up a dict is much cheaper than calling the enum for every received message
+OPCODES_BY_VALUE = {opcode.value: opcode for opcode in OpCode}
+
+# Binary frame header: magic, format version, opcode id, port, sequence number, body encoding and body length.
+# The magic byte can never start a JSON message, which lets receivers accept both formats.
+WIRE_MAGIC = 0xB7
+# Version 2 also receives bundles, version 1 only single messages
+WIRE_VERSION = 2
+BINARY_VERSION = 1
+BUNDLE_VERSION = 2
+HEADER = struct.Struct("!BBBHIBI")
+
+# Several messages coalesced into one datagram: the magic byte followed by every message with its length
+BUNDLE_MAGIC = 0xB8
+FRAME_LENGTH = struct.Struct("!H")
+BUNDLE_OVERHEAD = 1
+FRAME_OVERHEAD = FRAME_LENGTH.size
+
+BODY_NONE = 0
+BODY_TEXT = 1
+BODY_JSON = 2
+
+# "json" only speaks the original JSON format, "binary" always uses the binary format and
+# "auto" sends binary to peers that advertised support for it and JSON to everyone else
+WIRE_FORMATS = ["json", "auto", "binary"]
+wire_format = "auto"
+binary_peers: set[tuple[str, int]] = set()
+bundle_peers: set[tuple[str, int]] = set()
+sequence = itertools.count(1)
+
+
+transport = "broadcast"
+multicast_interface = INTERFACE.ip.compressed
+
+
+# `ttl` 1 keeps the datagrams on the local network, every router on the way decreases it by one
+def configure_transport(name: str, ttl: int = 1, interface: str | None = None):
+    global transport, multicast_interface
+    transport = name
+    if interface is not None:
+        multicast_interface = interface
+    if transport == "multicast":
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(multicast_interface))
+
+
+# Receives the datagrams sent to `groups`. A socket bound to a single group only gets the datagrams of
+# that group, even if another process on the same host joined other groups on the same port.
+def multicast_socket(groups: list[str]) -> socket.socket:
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    apply_receive_buffer(listen_socket)
+    listen_socket.bind((groups[0] if len(groups) == 1 else "", MULTICAST_PORT))
+    for group in groups:
+        membership = socket.inet_aton(group) + socket.inet_aton(multicast_interface)
+        listen_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    return listen_socket
+
+
+# Set on startup if datagrams are sent by the outbound sender instead of the calling thread
+outbound_sender = None
+
+
+def configure_sender(sender):
+    global outbound_sender
+    outbound_sender = sender
+
+
+# Larger buffers absorb longer bursts, 0 keeps the default of the operating system
+receive_buffer = 0
+
+
+def configure_buffers(send: int = 0, receive: int = 0):
+    global receive_buffer
+    receive_buffer = receive
+    if send:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send)
+
+
+def apply_receive_buffer(listen_socket: socket.socket):
+    if receive_buffer:
+        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+
+
+def configure_wire_format(format: str):
+    global wire_format
+    wire_format = format
+
+
+# Unicast messages that go through the reliable layer (retransmits, exactly once and in order delivery)
+# if it is enabled. Broadcast operations are covered by their operation sequence numbers instead.
+RELIABLE_OPCODES = {
+    OpCode.HELLO_REPLY,
+    OpCode.ELECTION_VOTE,
+    OpCode.ELECTION_REPLY,
+    OpCode.QUESTION_REQUEST,
+    OpCode.VOTE_REQUEST,
+    OpCode.APPLICATION_STATE,
+    OpCode.SYNC_REQUEST,
+    OpCode.OPERATION_LOG,
+    OpCode.ROOM_CLAIM,
+    OpCode.ROOM_CLAIM_REPLY,
+}
+reliable_channel = None
+
+
+def configure_reliable(channel):
+    global reliable_channel
+    reliable_channel = channel
+
+
+def register_peer(ip: str, message: "Message"):
+    if message.wire is None or message.port is None:
+        return
+    if message.wire >= BINARY_VERSION:
+        binary_peers.add((ip, message.port))
+    if message.wire >= BUNDLE_VERSION:
+        bundle_peers.add((ip, message.port))
+
+
+def pack_bundle(payloads: list[bytes]) -> bytes:
+    parts = [bytes((BUNDLE_MAGIC,))]
+    for payload in payloads:
+        parts.append(FRAME_LENGTH.pack(len(payload)))
+        parts.append(payload)
+    return b"".join(parts)
+
+
+# The messages in a received datagram, slices of the datagram if it is a bundle
+def unpack_datagram(datagram: bytes) -> list[bytes]:
+    if datagram[0] != BUNDLE_MAGIC:
+        return [datagram]
+
+    view = memoryview(datagram)
+    frames = []
+    offset = BUNDLE_OVERHEAD
+    while offset + FRAME_OVERHEAD <= len(view):
+        (length,) = FRAME_LENGTH.unpack_from(view, offset)
+        offset += FRAME_OVERHEAD
+        frames.append(view[offset:offset + length])
+        offset += length
+    return frames
+
 
 class Message:
     def __init__(
@@ -54,37 +267,129 @@ class Message:
         self.opcode: OpCode = opcode
         self.data: bytes = data
         self.port: int = port
+        # Binary format version supported by the sender and sequence number of the received frame
+        self.wire: int | None = None
+        self.seq: int | None = None
 
-    def marshal(self):
-        return bytes(json.dumps(self.__dict__), "UTF-8")
+    def marshal(self, binary: bool | None = None):
+        if binary is None:
+            binary = wire_format == "binary"
+        if binary:
+            return self.marshal_binary()
 
-    @staticmethod
-    def unmarshal(data_b: bytes) -> "Message":
-        data_str = data_b.decode("UTF-8")
-        payload = json.loads(data_str)
-        logging.debug(f"Unmarshalled payload {payload}")
-        return Message(
-            OpCode(payload.get("opcode")), payload.get("data"), payload.get("port")
+        payload = {"opcode": self.opcode, "data": self.data, "port": self.port}
+        if wire_format != "json":
+            payload["wire"] = WIRE_VERSION
+        return bytes(json.dumps(payload), "UTF-8")
+
+    def marshal_binary(self) -> bytes:
+        # Text payloads are sent as they are instead of being escaped into another JSON document
+        if self.data is None:
+            encoding, body = BODY_NONE, b""
+        elif isinstance(self.data, str):
+            encoding, body = BODY_TEXT, self.data.encode("UTF-8")
+        else:
+            encoding, body = BODY_JSON, json.dumps(self.data, separators=(",", ":")).encode("UTF-8")
+
+        header = HEADER.pack(
+            WIRE_MAGIC,
+            WIRE_VERSION,
+            OPCODE_IDS[self.opcode],
+            self.port or 0,
+            next(sequence) & 0xFFFFFFFF,
+            encoding,
+            len(body),
         )
+        return header + body
+
+    # Accepts both formats. If the sender ip is given, the sender is remembered as binary capable when it advertised it.
+    @staticmethod
+    def unmarshal(data_b: bytes, ip: str | None = None) -> "Message":
+        if data_b[0] == WIRE_MAGIC:
+            message = Message.unmarshal_binary(data_b)
+        else:
+            # Also decodes memoryview slices of a receive buffer without copying them into bytes first
+            data_str = str(data_b, "UTF-8")
+            payload = json.loads(data_str)
+            logging.debug("Unmarshalled payload %s", payload)
+            message = Message(
+                OPCODES_BY_VALUE[payload.get("opcode")], payload.get("data"), payload.get("port")
+            )
+            message.wire = payload.get("wire")
+
+        if ip is not None:
+            register_peer(ip, message)
+        return message
+
+    # All messages of a received datagram, which may be a bundle of several
+    @staticmethod
+    def unmarshal_datagram(datagram: bytes, ip: str | None = None) -> list["Message"]:
+        return [Message.unmarshal(frame, ip) for frame in unpack_datagram(datagram)]
+
+    @staticmethod
+    def unmarshal_binary(data_b: bytes) -> "Message":
+        _, version, opcode_id, port, seq, encoding, length = HEADER.unpack_from(data_b)
+        body = memoryview(data_b)[HEADER.size:HEADER.size + length]
+
+        if encoding == BODY_TEXT:
+            data = str(body, "UTF-8")
+        elif encoding == BODY_JSON:
+            data = json.loads(str(body, "UTF-8"))
+        else:
+            data = None
+
+        message = Message(OPCODES_BY_ID[opcode_id], data, port or None)
+        message.wire = version
+        message.seq = seq
+        return message
 
     def broadcast(self, timeout=0) -> tuple["Message", str, str]:
-        return send(self.marshal(), timeout=timeout)
+        return send(self.marshal(), timeout=timeout, opcode=self.opcode)
 
     def send(self, ip: str, port: int, timeout=0) -> tuple["Message", str, str]:
-        return send(self.marshal(), (ip, port), timeout=timeout)
+        if reliable_channel is not None and self.opcode in RELIABLE_OPCODES:
+            return reliable_channel.send(self, ip, port)
+        return self.send_unreliable(ip, port, timeout)
 
+    def send_unreliable(self, ip: str, port: int, timeout=0) -> tuple["Message", str, str]:
+        binary = wire_format == "binary" or (wire_format == "auto" and (ip, port) in binary_peers)
+        return send(self.marshal(binary), (ip, port), timeout=timeout, opcode=self.opcode)
 
-def send(payload: bytes, address: tuple[str, int] | None = None, timeout=0):
-    if address is None:
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        address = (BROADCAST_IP, BROADCAST_PORT)
 
-    msg = json.loads(payload)
+# Broadcast messages the clients need, everything else is sent to the control group
+DATA_OPCODES = {OpCode.QUESTION, OpCode.VOTE, OpCode.VOTE_BATCH, OpCode.ELECTION_RESULT}
+
+
+MESSAGES_SENT = metrics.counter("qhub_messages_sent_total", "Messages sent by type", ("opcode",))
+
+
+# Frequent messages that are not logged on every send
+QUIET_OPCODES = {
+    OpCode.HEARTBEAT, OpCode.STATE_CHUNK, OpCode.PING, OpCode.PING_REQ, OpCode.PING_ACK,
+    OpCode.RELIABLE_DATA, OpCode.RELIABLE_ACK, OpCode.READ_REQUEST, OpCode.READ_REPLY,
+    OpCode.REQUEST_ACK,
+}
+
+
+def send(payload: bytes, address: tuple[str, int] | None = None, timeout=0, *, opcode: OpCode):
+    # Everyone receiving a broadcast has to understand bundles, which only "binary" guarantees
+    if address is None:
+        bundle = wire_format == "binary"
+        if transport == "multicast":
+            address = (DATA_GROUP if opcode in DATA_OPCODES else CONTROL_GROUP, MULTICAST_PORT)
+        else:
+            address = (BROADCAST_IP, BROADCAST_PORT)
+    else:
+        bundle = address in bundle_peers
 
-    if msg["opcode"] != "heartbeat":
+    MESSAGES_SENT.inc(opcode.value)
+    if opcode not in QUIET_OPCODES:
         logging.info(
-            f"Sending message of type {msg['opcode']} to {address[0]}:{address[1]}"
+            f"Sending message of type {opcode.value} to {address[0]}:{address[1]}"
         )
 
     print(address)
-    sock.sendto(payload, address)
+    if outbound_sender is not None:
+        outbound_sender.send(payload, address, opcode, bundle)
+    else:
+        sock.sendto(payload, address)
@@ -0,0 +1,63 @@
+from bisect import bisect_left, insort
+from threading import Lock
+
+
+# Questions ordered by vote count (descending) and arrival (ascending) for equal counts.
+# The order is kept up to date on every change, so reading a page is O(k) instead of sorting on every request.
+# Changes arrive on the receive thread while request threads read pages, so both hold the lock.
+class Ranking:
+    def __init__(self):
+        self._entries: list[tuple[int, int, str]] = []
+        self._keys: dict[str, tuple[int, int, str]] = {}
+        self._questions = {}
+        self._arrivals = 0
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def rebuild(self, questions):
+        with self._lock:
+            self._entries = []
+            self._keys = {}
+            self._questions = {}
+            self._arrivals = 0
+            for question in questions:
+                self._keys[question.uuid] = self._key(question)
+                self._questions[question.uuid] = question
+            self._entries = sorted(self._keys.values())
+
+    def add(self, question):
+        with self._lock:
+            self._add(question)
+
+    # Move a question to its new position after its vote count changed
+    def update(self, question):
+        with self._lock:
+            old_key = self._keys.get(question.uuid)
+            if old_key is None:
+                return self._add(question)
+            if old_key[0] == -question.vote_count:
+                return
+
+            del self._entries[bisect_left(self._entries, old_key)]
+            key = (-question.vote_count, old_key[1], question.uuid)
+            self._keys[question.uuid] = key
+            insort(self._entries, key)
+
+    def page(self, offset: int = 0, limit: int | None = None):
+        end = None if limit is None else offset + limit
+        with self._lock:
+            return [self._questions[uuid] for _, _, uuid in self._entries[offset:end]]
+
+    def _add(self, question):
+        if question.uuid in self._keys:
+            return
+        key = self._key(question)
+        self._keys[question.uuid] = key
+        self._questions[question.uuid] = question
+        insort(self._entries, key)
+
+    def _key(self, question) -> tuple[int, int, str]:
+        self._arrivals += 1
+        return (-question.vote_count, self._arrivals, question.uuid)
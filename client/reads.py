@@ -0,0 +1,117 @@
+import itertools
+import logging
+import time
+from threading import Event, Lock
+from uuid import uuid4
+from network import Message, OpCode
+
+# Answers to a read request, see server/reads.py
+READ_OK = "ok"
+READ_STALE = "stale"
+READ_NOT_LEADER = "not_leader"
+
+# Servers that have not been heard of for this many seconds are no longer asked
+REPLICA_TTL = 10
+
+
+# Servers the client can read from. They are learned from their heartbeats, election results and the
+# operations of the room leaders.
+class Replicas:
+    def __init__(self, ttl: float = REPLICA_TTL):
+        self.ttl = ttl
+        self._seen: dict[tuple[str, int], float] = {}
+        self._next = itertools.count()
+        self._lock = Lock()
+
+    def seen(self, ip: str, port: int, now: float | None = None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._seen[(ip, port)] = now
+
+    # All live servers, starting at a different one on every call to spread the reads
+    def rotation(self, now: float | None = None) -> list[tuple[str, int]]:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            for replica, seen in list(self._seen.items()):
+                if seen + self.ttl < now:
+                    del self._seen[replica]
+            replicas = sorted(self._seen)
+        if not replicas:
+            return []
+        start = next(self._next) % len(replicas)
+        return replicas[start:] + replicas[:start]
+
+
+class ReadError(Exception):
+    pass
+
+
+class PendingRead:
+    def __init__(self):
+        self.done = Event()
+        self.reply: dict | None = None
+
+
+# Reads the questions from the servers instead of the local replica. Bounded reads go to the servers
+# in turn and move on to the next one if a server does not answer within `timeout` or its state is
+# too old. Lease reads always go to the leader of the room.
+class ReadClient:
+    def __init__(self, local_port: int, replicas: Replicas, timeout: float = 0.5):
+        self.local_port = local_port
+        self.replicas = replicas
+        self.timeout = timeout
+        self._pending: dict[str, PendingRead] = {}
+        self._lock = Lock()
+
+    def read(self, consistency: str, leader: tuple[str, int] | None, max_staleness: float | None = None,
+             min_seq: int = 0, offset: int = 0, limit: int | None = None, room: str | None = None) -> tuple[dict, tuple[str, int]]:
+        request = {"consistency": consistency, "min_seq": min_seq, "offset": offset, "limit": limit}
+        if room is not None:
+            request["room"] = room
+        if max_staleness is not None:
+            request["max_staleness"] = max_staleness
+
+        if consistency == "lease":
+            targets = [leader]
+        else:
+            targets = self.replicas.rotation()
+            if leader not in targets:
+                targets.append(leader)
+
+        for target in targets:
+            if target is None:
+                continue
+            reply = self._request(request, target)
+            if reply is None:
+                logging.info(f"Read from {target[0]}:{target[1]} timed out")
+                continue
+            if reply["status"] == READ_OK:
+                return reply, target
+            if reply["status"] == READ_NOT_LEADER and reply.get("leader") is not None:
+                leader = tuple(reply["leader"])
+                reply = self._request(request, leader)
+                if reply is not None and reply["status"] == READ_OK:
+                    return reply, leader
+
+        raise ReadError(f"No server answered the {consistency} read")
+
+    def _request(self, request: dict, target: tuple[str, int]) -> dict | None:
+        request_id = uuid4().hex
+        pending = PendingRead()
+        with self._lock:
+            self._pending[request_id] = pending
+        try:
+            Message(opcode=OpCode.READ_REQUEST, port=self.local_port, data={**request, "id": request_id}).send(*target)
+            pending.done.wait(self.timeout)
+            return pending.reply
+        finally:
+            with self._lock:
+                self._pending.pop(request_id, None)
+
+    # Replies to reads of another HTTP worker sharing the port are ignored
+    def reply_handler(self, message: Message):
+        with self._lock:
+            pending = self._pending.get(message.data["id"])
+        if pending is not None:
+            pending.reply = message.data
+            pending.done.set()
@@ -0,0 +1,134 @@
+import json
+import logging
+import time
+from threading import BoundedSemaphore, Event, Lock
+from uuid import uuid4
+import metrics
+from network import Message, OpCode
+
+REQUEST_LATENCY = metrics.histogram(
+    "qhub_client_request_seconds",
+    "Time from sending a request until the leader acknowledged it",
+    (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+    ("opcode",),
+)
+REQUEST_RETRIES = metrics.counter("qhub_client_request_retries_total", "Requests sent again after a timeout", ("opcode",))
+REQUEST_REDIRECTS = metrics.counter("qhub_client_request_redirects_total", "Requests a follower sent to the leader", ("opcode",))
+REQUEST_FAILURES = metrics.counter("qhub_client_request_failures_total", "Requests that were never acknowledged", ("opcode",))
+
+
+class RequestError(Exception):
+    pass
+
+
+# The leader refused the request, sending it again would not change that
+class RequestRejected(RequestError):
+    pass
+
+
+class PendingRequest:
+    def __init__(self):
+        self.done = Event()
+        self.seq: int | None = None
+        # Set by a follower that does not know the leader either
+        self.redirected = False
+        self.leader: tuple[str, int] | None = None
+        self.rejected: str | None = None
+
+
+# Sends questions and votes to the leader and waits until the leader acknowledges them. A request keeps
+# its id across retries, so the leader applies it once even if only the acknowledgement got lost. Requests
+# are retried with a growing timeout, at the leader a follower names or at the leader learned from the
+# latest election result. At most `window` requests are in flight at once, further ones wait for a slot.
+#
+# Every room has its own leader. The leaders that acknowledged or were named in a redirect are remembered
+# per room, until then requests go to the elected leader, which redirects them.
+class RequestManager:
+    def __init__(self, local_port: int, window: int = 64, timeout: float = 0.5, attempts: int = 8):
+        self.local_port = local_port
+        self.timeout = timeout
+        self.attempts = attempts
+        self._window = BoundedSemaphore(window)
+        self._pending: dict[str, PendingRequest] = {}
+        self._leaders: dict[str | None, tuple[str, int]] = {}
+        self._lock = Lock()
+
+    def leader(self, room: str | None, cp) -> tuple[str, int] | None:
+        if room is not None and room in self._leaders:
+            return self._leaders[room]
+        return current_leader(cp)
+
+    # Returns the sequence number the leader assigned and the latency in seconds
+    def submit(self, opcode: OpCode, data: dict, cp) -> tuple[int, float]:
+        request_id = uuid4().hex
+        room = data.get("room")
+        payload = json.dumps({**data, "request_id": request_id})
+        pending = PendingRequest()
+
+        with self._window:
+            with self._lock:
+                self._pending[request_id] = pending
+            started = time.monotonic()
+            try:
+                leader = None
+                for attempt in range(self.attempts):
+                    timeout = self.timeout * 2 ** min(attempt, 3)
+                    leader = leader or self.leader(room, cp)
+                    if leader is None:
+                        # An election is going on, the result tells us the new leader
+                        time.sleep(timeout)
+                        continue
+
+                    if attempt > 0:
+                        REQUEST_RETRIES.inc(opcode.value)
+                    pending.done.clear()
+                    Message(opcode=opcode, port=self.local_port, data=payload).send(*leader)
+
+                    replied = pending.done.wait(timeout)
+                    if replied and pending.rejected is not None:
+                        raise RequestRejected(pending.rejected)
+                    if replied and pending.seq is not None:
+                        if room is not None:
+                            self._leaders[room] = leader
+                        latency = time.monotonic() - started
+                        REQUEST_LATENCY.observe(latency, opcode.value)
+                        return pending.seq, latency
+
+                    if pending.redirected:
+                        REQUEST_REDIRECTS.inc(opcode.value)
+                        pending.redirected = False
+                        leader = pending.leader
+                        if leader is None:
+                            time.sleep(timeout)
+                    else:
+                        logging.info(f"Request {request_id} to {leader[0]}:{leader[1]} timed out")
+                        self._leaders.pop(room, None)
+                        leader = None
+            finally:
+                with self._lock:
+                    self._pending.pop(request_id, None)
+
+        REQUEST_FAILURES.inc(opcode.value)
+        raise RequestError(f"Request {request_id} was not acknowledged after {self.attempts} attempts")
+
+    # Replies to requests of another HTTP worker sharing the port are ignored
+    def reply_handler(self, message: Message):
+        with self._lock:
+            pending = self._pending.get(message.data["request_id"])
+        if pending is None:
+            return
+
+        if message.opcode is OpCode.REQUEST_ACK:
+            pending.seq = message.data["seq"]
+        elif message.opcode is OpCode.REQUEST_REJECTED:
+            pending.rejected = message.data["reason"]
+        else:
+            pending.redirected = True
+            pending.leader = None if message.data["leader"] is None else tuple(message.data["leader"])
+        pending.done.set()
+
+
+def current_leader(cp) -> tuple[str, int] | None:
+    if cp.leader_ip is None or cp.leader_port is None:
+        return None
+    return cp.leader_ip, cp.leader_port
@@ -0,0 +1,46 @@
+import json
+from threading import Lock
+from uuid import uuid4
+from application_state import ApplicationState
+
+
+# Encoded /api/get bodies of the current state version. The cache is dropped as soon as the
+# version changes, so polls on an unchanged state never serialize the questions again.
+class SnapshotCache:
+    def __init__(self, max_pages: int = 64):
+        self.max_pages = max_pages
+        # Versions start at zero again after a restart, the epoch keeps old ETags from matching
+        self.epoch = uuid4().hex[:8]
+        self._version: int | None = None
+        self._bodies: dict[tuple[int, int | None], bytes] = {}
+        self._lock = Lock()
+
+    def etag(self, version: int) -> str:
+        return f"{self.epoch}-{version}"
+
+    def get(self, app_state: ApplicationState, offset: int = 0, limit: int | None = None) -> tuple[int, bytes]:
+        version = app_state.version
+        page = (offset, limit)
+
+        with self._lock:
+            if self._version == version and page in self._bodies:
+                return version, self._bodies[page]
+
+        body = encode_questions(app_state.ranking.page(offset, limit))
+
+        with self._lock:
+            if self._version != version:
+                self._version = version
+                self._bodies = {}
+            if len(self._bodies) < self.max_pages:
+                self._bodies[page] = body
+
+        return version, body
+
+
+def summarize(question) -> dict:
+    return {"uuid": question.uuid, "text": question.text, "votes": question.vote_count}
+
+
+def encode_questions(questions) -> bytes:
+    return json.dumps([summarize(question) for question in questions], separators=(",", ":")).encode("UTF-8")
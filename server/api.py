@@ -1,24 +1,110 @@
-from network import Message, OpCode
+from network import Message, OpCode, QUIET_OPCODES
 import socket
-from network import INTERFACE, BROADCAST_PORT
+from network import INTERFACE, BROADCAST_PORT, CONTROL_GROUP, DATA_GROUP, multicast_socket, apply_receive_buffer
+import network
 import logging
 from control_plane import ControlPlane
 import time
 from node import Node
 from election import Election
 import json
-from election import ElectionData
+from election import ElectionData, ELECTION_OPCODES
+import election as elections
 from application_state import ApplicationState, Question, Vote
 import node
+import transfer
+from receiver import BatchReceiver
+from batcher import VoteBatcher
+from dispatch import Dispatcher
+from swim import Swim
+from phi import PhiAccrualDetector
+from reliable import ReliableChannel
+from bully import BullyElection
+from claims import RoomClaims
+from request_table import RequestTable
+from reads import Freshness, READ_OK, READ_STALE, READ_NOT_LEADER, leader_staleness, read_page
+import metrics
+
+# Its counts are the messages handled per type as well
+HANDLER_LATENCY = metrics.histogram(
+    "qhub_handler_seconds",
+    "Time the handler of a message took",
+    (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5),
+    ("opcode",),
+)
+HEARTBEAT_RTT = metrics.histogram(
+    "qhub_heartbeat_rtt_seconds",
+    "Time from sending a heartbeat until a peer acknowledged it",
+    (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+    ("peer",),
+)
+STATE_QUESTIONS = metrics.gauge("qhub_state_questions", "Questions in all rooms")
+STATE_VOTES = metrics.gauge("qhub_state_votes", "Votes in all rooms")
+STATE_ROOMS = metrics.gauge("qhub_state_rooms", "Rooms besides the default room")
+
+# Minimum time between two requests for missing operations
+SYNC_REQUEST_INTERVAL = 1
+
+# Datagrams the receiving threads read per wakeup, 1 reads them one at a time
+RECEIVE_BATCH = 64
+
+# Time a node holds the first vote of an election, so the other nodes notice the same failure first
+ELECTION_DELAY = 1.0
+
+# Set on startup if the leader broadcasts votes in batches
+vote_batcher: VoteBatcher | None = None
+
+
+# Set on startup if failures are detected with SWIM instead of broadcast heartbeats
+failure_detector: Swim | None = None
+
+# Set on startup if peers are suspected based on the distribution of their heartbeat arrival times
+phi_detector: PhiAccrualDetector | None = None
+
+# Unwraps messages that were sent through the reliable layer and acknowledges them
+reliable: ReliableChannel | None = None
+
+# Seconds since a majority last confirmed the leader, up to which the leader answers lease reads
+READ_LEASE = 2.0
+
+# Ids of the client requests that were applied, so retried requests are not applied twice
+request_table = RequestTable()
+
+# Rooms this node led at the last heartbeat, to log when rooms move between nodes
+led_rooms: set[str] = set()
+
+# Bytes of room names and sequence numbers a heartbeat announces at most, and where the next one continues
+ANNOUNCED_ROOMS_SIZE = 1024
+ROOM_ANNOUNCEMENT_OVERHEAD = 16
+announced_offset = 0
+
+# How far this node is behind the leader of each room, learned from the sequence numbers in the heartbeats of the leaders
+freshness: dict[str | None, Freshness] = {}
+
+# Set on startup if leaders are elected with the bully algorithm instead of on the ring
+bully: BullyElection | None = None
+
+# Set on startup if handlers run on the worker pools of the dispatcher instead of the receiving thread
+dispatcher: Dispatcher | None = None
+
+# Set on startup, syncs the rooms this node becomes the owner of before it sequences writes to them
+room_claims: RoomClaims | None = None
+
+
+# Runs a callback after a delay. The threaded runtime blocks the receiving thread for the delay,
+# the asyncio runtime replaces this with a timer on its event loop.
+def defer(delay: float, callback):
+    time.sleep(delay)
+    callback()
 
 class CustomEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, ApplicationState):
             # Serialize the Question object to a dictionary
-            return {'_type': 'ApplicationState', **obj.__dict__}
+            return {'_type': 'ApplicationState', **obj.to_dict()}
         if isinstance(obj, Question):
             # Serialize the Question object to a dictionary
-            return {'_type': 'Question', **obj.__dict__}
+            return {'_type': 'Question', **obj.to_dict()}
         if isinstance(obj, Vote):
             # Serialize the Question object to a dictionary
             return {'_type': 'Vote', **obj.__dict__}
@@ -45,206 +131,627 @@ class CustomDecoder(json.JSONDecoder):
     
 def application_state_handler(message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState):
     application_state = json.loads(message.data, cls=CustomDecoder)
-    app_state.questions = application_state.questions
-
-    logging.info("Received application state")
+    room_state = app_state.room(application_state.room_id)
+    room_state.questions = application_state.questions
+    room_state.seq = application_state.seq
+    room_state.epoch = application_state.epoch
+    room_state.owner = application_state.owner
+    room_state.operations.reset(room_state.seq)
+    # The logged operations no longer lead up to the new state, so it has to be stored as a whole
+    if room_state.storage is not None:
+        room_state.storage.snapshot(room_state)
+
+    # The state of the default room comes with all other rooms, only those that are ahead replace ours. A room
+    # taken over by a new owner is ahead even if its sequence number is not, the owner reused ours.
+    for room, state in application_state.rooms.items():
+        current = app_state.room(room)
+        if (state.epoch, state.seq) > (current.epoch, current.seq):
+            app_state.rooms[room] = state
+
+    logging.info(f"Received application state of room {room_state.room_id} at operation {room_state.seq}")
     # print("RECEIVED APPLICATION STATE")
     print(app_state.__dict__)
 
+# Operations are applied in the order of the sequence numbers assigned by the leader. Duplicates are ignored,
+# and on a gap the operation is dropped and the missing operations are requested from the sender.
+def in_sequence(msg: dict, ip: str, port: int, cp: ControlPlane, app_state: ApplicationState) -> bool:
+    seq = msg.get("seq")
+    if seq is None:
+        return True
+    if app_state.room_id is not None and not from_owner(msg, ip, port, cp, app_state):
+        return False
+    if seq <= app_state.seq:
+        return False
+    if seq > app_state.seq + 1:
+        request_sync(ip, port, cp, app_state)
+        return False
+    return True
+
+# Operations of a room are only applied if they come from the owner of the latest epoch we know of. A new owner
+# continues after the highest sequence number it found, so if we applied operations of the previous owner that
+# it never saw, our state diverged and is replaced by that of the new owner.
+def from_owner(msg: dict, ip: str, port: int, cp: ControlPlane, app_state: ApplicationState) -> bool:
+    epoch, owner = msg.get("epoch", 0), msg.get("owner")
+    if epoch < app_state.epoch or (epoch == app_state.epoch and app_state.owner is not None and owner != app_state.owner):
+        logging.info(f"Dropping operation {msg['seq']} of room {app_state.room_id} from {owner}, which no longer owns it")
+        return False
+    if epoch > app_state.epoch and msg["seq"] <= app_state.seq:
+        request_sync(ip, port, cp, app_state, full=True)
+        return False
+    return True
+
+# Operations that are no longer logged are sent as the whole state, `full` asks for it right away
+def request_sync(ip: str, port: int, cp: ControlPlane, app_state: ApplicationState, full: bool = False):
+    now = time.monotonic()
+    # A single request covers all operations after our own sequence number, so there is no need to repeat it right away
+    if app_state.operations.sync_requested + SYNC_REQUEST_INTERVAL > now:
+        return
+    app_state.operations.sync_requested = now
+
+    logging.info(f"Missing operations of room {app_state.room_id} after {app_state.seq}, requesting them from {ip}:{port}")
+    request = {"seq": -1 if full else app_state.seq}
+    if app_state.room_id is not None:
+        request["room"] = app_state.room_id
+    Message(opcode=OpCode.SYNC_REQUEST, port=cp.node.port, data=request).send(ip, port)
+
+# The send time belongs to the broadcast only. Followers log the operation as the leader logged it, so operations
+# they replay after a failover do not tell the clients that they just took that long to arrive.
+def applied(seq: int | None, message: Message, msg: dict, app_state: ApplicationState):
+    if seq is not None:
+        data = message.data
+        if "at" in msg:
+            data = json.dumps({key: value for key, value in msg.items() if key != "at"})
+        app_state.seq = seq
+        if "epoch" in msg:
+            app_state.epoch, app_state.owner = msg["epoch"], msg["owner"]
+        app_state.operations.append(seq, message.opcode.value, data)
+        persist(seq, message.opcode, data, app_state)
+
+def persist(seq: int, opcode: OpCode, data: str, app_state: ApplicationState):
+    if app_state.storage is not None:
+        app_state.storage.append(seq, opcode.value, data)
+        app_state.storage.maybe_snapshot(app_state)
+
+# Assign the next sequence number to an operation of the leader and log it. Operations of rooms carry the
+# epoch in which their owner took the room over.
+def next_operation(opcode: OpCode, data: dict, app_state: ApplicationState) -> dict:
+    app_state.seq += 1
+    operation = {**data, "seq": app_state.seq}
+    if app_state.owner is not None:
+        operation["epoch"] = app_state.epoch
+        operation["owner"] = app_state.owner
+    encoded = json.dumps(operation)
+    app_state.operations.append(app_state.seq, opcode.value, encoded)
+    persist(app_state.seq, opcode, encoded, app_state)
+    return operation
+
+# Broadcasts carry the wall clock time they were sent at, so the clients can tell how long operations take
+# to reach them. Only the broadcast has it, operations replayed from the log would skew the delays.
+def broadcast_operation(opcode: OpCode, data: dict, cp: ControlPlane, app_state: ApplicationState):
+    operation = next_operation(opcode, data, app_state)
+    Message(opcode=opcode, port=cp.node.port, data=json.dumps({**operation, "at": time.time()})).broadcast()
+    complete_request(operation.get("request_id"), operation["seq"], cp)
+
+# Apply a batch of votes collected by the vote batcher and broadcast all of them in one message
+def broadcast_votes(votes: list[dict], cancelled: list[dict], cp: ControlPlane, app_state: ApplicationState):
+    operations = []
+    for vote in votes:
+        room_state = app_state.room(vote.get("room"))
+        if not owns_room(cp, room_state):
+            # The room was taken over while the vote waited in the batch, a retry goes to the new owner
+            forget_request(vote.get("request_id"))
+            continue
+        question = room_state.get_question_from_uuid(vote["question_uuid"])
+        if question is None:
+            continue
+        room_state.toggle_vote(question, Vote(vote["socket"], vote["question_uuid"]))
+        operations.append(next_operation(OpCode.VOTE, vote, room_state))
+
+    # Toggles that cancelled each other out are done as well. The followers record them too, otherwise a new
+    # leader would apply a retry of one of them as a single toggle.
+    completed = []
+    for vote in cancelled:
+        room_state = app_state.room(vote.get("room"))
+        if not owns_room(cp, room_state):
+            forget_request(vote.get("request_id"))
+        elif vote.get("request_id") is not None:
+            completed.append({"request_id": vote["request_id"], "seq": room_state.seq})
+
+    if operations or completed:
+        batch = {"votes": operations, "at": time.time()}
+        if completed:
+            batch["cancelled"] = completed
+        Message(opcode=OpCode.VOTE_BATCH, port=cp.node.port, data=json.dumps(batch)).broadcast()
+
+    for operation in operations:
+        complete_request(operation.get("request_id"), operation["seq"], cp)
+    for request in completed:
+        complete_request(request["request_id"], request["seq"], cp)
+
+def configure_vote_batching(window: float, max_size: int, cp: ControlPlane, app_state: ApplicationState):
+    global vote_batcher
+    vote_batcher = VoteBatcher(
+        window, max_size, lambda votes, cancelled: broadcast_votes(votes, cancelled, cp, app_state), lock=app_state.lock
+    )
+
+# The elected leader leads the default room, every other room is led by the node it hashes to
+def room_leader(cp: ControlPlane, room: str | None) -> Node | None:
+    if room is None:
+        return cp.current_leader
+    return cp.room_owner(room)
+
+def leads_room(cp: ControlPlane, room: str | None) -> bool:
+    if room is None:
+        return cp.node.leader
+    leader = cp.room_owner(room)
+    return leader is not None and (leader.ip, leader.port) == (cp.node.ip, cp.node.port)
+
+# Whether this node may sequence writes to a room: the default room is sequenced by the elected leader,
+# other rooms only once this node claimed them in the current epoch
+def owns_room(cp: ControlPlane, room_state: ApplicationState | None) -> bool:
+    if room_state is None:
+        return False
+    return room_state.room_id is None or room_state.owner == f"{cp.node.ip}:{cp.node.port}"
+
+def configure_room_claims(timeout: float, cp: ControlPlane, app_state: ApplicationState):
+    global room_claims
+    room_claims = RoomClaims(
+        cp, timeout, lambda room, epoch, seq, source, pending: room_claimed(room, epoch, seq, source, pending, cp, app_state)
+    )
+
+# Takes a room over once the other servers told us its latest epoch and sequence number. If one of them is
+# ahead, we sync first and the requests that waited are dropped, the clients retry them.
+def room_claimed(room: str, epoch: int, seq: int, source: tuple[str, int] | None, pending: list, cp: ControlPlane, app_state: ApplicationState) -> bool:
+    with app_state.lock:
+        room_state = app_state.room(room)
+        if room_state.seq < seq:
+            logging.info(f"Room {room} is at {seq} elsewhere and at {room_state.seq} here, syncing before taking it over")
+            request_sync(*source, cp, room_state)
+            return False
+        room_state.epoch = max(epoch, room_state.epoch) + 1
+        room_state.owner = f"{cp.node.ip}:{cp.node.port}"
+        logging.info(f"Took over room {room} in epoch {room_state.epoch} after operation {room_state.seq}")
+
+    for retry in pending:
+        retry()
+    return True
+
+# Another server became the owner of a room. We stop sequencing it and tell the server where we are.
+def room_claim_handler(message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState):
+    room = message.data["room"]
+    claimant = f"{ip}:{message.port}"
+    # We claim the room ourselves and win, the claimant gives up once it receives our claim
+    if room_claims is not None and room_claims.contests(room, claimant):
+        return
+
+    room_state = app_state.find_room(room)
+    if room_state is not None and owns_room(cp, room_state):
+        # Votes waiting in the batch are sequenced while we still own the room, so the claimant continues after them
+        if vote_batcher is not None:
+            vote_batcher.flush("claim")
+        logging.info(f"Handing room {room} over to {claimant} after operation {room_state.seq}")
+        room_state.owner = None
+
+    reply = {"room": room, "seq": 0, "epoch": 0} if room_state is None else {"room": room, "seq": room_state.seq, "epoch": room_state.epoch}
+    Message(opcode=OpCode.ROOM_CLAIM_REPLY, port=cp.node.port, data=reply).send(ip, message.port)
+
+def room_claim_reply_handler(message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState):
+    if room_claims is not None:
+        room_claims.reply_handler(message, ip)
+
+# Requests only reach a follower if the client does not know the current leader yet, it is told where to go instead
+def redirect_request(request_id: str | None, room: str | None, ip: str, port: int, cp: ControlPlane):
+    leader = room_leader(cp, room)
+    data = {"request_id": request_id, "leader": None if leader is None or leader is cp.node else [leader.ip, leader.port]}
+    Message(opcode=OpCode.NOT_LEADER, port=cp.node.port, data=data).send(ip, port)
+
+def reject_request(request_id: str | None, reason: str, ip: str, port: int, cp: ControlPlane):
+    if request_id is not None:
+        Message(opcode=OpCode.REQUEST_REJECTED, port=cp.node.port, data={"request_id": request_id, "reason": reason}).send(ip, port)
+
+# Returns whether a request has to be applied. Retries of applied requests are acknowledged again,
+# retries of requests that wait in a vote batch are acknowledged once the batch is broadcast.
+def start_request(request_id: str | None, ip: str, port: int, cp: ControlPlane) -> bool:
+    if request_id is None or request_table.start(request_id, (ip, port)):
+        return True
+
+    seq = request_table.result(request_id)
+    logging.info(f"Request {request_id} was already applied as {seq}")
+    if seq is not None:
+        Message(opcode=OpCode.REQUEST_ACK, port=cp.node.port, data={"request_id": request_id, "seq": seq}).send(ip, port)
+    return False
+
+def forget_request(request_id: str | None):
+    if request_id is not None:
+        request_table.forget(request_id)
+
+def complete_request(request_id: str | None, seq: int | None, cp: ControlPlane):
+    if request_id is None or seq is None:
+        return
+    reply_to = request_table.complete(request_id, seq)
+    if reply_to is not None:
+        Message(opcode=OpCode.REQUEST_ACK, port=cp.node.port, data={"request_id": request_id, "seq": seq}).send(*reply_to)
+
 # Vote for an existing question. If the leader does not know about the question, the question does not exist. 
 # Each question is assigned a unique UUID for identification purposes
 def vote_request_handler(message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState):
     msg = json.loads(message.data)
 
     print(f"Received msg: {msg}")
-    print(app_state.questions[0].__dict__)
-    question = app_state.get_question_from_uuid(msg["question_uuid"])
+    room = msg.get("room")
+    if not leads_room(cp, room):
+        redirect_request(msg.get("request_id"), room, ip, message.port, cp)
+        return
+
+    room_state = app_state.find_room(room)
+    if room_state is not None and not owns_room(cp, room_state):
+        room_claims.claim(room, lambda: handle(message, ip, cp, election, app_state))
+        return
+
+    question = None if room_state is None else room_state.get_question_from_uuid(msg["question_uuid"])
+    if question is None:
+        # Retrying cannot make the question appear, so the client is told right away
+        logging.info(f"Rejecting vote for unknown question {msg['question_uuid']}")
+        reject_request(msg.get("request_id"), f"Unknown question {msg['question_uuid']}", ip, message.port, cp)
+        return
+
+    request_id = msg.get("request_id")
+    if not start_request(request_id, ip, message.port, cp):
+        return
 
     vote = Vote(msg["socket"], msg["question_uuid"])
+    operation = dict(vote.__dict__)
+    if room is not None:
+        operation["room"] = room
+    if request_id is not None:
+        operation["request_id"] = request_id
+
+    if vote_batcher is not None:
+        vote_batcher.add(operation)
+        return
 
-    question.toggle_vote(vote)
-    Message(opcode=OpCode.VOTE, port=cp.node.port, data=json.dumps(vote.__dict__)).broadcast()
+    room_state.toggle_vote(question, vote)
+    broadcast_operation(OpCode.VOTE, operation, cp, room_state)
 
 # Since only the leader handles the request, the other servers also need to receive the update. This happens via the broadcast.
 def vote_handler(message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState):
     msg = json.loads(message.data)
-    question = app_state.get_question_from_uuid(msg["question_uuid"])
+    room_state = app_state.room(msg.get("room"))
+    if not in_sequence(msg, ip, message.port, cp, room_state):
+        return
+
+    question = room_state.get_question_from_uuid(msg["question_uuid"])
+    # The leader only sequences votes for questions it has, so our state diverged and is replaced as a whole
+    if question is None:
+        logging.info(f"Vote {msg.get('seq')} of room {room_state.room_id} is for the unknown question {msg['question_uuid']}")
+        if msg.get("seq") is not None:
+            request_sync(ip, message.port, cp, room_state, full=True)
+        return
 
     vote = Vote(msg["socket"], msg["question_uuid"])
 
-    question.toggle_vote(vote)
+    room_state.toggle_vote(question, vote)
+    applied(msg.get("seq"), message, msg, room_state)
+    complete_request(msg.get("request_id"), msg.get("seq"), cp)
+
+def vote_batch_handler(message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState):
+    batch = json.loads(message.data)
+    for vote in batch["votes"]:
+        vote_handler(Message(opcode=OpCode.VOTE, port=message.port, data=json.dumps(vote)), ip, cp, election, app_state)
+    for request in batch.get("cancelled", []):
+        complete_request(request["request_id"], request["seq"], cp)
 
 # Post a new question to the application
 def question_request_handler(message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState):
     msg = json.loads(message.data)
 
     print(f"Received msg: {msg}") 
-    question = Question(msg["text"])
-    print(f"Created question {question.__dict__}")
-    app_state.add_question(question)
+    room = msg.get("room")
+    if not leads_room(cp, room):
+        redirect_request(msg.get("request_id"), room, ip, message.port, cp)
+        return
+    # The request is handled again once the room is ours
+    if not owns_room(cp, app_state.find_room(room)):
+        room_claims.claim(room, lambda: handle(message, ip, cp, election, app_state))
+        return
+
+    request_id = msg.get("request_id")
+    if not start_request(request_id, ip, message.port, cp):
+        return
+
+    question = Question(msg["text"], room=room)
+    print(f"Created question {question.to_dict()}")
+    room_state = app_state.room(room)
+    room_state.add_question(question)
 
-    Message(opcode=OpCode.QUESTION, port=cp.node.port, data=json.dumps(question.__dict__)).broadcast()
+    operation = question.to_dict() if request_id is None else {**question.to_dict(), "request_id": request_id}
+    broadcast_operation(OpCode.QUESTION, operation, cp, room_state)
 
 def question_handler(message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState):
     msg = json.loads(message.data)
+    room_state = app_state.room(msg.get("room"))
+    if not in_sequence(msg, ip, message.port, cp, room_state):
+        return
     
-    question = Question(msg["text"], msg["votes"], msg["uuid"])
-    app_state.add_question(question)
+    question = Question(msg["text"], msg["votes"], msg["uuid"], msg.get("room"))
+    room_state.add_question(question)
+    applied(msg.get("seq"), message, msg, room_state)
+    complete_request(msg.get("request_id"), msg.get("seq"), cp)
+
+# Send the operations the requesting node is missing, or the whole state if the log does not reach back far enough
+def sync_request_handler(message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState):
+    room_state = app_state.find_room(message.data.get("room"))
+    if room_state is None:
+        return
+    operations = room_state.operations.since(message.data["seq"])
+
+    if operations is None:
+        logging.info(f"Operations after {message.data['seq']} are no longer logged, sending the application state")
+        transfer.send(Message(opcode=OpCode.APPLICATION_STATE, port=cp.node.port, data=json.dumps(room_state, cls=CustomEncoder)), ip, message.port)
+    else:
+        transfer.send(Message(opcode=OpCode.OPERATION_LOG, port=cp.node.port, data=operations), ip, message.port)
 
+def operation_log_handler(message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState):
+    logging.info(f"Replaying {len(message.data)} operations")
+    for seq, opcode, data in message.data:
+        handle(Message(opcode=OpCode(opcode), port=message.port, data=data), ip, cp, election, app_state)
 
 
 def election_result_handler(
-    message: Message, ip: str, cp: ControlPlane, election: Election
+    message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState
 ):
-    node = cp.get_node_from_socket(f"{ip}:{message.port}")
+    if bully is not None and not bully.result_handler(message, ip):
+        return
+    # A node that corrects an outdated result names the leader of the current term
+    leader = message.data.get("leader") if isinstance(message.data, dict) else None
+    node = cp.get_node_from_socket(f"{ip}:{message.port}" if leader is None else f"{leader[0]}:{leader[1]}")
+    if node is None:
+        return
     cp.make_leader(node)
+    elections.stats.finish()
 
 
-def broadcast_target(callback, cp: ControlPlane, election: Election, app_state: ApplicationState):
+# Servers receive the control and the data group when the cluster uses multicast
+def broadcast_socket() -> socket.socket:
+    if network.transport == "multicast":
+        return multicast_socket([CONTROL_GROUP, DATA_GROUP])
+
     listen_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
     listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    apply_receive_buffer(listen_socket)
     listen_socket.bind(("", BROADCAST_PORT))
+    return listen_socket
+
+
+def unicast_socket(lport: int) -> socket.socket:
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    apply_receive_buffer(listen_socket)
+    listen_socket.bind((INTERFACE.ip.compressed, lport))
+    return listen_socket
+
+
+def broadcast_target(callback, cp: ControlPlane, election: Election, app_state: ApplicationState):
+    listen_socket = broadcast_socket()
+    receiver = BatchReceiver(listen_socket, RECEIVE_BATCH)
 
     try:
         while True:
-            data, (ip, port) = listen_socket.recvfrom(2048)
-            if data:
-                msg = Message.unmarshal(data)
+            for data, ip in receiver.receive():
+                for msg in Message.unmarshal_datagram(data, ip):
 
-                #logging.debug(f"Broadcast message received: {msg.opcode}")
+                    #logging.debug(f"Broadcast message received: {msg.opcode}")
 
-                callback(msg, ip, cp, election, app_state)
+                    callback(msg, ip, cp, election, app_state)
     except KeyboardInterrupt:
         listen_socket.close()
         exit(0)
 
 
 def unicast_target(callback, lport: int, cp: ControlPlane, election: Election, app_state: ApplicationState):
-    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    listen_socket.bind((INTERFACE.ip.compressed, lport))
-          
+    listen_socket = unicast_socket(lport)
+    receiver = BatchReceiver(listen_socket, RECEIVE_BATCH)
+
     try:
         while True:
-            data, (ip, port) = listen_socket.recvfrom(2048)
-            if data:
+            for data, ip in receiver.receive():
                 #print(data)
-                msg = Message.unmarshal(data)
-                #logging.debug(f"Unicast message received: {msg.opcode}")
-                callback(msg, ip, cp, election, app_state)
+                for msg in Message.unmarshal_datagram(data, ip):
+                    #logging.debug(f"Unicast message received: {msg.opcode}")
+                    callback(msg, ip, cp, election, app_state)
     except KeyboardInterrupt:
         listen_socket.close()
         exit(0)
 
-def heartbeat_ack_handler(message: Message, ip: str, cp: ControlPlane, election: Election):
+def heartbeat_ack_handler(message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState):
     local_socket = f'{cp.node.ip}:{cp.node.port}'
     received_socket = f'{ip}:{message.port}'
     cp.register_heartbeat(local_socket)
+    # Acknowledgements are broadcast and carry the heartbeat they answer, only ours tell our round trip time
+    heartbeat = message.data['slackish']
+    if heartbeat.get('origin') == local_socket and 'at' in heartbeat:
+        HEARTBEAT_RTT.observe(time.monotonic() - heartbeat['at'], received_socket)
     if local_socket in message.data['updated']:
         logging.info(f"ACK {message.data['updated'][local_socket]} received from {ip}:{message.port}")
 
-def heartbeat_neg_ack_handler(message: Message, ip: str, cp: ControlPlane, election: Election):
+def heartbeat_neg_ack_handler(message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState):
     local_socket = f'{cp.node.ip}:{cp.node.port}'
     received_socket = f'{ip}:{message.port}'
     cp.register_heartbeat(local_socket)
     logging.info(f"NEG_ACK {message.data['slackish']['sent'][local_socket]} received from {ip}:{message.port} please send hb {message.data['updated'][local_socket]}")
 
-holdback_queue = []
-delivery_queue = []
-def heartbeat_handler(message: Message, ip: str, cp: ControlPlane, election: Election):
+def heartbeat_handler(message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState):
     local_socket = f'{cp.node.ip}:{cp.node.port}'
     received_socket = f'{ip}:{message.port}'
 
+    if phi_detector is not None:
+        phi_detector.heartbeat(received_socket)
+
+    leader = cp.current_leader
+    if 'seq' in message.data and leader is not None and (leader.ip, leader.port) == (ip, message.port):
+        announced(None, message.data['seq'], ip, message.port, cp, app_state)
+    # Rooms are announced by the node that claimed them, which our membership view may not know as the owner yet
+    for room, seq in message.data.get('rooms', {}).items():
+        owner = cp.room_owner(room)
+        room_state = app_state.find_room(room)
+        if (owner is not None and (owner.ip, owner.port) == (ip, message.port)) or (
+            room_state is not None and room_state.owner == received_socket
+        ):
+            announced(room, seq, ip, message.port, cp, app_state)
+
     #just in case the connection slacks
     if received_socket in message.data['received']:
-        if received_socket in cp._node_heartbeats_received:
-            if message.data['received'][received_socket] > cp._node_heartbeats_received[received_socket]:
-                cp._node_heartbeats_received[received_socket] = message.data['received'][received_socket]
-            else:
-                pass
-        else:
-            cp._node_heartbeats_received[received_socket] = message.data['received'][received_socket]
+        cp.update_heartbeats_received(received_socket, message.data['received'][received_socket])
 
     logging.debug(f"data received {message.data['received']}")
-    logging.debug(f"data stored {cp._node_heartbeats_received}")
+    logging.debug(f"data stored {cp.heartbeats_received}")
 
     transport = {
             'slackish': message.data, 
-            'updated': cp._node_heartbeats_received
+            'updated': cp.heartbeats_received
     }
 
     if local_socket in message.data['received']:
-        Sp = cp._node_heartbeats_sent[local_socket]
-        Rq = message.data['received'][local_socket]
-        logging.debug(f"{local_socket}: Sp = {Sp} Rq = {Rq}")
-        if (Sp == Rq+1):
-            delivery_queue.append(message)
-            Rq = Rq+1
-            logging.debug(f"delivery_queue {delivery_queue[0].data}")
-            if (holdback_queue):
-                for message in holdback_queue:
-                    if (message.data == Rq+1):
-                        delivery_queue.append(message)
-                        Rq = Rq+1
-                        holdback_queue.remove(message)
-        if (Sp > Rq+1):
-            holdback_queue.append(message)
-            logging.debug(f"holdback_queue {holdback_queue[0].data}")
-        if Sp <= Rq:
-            pass
-        for message in delivery_queue:
-            logging.debug(f"delivery_queue ready for sending {delivery_queue[0].data}")
-            delivery_queue.remove(message)
-            cp.register_heartbeat(received_socket)
-        if cp._node_heartbeats_received[received_socket] == message.data['received'][received_socket]:
+        # Heartbeats are only about liveness, a late one is as good as any other. Messages that have to
+        # arrive go through the reliable layer instead.
+        cp.register_heartbeat(received_socket)
+
+        if cp.heartbeats_received.get(received_socket) == message.data['received'][received_socket]:
             Message(opcode=OpCode.HEARTBEAT_ACK, port=cp.node.port, data=transport).broadcast(2)
-            logging.info(f"ACK for {cp._node_heartbeats_received[received_socket]} sent to {ip}:{message.port}")
+            logging.info(f"ACK for {cp.heartbeats_received[received_socket]} sent to {ip}:{message.port}")
             
         if received_socket in message.data['received']:
-            if received_socket in cp._node_heartbeats_received:
-                if cp._node_heartbeats_received[received_socket] > message.data['received'][received_socket]:
-                    cp.register_heartbeat(received_socket)
+            if received_socket in cp.heartbeats_received:
+                if cp.heartbeats_received[received_socket] > message.data['received'][received_socket]:
                     Message(opcode=OpCode.HEARTBEAT_NEG_ACK, port=cp.node.port, data=transport).broadcast(2)
                     logging.info(f"NEG_ACK for {message.data['received'][received_socket]} sent to {ip}:{message.port}")
 
 
-def heartbeat_target(callback, delay: int, cp: ControlPlane, election: Election, app_state: ApplicationState):
+# Start an election if the lost node was the leader and we have the highest uuid of the remaining nodes
+def handle_lost_node(cp: ControlPlane, socket: str, node: Node | None):
+    logging.info(f"Lost connection to node: {socket}")
+
+    if (
+        node is not None
+        and node.leader is True
+        and len(cp.heartbeats) > 1
+        and cp.node.uuid
+        == max(cp.nodes, key=lambda node: node.uuid).uuid
+    ):
+        start_election(cp)
+
+
+def start_election(cp: ControlPlane):
+    if bully is not None:
+        bully.initiate_election()
+    else:
+        Election(cp).initiate_election()
+
+
+def configure_bully(timeout: float, cp: ControlPlane):
+    global bully
+    bully = BullyElection(cp, timeout)
+    elections.stats.algorithm = "bully"
+
+
+def configure_phi(threshold: float, interval: float):
+    global phi_detector
+    phi_detector = PhiAccrualDetector(threshold, interval)
+
+
+def configure_swim(period: float, indirect: int, suspicion_multiplier: int, cp: ControlPlane):
+    global failure_detector
+    failure_detector = Swim(
+        cp, period, lambda socket: handle_lost_node(cp, socket, cp.remove_member(socket)), indirect, suspicion_multiplier
+    )
+
+
+# Drop nodes whose heartbeats stopped, start an election if the leader was among them and announce ourselves.
+# With SWIM, a tick probes one member instead.
+def heartbeat_tick(cp: ControlPlane, app_state: ApplicationState):
+    if failure_detector is not None:
+        failure_detector.tick()
+        return
+
+    # Suspected peers are dropped as soon as they miss the heartbeats they usually send
+    if phi_detector is not None:
+        for socket in phi_detector.suspects():
+            phi_detector.remove(socket)
+            handle_lost_node(cp, socket, cp.remove_member(socket))
+
+    for socket, node in cp.expire_nodes(time.monotonic() - 10):
+        if phi_detector is not None:
+            phi_detector.remove(socket)
+        handle_lost_node(cp, socket, node)
+
+    transport = {
+            'sent': cp.heartbeats_sent, 
+            'received': cp.heartbeats_received,
+            'origin': f"{cp.node.ip}:{cp.node.port}",
+            'at': time.monotonic(),
+    }
+    # Lets the followers tell how current their state is when they answer reads
+    if cp.node.leader:
+        transport['seq'] = app_state.seq
+    with app_state.lock:
+        rooms = {room: state.seq for room, state in app_state.rooms.items() if state.seq > 0 and owns_room(cp, state)}
+    if rooms:
+        transport['rooms'] = announced_rooms(rooms)
+    if rooms.keys() != led_rooms:
+        logging.info(f"Leading rooms {sorted(rooms)}")
+        led_rooms.clear()
+        led_rooms.update(rooms)
+
+    Message(opcode=OpCode.HEARTBEAT, data=transport, port=cp.node.port).broadcast(2)
+    cp.register_heartbeat(f"{cp.node.ip}:{cp.node.port}")
+    cp.count_heartbeats_sent(f"{cp.node.ip}:{cp.node.port}")
+
+
+# Heartbeats are single datagrams, so they announce the rooms in turns of up to ANNOUNCED_ROOMS_SIZE
+# bytes of room names. Every room is still announced every few heartbeats.
+def announced_rooms(rooms: dict[str, int]) -> dict[str, int]:
+    global announced_offset
+    names = sorted(rooms)
+    start = announced_offset % len(names)
+    announced = {}
+    size = 0
+    for room in names[start:] + names[:start]:
+        size += len(room) + ROOM_ANNOUNCEMENT_OVERHEAD
+        if announced and size > ANNOUNCED_ROOMS_SIZE:
+            break
+        announced[room] = rooms[room]
+    announced_offset = start + len(announced)
+    return announced
+
+
+def collect_state_size(app_state: ApplicationState):
+    with app_state.lock:
+        rooms = [app_state, *app_state.rooms.values()]
+        questions = sum(len(room.questions) for room in rooms)
+        votes = sum(question.vote_count for room in rooms for question in room.questions)
+    STATE_QUESTIONS.set(questions)
+    STATE_VOTES.set(votes)
+    STATE_ROOMS.set(len(rooms) - 1)
+
+
+# Runs one heartbeat interval after the tick
+def leadership_check(cp: ControlPlane):
+    if len(cp.heartbeats) == 1 and cp.node.leader == False:
+        logging.info("Taking leadership since I am the only node left")
+        # The bully election declares the node leader of a new term right away, as no node has a higher uuid
+        if bully is not None:
+            bully.initiate_election()
+            return
+        cp.make_leader(cp.node)
+        Message(opcode=OpCode.ELECTION_RESULT, port=cp.node.port).broadcast()
+
+
+def heartbeat_target(callback, delay: float, cp: ControlPlane, election: Election, app_state: ApplicationState):
     try:
         while True:
-            new_hb_dict = cp._node_heartbeats.copy()
-            for socket, hb in cp._node_heartbeats.items():
-                node = cp.get_node_from_socket(socket)
-
-                if hb + 10 < int(time.time()):
-                    cp.remove_node(node)
-                    logging.info(f"Lost connection to node: {node.ip}:{node.port}")
-                    new_hb_dict.pop(socket)
-                    cp._node_heartbeats = new_hb_dict
-
-                    if (
-                        node.leader is True
-                        and len(cp._node_heartbeats) > 1
-                        and cp.node.uuid
-                        == max(cp.nodes, key=lambda node: node.uuid).uuid
-                    ):
-                        e = Election(cp)
-                        e.initiate_election()
-
-            transport = {
-                    'sent': cp._node_heartbeats_sent, 
-                    'received': cp._node_heartbeats_received
-            }
-
-            Message(opcode=OpCode.HEARTBEAT, data=transport, port=cp.node.port).broadcast(2)
-            cp.register_heartbeat(f"{cp.node.ip}:{cp.node.port}")
-            cp.count_heartbeats_sent(f"{cp.node.ip}:{cp.node.port}")
-
+            heartbeat_tick(cp, app_state)
             time.sleep(delay)
-
-            if len(cp._node_heartbeats) == 1 and cp.node.leader == False:
-                logging.info("Taking leadership since I am the only node left")
-                cp.make_leader(cp.node)
-                Message(opcode=OpCode.ELECTION_RESULT, port=cp.node.port).broadcast()
+            leadership_check(cp)
 
     except KeyboardInterrupt:
         exit(0)
@@ -254,54 +761,132 @@ def hello_server_handler(message, ip, cp, election, app_state):
     application_state: ApplicationState = app_state
 
     if cp.current_leader == None or cp.node.leader == True:
-        Message(opcode=OpCode.HELLO_REPLY, port=cp.node.port, data=json.dumps(application_state, cls=CustomEncoder)).send(ip, message.port)
+        transfer.send(Message(opcode=OpCode.HELLO_REPLY, port=cp.node.port, data=json.dumps(application_state, cls=CustomEncoder)), ip, message.port)
+
+def room_freshness(room: str | None) -> Freshness:
+    state = freshness.get(room)
+    if state is None:
+        state = freshness.setdefault(room, Freshness())
+    return state
+
+
+# The leader of a room announced its sequence number. Missing operations are requested right away, so a
+# follower that missed the last operations before a quiet period does not stay behind until the next one.
+def announced(room: str | None, seq: int, ip: str, port: int, cp: ControlPlane, app_state: ApplicationState):
+    with app_state.lock:
+        # Only rooms with operations are announced, so this creates no rooms that stay empty
+        room_state = app_state.room(room)
+        room_freshness(room).announce(seq, room_state.seq)
+        if seq > room_state.seq:
+            request_sync(ip, port, cp, room_state)
+
+
+# Any server answers reads from its own state along with its sequence number and how old the state may be.
+# Bounded reads are refused if the state is older than the client allows or misses operations the client
+# has already seen. Lease reads are only answered by the leader while a majority confirmed it within the lease.
+def read_request_handler(message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState):
+    request = message.data
+    room = request.get("room")
+    # A room nobody posted to reads as empty, without creating it
+    room_state = app_state.find_room(room)
+    seq = 0 if room_state is None else room_state.seq
+    leads = leads_room(cp, room)
+    # The owner of a room only knows its state is current once it claimed the room
+    claimed = leads and (room_state is None or owns_room(cp, room_state))
+    if claimed:
+        staleness = leader_staleness(cp)
+    elif room in freshness:
+        staleness = freshness[room].staleness(seq)
+    else:
+        staleness = float("inf")
+
+    reply = {"id": request["id"], "seq": seq, "staleness": staleness if staleness != float("inf") else None}
+    leader = room_leader(cp, room)
+    if request.get("consistency") == "lease" and not leads:
+        reply["status"] = READ_NOT_LEADER
+        reply["leader"] = None if leader is None else [leader.ip, leader.port]
+    elif request.get("consistency") == "lease" and (not claimed or staleness > READ_LEASE):
+        reply["status"] = READ_STALE
+    elif seq < request.get("min_seq", 0) or staleness > request.get("max_staleness", float("inf")):
+        reply["status"] = READ_STALE
+    else:
+        reply["status"] = READ_OK
+        reply["questions"] = [] if room_state is None else read_page(room_state, request.get("offset", 0), request.get("limit"))
+
+    transfer.send(Message(opcode=OpCode.READ_REPLY, port=cp.node.port, data=reply), ip, message.port)
+
+
+def ping_handler(message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState):
+    if failure_detector is not None:
+        failure_detector.ping_handler(message, ip)
+
+
+def ping_req_handler(message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState):
+    if failure_detector is not None:
+        failure_detector.ping_req_handler(message, ip)
+
+
+def ping_ack_handler(message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState):
+    if failure_detector is not None:
+        failure_detector.ping_ack_handler(message, ip)
+
+
+def state_chunk_handler(message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState):
+    transfer.chunk_handler(message, ip, cp.node.port, lambda msg: handle(msg, ip, cp, election, app_state))
+
+
+def state_chunk_request_handler(message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState):
+    transfer.chunk_request_handler(message, ip, cp.node.port)
+
 
 def message_handler(message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState):
     if ip == cp.node.ip and message.port == cp.node.port:
         return
 
-    if message.opcode is not OpCode.HEARTBEAT:
+    # Unwrapped on the receiving thread, so the messages stay in order on their way to the lanes
+    if message.opcode is OpCode.RELIABLE_DATA and reliable is not None:
+        for delivered in reliable.receive(message, ip):
+            message_handler(delivered, ip, cp, election, app_state)
+        return
+    if message.opcode is OpCode.RELIABLE_ACK and reliable is not None:
+        reliable.ack(message, ip)
+        return
+
+    if message.opcode in ELECTION_OPCODES:
+        elections.stats.message(message.opcode)
+
+    if message.opcode not in QUIET_OPCODES:
         logging.info(
             f"Received message of type {message.opcode.value} from {ip}:{message.port}"
         )
 
-    if message.opcode is OpCode.HELLO:
-        hello_handler(message, ip, cp, election, app_state)
-    elif message.opcode is OpCode.HELLO_SERVER:
-        hello_server_handler(message, ip, cp, election, app_state)
-    elif message.opcode is OpCode.HELLO_REPLY:
-        hello_reply_handler(message, ip, cp, election)
-    elif message.opcode is OpCode.HEARTBEAT:
-        heartbeat_handler(message, ip, cp, election)
-    elif message.opcode is OpCode.HEARTBEAT_ACK:
-        heartbeat_ack_handler(message, ip, cp, election)
-    elif message.opcode is OpCode.HEARTBEAT_NEG_ACK:
-        heartbeat_neg_ack_handler(message, ip, cp, election)
-    elif (
-        message.opcode is OpCode.ELECTION_VOTE
-        or message.opcode is OpCode.ELECTION_REPLY
-    ):
-        election_handler(message, ip, cp, election)
-    elif message.opcode is OpCode.ELECTION_RESULT:
-        election_result_handler(message, ip, cp, election)
-    elif message.opcode is OpCode.QUESTION_REQUEST:
-        question_request_handler(message, ip, cp, election, app_state)
-    elif message.opcode is OpCode.VOTE_REQUEST:
-        vote_request_handler(message, ip, cp, election, app_state)
-    elif message.opcode is OpCode.VOTE:
-        vote_handler(message, ip, cp, election, app_state)
-    elif message.opcode is OpCode.QUESTION:
-        question_handler(message, ip, cp, election, app_state)
-    elif message.opcode is OpCode.APPLICATION_STATE:
-        application_state_handler(message, ip, cp, election, app_state)
+    if dispatcher is None:
+        handle(message, ip, cp, election, app_state)
     else:
-        return
+        dispatcher.submit(message, ip, lambda: handle(message, ip, cp, election, app_state))
+
+
+# Runs the handler of a message right away on the calling thread
+def handle(message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState):
+    handler = HANDLERS.get(message.opcode)
+    if handler is not None:
+        started = time.perf_counter()
+        if message.opcode in STATE_OPCODES:
+            with app_state.lock:
+                handler(message, ip, cp, election, app_state)
+        else:
+            handler(message, ip, cp, election, app_state)
+        HANDLER_LATENCY.observe(time.perf_counter() - started, message.opcode.value)
 
 
-def election_handler(message: Message, ip: str, cp: ControlPlane, election: Election):
-    sender_socket = f"{ip}:{message.port}"
-    next_neighbour = cp.get_next_neighbour(cp.get_node_from_socket(sender_socket))
-    previous_neighbour = cp.get_node_from_socket(f"{ip}:{message.port}")
+def election_handler(message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState):
+    elections.stats.start()
+    if bully is not None:
+        if message.opcode is OpCode.ELECTION_VOTE:
+            bully.vote_handler(message, ip)
+        else:
+            bully.reply_handler(message, ip)
+        return
 
     msg = json.loads(message.data)
 
@@ -317,7 +902,14 @@ def election_handler(message: Message, ip: str, cp: ControlPlane, election: Elec
     print(f"Current vote: {vote.__dict__}")
 
     if vote.hop == 1 and vote.phase == 0:
-        time.sleep(1)
+        defer(ELECTION_DELAY, lambda: process_election_data(vote, ip, message.port, cp, election))
+    else:
+        process_election_data(vote, ip, message.port, cp, election)
+
+
+def process_election_data(vote: ElectionData, ip: str, port: int, cp: ControlPlane, election: Election):
+    next_neighbour = cp.get_next_neighbour(cp.get_node_from_socket(f"{ip}:{port}"))
+    previous_neighbour = cp.get_node_from_socket(f"{ip}:{port}")
 
     # Handle reply
     if vote.hop is None:
@@ -373,6 +965,7 @@ def election_handler(message: Message, ip: str, cp: ControlPlane, election: Elec
                 cp.make_leader(
                     cp.get_node_from_socket(f"{vote.leader_ip}:{vote.leader_port}")
                 )
+                elections.stats.finish()
                 Message(
                     opcode=OpCode.ELECTION_RESULT, port=vote.leader_port
                 ).broadcast()
@@ -381,7 +974,7 @@ def election_handler(message: Message, ip: str, cp: ControlPlane, election: Elec
 
 
 def hello_reply_handler(
-    message: Message, ip: str, cp: ControlPlane, election: Election
+    message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState
 ):
     logging.info(f"Received node state: {message.data}")
 
@@ -392,20 +985,26 @@ def hello_reply_handler(
 
     new_nodes = []
 
-    for node in message.data:
+    # With the bully election the reply also carries the current term, so our election does not run in a term that is long over
+    nodes = message.data
+    if isinstance(message.data, dict):
+        nodes = message.data["nodes"]
+        if bully is not None:
+            bully.adopt(message.data["term"])
+
+    for node in nodes:
         if cp.node.ip != node["ip"] or cp.node.port != int(node["port"]):
             new_nodes.append(Node(node["ip"], node["port"], node["leader"], node["uuid"]))
     
     for node in new_nodes:
         cp.register_heartbeat(f"{node.ip}:{node.port}")
 
-    cp.nodes.update(set(new_nodes))
+    cp.register_nodes(set(new_nodes))
 
     # If the election below gets dropped due to me not having the highest port, we don't have a leader if it was not declared previously
     cp.current_leader = cp.get_node_from_socket(f"{ip}:{message.port}")
 
-    e = Election(cp)
-    e.initiate_election()
+    start_election(cp)
 
 
 def hello_handler(message: Message, ip: str, cp: ControlPlane, election: Election, app_state: ApplicationState):
@@ -421,18 +1020,75 @@ def hello_handler(message: Message, ip: str, cp: ControlPlane, election: Electio
 
     print(f"After removing: {cp.nodes}")
     cp.register_node(node)
+    cp.register_heartbeat(f"{ip}:{message.port}")
 
     print(f"After removing and adding: {cp.nodes}")
     if cp.current_leader == None or cp.node.leader == True:
-        Message(
+        nodes = list(map(lambda node: node.__dict__, cp.nodes))
+        transfer.send(Message(
             opcode=OpCode.HELLO_REPLY,
             port=cp.node.port,
-            data=list(map(lambda node: node.__dict__, cp.nodes)),
-        ).send(ip, message.port)
-        Message (
-            opcode = OpCode.APPLICATION_STATE,
-            port=cp.node.port,
-            data=json.dumps(app_state, cls=CustomEncoder)
-        ).send(ip, message.port)
+            data=nodes if bully is None else {"nodes": nodes, "term": bully.concluded},
+        ), ip, message.port)
+
+        # A node that rejoins after a short interruption only needs the operations it missed. The operations
+        # only cover the default room, with other rooms the node may take over it needs the whole state.
+        operations = None if msg.get("seq") is None or app_state.rooms else app_state.operations.since(msg["seq"])
+        if operations is not None:
+            transfer.send(Message(opcode=OpCode.OPERATION_LOG, port=cp.node.port, data=operations), ip, message.port)
+        else:
+            transfer.send(Message (
+                opcode = OpCode.APPLICATION_STATE,
+                port=cp.node.port,
+                data=json.dumps(app_state, cls=CustomEncoder)
+            ), ip, message.port)
         
         
+
+
+# Handlers that assign, apply or send sequenced operations. They hold the lock of the state, so the
+# operations of a room are sequenced, logged and broadcast in the same order no matter which thread
+# runs them, e.g. the timer that flushes a vote batch or the receiving threads without a dispatcher.
+# Handlers on the other lanes that serialize or page through the state hold it as well.
+STATE_OPCODES = {
+    OpCode.ROOM_CLAIM,
+    OpCode.HELLO,
+    OpCode.HELLO_SERVER,
+    OpCode.READ_REQUEST,
+    OpCode.QUESTION_REQUEST,
+    OpCode.VOTE_REQUEST,
+    OpCode.QUESTION,
+    OpCode.VOTE,
+    OpCode.VOTE_BATCH,
+    OpCode.APPLICATION_STATE,
+    OpCode.SYNC_REQUEST,
+    OpCode.OPERATION_LOG,
+}
+
+HANDLERS = {
+    OpCode.HELLO: hello_handler,
+    OpCode.HELLO_SERVER: hello_server_handler,
+    OpCode.READ_REQUEST: read_request_handler,
+    OpCode.HELLO_REPLY: hello_reply_handler,
+    OpCode.HEARTBEAT: heartbeat_handler,
+    OpCode.HEARTBEAT_ACK: heartbeat_ack_handler,
+    OpCode.HEARTBEAT_NEG_ACK: heartbeat_neg_ack_handler,
+    OpCode.ELECTION_VOTE: election_handler,
+    OpCode.ELECTION_REPLY: election_handler,
+    OpCode.ELECTION_RESULT: election_result_handler,
+    OpCode.QUESTION_REQUEST: question_request_handler,
+    OpCode.VOTE_REQUEST: vote_request_handler,
+    OpCode.VOTE: vote_handler,
+    OpCode.VOTE_BATCH: vote_batch_handler,
+    OpCode.QUESTION: question_handler,
+    OpCode.APPLICATION_STATE: application_state_handler,
+    OpCode.SYNC_REQUEST: sync_request_handler,
+    OpCode.OPERATION_LOG: operation_log_handler,
+    OpCode.STATE_CHUNK: state_chunk_handler,
+    OpCode.STATE_CHUNK_REQUEST: state_chunk_request_handler,
+    OpCode.PING: ping_handler,
+    OpCode.PING_REQ: ping_req_handler,
+    OpCode.PING_ACK: ping_ack_handler,
+    OpCode.ROOM_CLAIM: room_claim_handler,
+    OpCode.ROOM_CLAIM_REPLY: room_claim_reply_handler,
+}
@@ -1,4 +1,7 @@
+from threading import RLock
 from uuid import uuid4
+from operation_log import OperationLog
+from ranking import Ranking
 
 class Vote:
     socket: str
@@ -11,43 +14,115 @@ class Vote:
 class Question:
     uuid: str
     text: str
-    votes: list[Vote]
+    votes: dict[str, Vote]
+    room: str | None
 
-    def __init__(self, text, votes=None, uuid=None):
+    def __init__(self, text, votes=None, uuid=None, room=None):
         self.text = text
-        # Maybe initialize with own socket since we are automatically voting for ourselves
-        self.votes = [] if votes==None else votes
+        # Questions without a room belong to the default room
+        self.room = room
+        # Votes are indexed by the socket of the voter, which makes lookups, toggles and counting O(1)
+        self.votes = {}
+        for vote in [] if votes==None else votes:
+            if isinstance(vote, dict):
+                vote = Vote(**vote)
+            self.votes[vote.socket] = vote
         self.uuid = str(uuid4()) if uuid==None else uuid
 
-    # Add vote to votes list
+    # Add vote to votes or remove it if the client already voted
     def toggle_vote(self, vote: Vote):
         if self.not_voted_for(vote):
-            self.votes.append(vote)
-        else: 
-            for v in self.votes:
-                if v.socket == vote.socket:
-                    self.votes.remove(v)
+            self.votes[vote.socket] = vote
+        else:
+            del self.votes[vote.socket]
 
     # Verify that one client can only vote once per question
     def not_voted_for(self, vote: Vote):
-        for v in self.votes:
-            if v.socket == vote.socket:
-                return False
-        return True 
+        return vote.socket not in self.votes
+
+    @property
+    def vote_count(self) -> int:
+        return len(self.votes)
+
+    # Votes are still transferred as a list to stay compatible with the existing wire format
+    def to_dict(self):
+        question = {"text": self.text, "votes": [vote.__dict__ for vote in self.votes.values()], "uuid": self.uuid}
+        if self.room is not None:
+            question["room"] = self.room
+        return question
 
 
 class ApplicationState:
-    def __init__(self, questions: list[Question] = []):
-        self.questions: list[Question] = questions
-    
+    def __init__(self, questions: list[Question] | None = None, seq: int = 0, room: str | None = None, rooms=None, epoch: int = 0, owner: str | None = None):
+        self.ranking = Ranking()
+        self.questions = [] if questions==None else questions
+        # Sequence number of the last operation assigned by the leader that is contained in this state
+        self.seq = seq
+        self.operations = OperationLog(seq=seq)
+        # Durable storage of the operations, if the server runs with a data directory
+        self.storage = None
+        # Taken by everything that assigns or applies sequence numbers, the lock of the default room
+        # guards the other rooms as well
+        self.lock = RLock()
+        # This state is the default room, every other room has its own state with its own sequence numbers
+        self.room_id = room
+        self.rooms: dict[str, ApplicationState] = {} if rooms is None else rooms
+        # Rooms other than the default room are sequenced by their owner, which took the room over in this epoch
+        self.epoch = epoch
+        self.owner = owner
+
+    # State of a room, created on first use
+    def room(self, room: str | None) -> "ApplicationState":
+        if room is None or room == self.room_id:
+            return self
+        state = self.rooms.get(room)
+        if state is None:
+            state = self.rooms.setdefault(room, ApplicationState(room=room))
+        return state
+
+    # State of a room, without creating rooms nobody posted a question to
+    def find_room(self, room: str | None) -> "ApplicationState | None":
+        if room is None or room == self.room_id:
+            return self
+        return self.rooms.get(room)
+
+    @property
+    def questions(self) -> list[Question]:
+        return self._questions
+
+    # Replacing the questions (e.g. after receiving the state of the leader) rebuilds the index
+    @questions.setter
+    def questions(self, questions: list[Question]):
+        self._questions: list[Question] = list(questions)
+        self._questions_by_uuid: dict[str, Question] = {question.uuid: question for question in self._questions}
+        self.ranking.rebuild(self._questions)
+
     def get_question_from_uuid(self, uuid: str) -> Question | None:
-        for question in self.questions:
-            if question.uuid == uuid:
-                return question
-        return None
+        return self._questions_by_uuid.get(uuid)
 
     def add_question(self, question: Question):
-        self.questions.append(question)
+        # Receiving the same question twice must not create a duplicate
+        if question.uuid in self._questions_by_uuid:
+            return
+        self._questions.append(question)
+        self._questions_by_uuid[question.uuid] = question
+        self.ranking.add(question)
+
+    def toggle_vote(self, question: Question, vote: Vote):
+        question.toggle_vote(vote)
+        self.ranking.update(question)
+
+    # Rooms are only part of the state if there are any, so the default room keeps its old format
+    def to_dict(self):
+        state = {"questions": self._questions, "seq": self.seq}
+        if self.room_id is not None:
+            state["room"] = self.room_id
+        if self.owner is not None:
+            state["epoch"] = self.epoch
+            state["owner"] = self.owner
+        if self.rooms:
+            state["rooms"] = self.rooms
+        return state
 
     def get_application_state(self):
-        return self.__dict__
\ No newline at end of file
+        return self.to_dict()
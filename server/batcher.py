@@ -0,0 +1,89 @@
+import logging
+import threading
+import time
+from threading import Lock
+import metrics
+
+BATCH_SIZE = metrics.histogram(
+    "qhub_vote_batch_size", "Votes per VOTE_BATCH broadcast", (1, 2, 5, 10, 20, 50, 100, 200)
+)
+BATCH_DELAY = metrics.histogram(
+    "qhub_vote_batch_delay_seconds", "Time from the first vote of a batch until it is flushed", (0.001, 0.005, 0.01, 0.02, 0.05, 0.1)
+)
+BATCH_FLUSHES = metrics.counter("qhub_vote_batch_flushes_total", "Flushed vote batches by trigger", ("reason",))
+BATCH_CANCELLED = metrics.counter(
+    "qhub_vote_batch_cancelled_total", "Votes dropped from a batch because the same voter toggled the same question again"
+)
+
+
+def start_timer(delay: float, callback):
+    timer = threading.Timer(delay, callback)
+    timer.daemon = True
+    timer.start()
+
+
+# Collects the votes the leader receives for up to `window` seconds or `max_size` votes and hands them
+# to `flush` as one batch. A larger window means fewer and larger broadcasts at the cost of vote latency.
+# `lock` is held while a batch is flushed, passing the lock of the state the votes are sequenced in
+# keeps a flush from the timer from interleaving with operations sequenced by the handlers.
+class VoteBatcher:
+    def __init__(self, window: float, max_size: int, flush, schedule=start_timer, lock=None):
+        self.window = window
+        self.max_size = max_size
+        self.flush_callback = flush
+        # Runs a callback after a delay, the asyncio runtime replaces the thread based timer
+        self.schedule = schedule
+        self._pending: dict[tuple[str, str], dict] = {}
+        # Votes that cancelled each other out, the clients still wait for them to be acknowledged
+        self._cancelled: list[dict] = []
+        self._opened: float | None = None
+        self._generation = 0
+        self._lock = Lock()
+        self._flush_lock = Lock() if lock is None else lock
+
+    def add(self, vote: dict):
+        with self._lock:
+            key = (vote["socket"], vote["question_uuid"])
+            if key in self._pending:
+                # Two toggles of the same vote cancel each other out
+                self._cancelled += [self._pending.pop(key), vote]
+                BATCH_CANCELLED.inc()
+            else:
+                self._pending[key] = vote
+
+            if self._opened is None:
+                self._opened = time.monotonic()
+                generation = self._generation
+                self.schedule(self.window, lambda: self._flush_window(generation))
+
+            full = len(self._pending) >= self.max_size
+
+        if full:
+            self.flush("size")
+
+    def _flush_window(self, generation: int):
+        # The batch this timer was started for might already have been flushed because it was full
+        if generation == self._generation:
+            self.flush("window")
+
+    def flush(self, reason: str):
+        # Batches are applied one after another, so sequence numbers are assigned in broadcast order
+        with self._flush_lock:
+            with self._lock:
+                votes = list(self._pending.values())
+                cancelled = self._cancelled
+                opened = self._opened
+                self._pending = {}
+                self._cancelled = []
+                self._opened = None
+                self._generation += 1
+
+            if not votes and not cancelled:
+                return
+
+            BATCH_SIZE.observe(len(votes))
+            BATCH_DELAY.observe(time.monotonic() - opened)
+            BATCH_FLUSHES.inc(reason)
+            logging.debug(f"Flushing {len(votes)} votes ({reason})")
+
+            self.flush_callback(votes, cancelled)
@@ -0,0 +1,160 @@
+import json
+import logging
+from threading import Lock
+from control_plane import ControlPlane
+from network import Message, OpCode
+from node import Node
+from batcher import start_timer
+import election
+
+
+# Bully election on the node uuids with terms. The node with the highest uuid among the members it
+# knows declares itself leader right away. Every other node asks the nodes with higher uuids one at a
+# time, highest first, and only moves on to the next one if a node does not answer within `timeout`.
+# Usually the first node asked wins, so an election takes one ELECTION_VOTE, one ELECTION_REPLY and
+# one ELECTION_RESULT broadcast instead of O(N log N) ring messages.
+#
+# Every election runs in a term that is higher than every term the node has seen. Results of older
+# terms are ignored and a node runs at most one election per term, so elections that were started
+# concurrently by several nodes collapse into one. Joining nodes adopt the term of the cluster, and a
+# node that still declares itself leader for an old term is told the current one and steps down.
+class BullyElection:
+    def __init__(self, cp: ControlPlane, timeout: float = 0.5, schedule=start_timer):
+        self.cp = cp
+        self.timeout = timeout
+        # Runs a callback after a delay, the asyncio runtime replaces the thread based timer
+        self.schedule = schedule
+        # Highest term seen and the highest term a leader is known for
+        self.term = 0
+        self.concluded = 0
+        # Term of the election this node runs and the nodes it still has to ask in it
+        self.running: int | None = None
+        self.candidates: list[Node] = []
+        self.waiting_for: Node | None = None
+        self._lock = Lock()
+
+    # Starts a new term, or joins the term of a node that asked us
+    def initiate_election(self, term: int | None = None):
+        with self._lock:
+            term = self.term + 1 if term is None else max(term, self.term)
+            # The term is over already, the asking node missed the result
+            if term <= self.concluded:
+                term = self.concluded + 1
+            if self.running is not None and self.running >= term:
+                return
+            self.term = self.running = term
+            self.candidates = sorted(
+                (node for node in self.cp.nodes if node.uuid > self.cp.node.uuid), key=lambda node: node.uuid, reverse=True
+            )
+        logging.info(f"Starting election for term {term}")
+        election.stats.start()
+        self._ask_next(term)
+
+    def _ask_next(self, term: int):
+        with self._lock:
+            if self.running != term:
+                return
+            if not self.candidates:
+                self.running = None
+                candidate = None
+            else:
+                candidate = self.waiting_for = self.candidates.pop(0)
+
+        if candidate is None:
+            self._declare(term)
+            return
+
+        Message(
+            opcode=OpCode.ELECTION_VOTE, port=self.cp.node.port, data=json.dumps({"term": term, "uuid": self.cp.node.uuid})
+        ).send(candidate.ip, candidate.port)
+        self.schedule(self.timeout, lambda: self._answer_timeout(term, candidate))
+
+    def _answer_timeout(self, term: int, candidate: Node):
+        with self._lock:
+            if self.running != term or self.waiting_for is not candidate:
+                return
+        logging.info(f"{candidate.ip}:{candidate.port} did not answer in term {term}")
+        self._ask_next(term)
+
+    # A higher node took over, if it does not announce a result in time we start over in a new term
+    def _result_timeout(self, term: int):
+        with self._lock:
+            if self.term != term or self.running != term:
+                return
+            self.running = None
+        self.initiate_election(term + 1)
+
+    def _declare(self, term: int):
+        logging.info(f"Declaring myself leader for term {term}")
+        with self._lock:
+            self.concluded = max(self.concluded, term)
+        self.cp.make_leader(self.cp.node)
+        election.stats.finish()
+        Message(opcode=OpCode.ELECTION_RESULT, port=self.cp.node.port, data={"term": term}).broadcast()
+
+    def vote_handler(self, message: Message, ip: str):
+        msg = json.loads(message.data)
+        Message(
+            opcode=OpCode.ELECTION_REPLY, port=self.cp.node.port, data=json.dumps({"term": msg["term"]})
+        ).send(ip, message.port)
+
+        # The current leader only has to tell the node who is in charge
+        if self.cp.node.leader:
+            with self._lock:
+                self.term = max(self.term, msg["term"])
+                # Announcing the result makes this node the leader of that term
+                term = self.concluded = self.term
+            Message(opcode=OpCode.ELECTION_RESULT, port=self.cp.node.port, data={"term": term}).broadcast()
+            return
+
+        self.initiate_election(msg["term"])
+
+    def reply_handler(self, message: Message, ip: str):
+        term = json.loads(message.data)["term"]
+        with self._lock:
+            if self.running != term or self.waiting_for is None:
+                return
+            if (self.waiting_for.ip, self.waiting_for.port) != (ip, message.port):
+                return
+            self.waiting_for = None
+            # Asking the remaining nodes is up to the node that answered
+            self.candidates = []
+        self.schedule(self.timeout * 4, lambda: self._result_timeout(term))
+
+    # The term a joining node learned from the leader that answered its hello
+    def adopt(self, term: int):
+        with self._lock:
+            self.term = max(self.term, term)
+            self.concluded = max(self.concluded, term)
+
+    # Returns whether the result is current and should be applied. Results without a term come from a
+    # node that took over because it was the only one left.
+    def result_handler(self, message: Message, ip: str) -> bool:
+        term = message.data["term"] if isinstance(message.data, dict) else self.term
+        with self._lock:
+            stale = term < self.term
+            if not stale:
+                self.term = term
+                self.concluded = term
+                self.running = None
+                self.waiting_for = None
+            concluded = self.concluded
+
+        if stale:
+            logging.info(f"Ignoring election result of old term {term} from {ip}:{message.port}")
+            if concluded > term:
+                self._correct(concluded, ip, message.port)
+        return not stale
+
+    # Tells a node that declared itself leader for an old term who leads the current one. The leader
+    # announces itself to everyone again, so clients that followed the old result switch back as well.
+    def _correct(self, term: int, ip: str, port: int):
+        leader = self.cp.current_leader
+        if leader is None:
+            return
+        if self.cp.node.leader:
+            Message(opcode=OpCode.ELECTION_RESULT, port=self.cp.node.port, data={"term": term}).broadcast()
+        else:
+            Message(
+                opcode=OpCode.ELECTION_RESULT, port=self.cp.node.port, data={"term": term, "leader": [leader.ip, leader.port]}
+            ).send(ip, port)
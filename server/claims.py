@@ -0,0 +1,108 @@
+import logging
+from threading import Lock
+from control_plane import ControlPlane
+from network import Message, OpCode
+from batcher import start_timer
+import metrics
+
+CLAIMS = metrics.counter("qhub_room_claims_total", "Claims of rooms this node took over by outcome", ("result",))
+
+
+class Claim:
+    def __init__(self, waiting: set[str]):
+        # Servers that did not answer yet
+        self.waiting = waiting
+        # Highest epoch and sequence number the servers know of the room, and a server that has that sequence number
+        self.epoch = 0
+        self.seq = 0
+        self.source: tuple[str, int] | None = None
+        # Requests that arrived during the claim, handled once it succeeded
+        self.pending: list = []
+
+
+# A node that becomes the owner of a room (because it joined, or the previous owner left) asks every
+# other server for the epoch and sequence number of the room before it sequences any write. It only
+# continues from the highest sequence number any of them has, so it never assigns a sequence number
+# twice, and it takes over in a higher epoch than every previous owner. Operations are stamped with
+# their epoch and owner, so followers reject operations of an owner that was already replaced.
+#
+# Servers that answer a claim stop sequencing the room themselves. Until the membership views agree
+# again, two nodes may keep claiming the same room in turns, but every claim has a higher epoch.
+class RoomClaims:
+    def __init__(self, cp: ControlPlane, timeout: float, claimed, schedule=start_timer):
+        self.cp = cp
+        # Servers that do not answer within the timeout are left out, they most likely failed
+        self.timeout = timeout
+        # Called with the room, the highest epoch and sequence number, the server that has them and the pending
+        # requests. Returns whether the room could be taken over.
+        self.claimed = claimed
+        # Runs a callback after a delay, the asyncio runtime replaces the thread based timer
+        self.schedule = schedule
+        self.claims: dict[str, Claim] = {}
+        self._lock = Lock()
+
+    @property
+    def local_socket(self) -> str:
+        return f"{self.cp.node.ip}:{self.cp.node.port}"
+
+    # Claims the room, or waits for the claim that is already running. `retry` handles the request again once the room is ours.
+    def claim(self, room: str, retry):
+        servers = {f"{node.ip}:{node.port}" for node in self.cp.nodes} - {self.local_socket}
+        with self._lock:
+            claim = self.claims.get(room)
+            if claim is not None:
+                claim.pending.append(retry)
+                return
+            claim = self.claims[room] = Claim(servers)
+            claim.pending.append(retry)
+
+        logging.info(f"Claiming room {room}, asking {len(servers)} servers")
+        for socket in servers:
+            ip, port = socket.rsplit(":", 1)
+            Message(opcode=OpCode.ROOM_CLAIM, port=self.cp.node.port, data={"room": room}).send(ip, int(port))
+
+        if servers:
+            self.schedule(self.timeout, lambda: self._finish(room, claim))
+        else:
+            self._finish(room, claim)
+
+    # Another server claims a room we claim as well, until the membership views agree. The claim of the higher
+    # socket wins, returns whether that is ours. Requests that waited for a claim we give up are dropped.
+    def contests(self, room: str, claimant: str) -> bool:
+        with self._lock:
+            claim = self.claims.get(room)
+            if claim is None:
+                return False
+            if claimant < self.local_socket:
+                return True
+            del self.claims[room]
+        CLAIMS.inc("yielded")
+        logging.info(f"Giving up the claim of room {room} to {claimant}")
+        return False
+
+    def reply_handler(self, message: Message, ip: str):
+        room = message.data["room"]
+        with self._lock:
+            claim = self.claims.get(room)
+            if claim is None:
+                return
+            claim.waiting.discard(f"{ip}:{message.port}")
+            claim.epoch = max(claim.epoch, message.data["epoch"])
+            if message.data["seq"] > claim.seq:
+                claim.seq = message.data["seq"]
+                claim.source = (ip, message.port)
+            done = not claim.waiting
+
+        if done:
+            self._finish(room, claim)
+
+    def _finish(self, room: str, claim: Claim):
+        with self._lock:
+            # Finished by the last reply or the timeout already, or given up
+            if self.claims.get(room) is not claim:
+                return
+            del self.claims[room]
+
+        if claim.waiting:
+            logging.info(f"No claim reply for room {room} from {sorted(claim.waiting)}")
+        CLAIMS.inc("claimed" if self.claimed(room, claim.epoch, claim.seq, claim.source, claim.pending) else "behind")
@@ -1,4 +1,5 @@
 from node import Node
+from membership import Membership, MembershipStore, parse_socket
 import time
 import logging
 
@@ -6,31 +7,49 @@ import logging
 class ControlPlane:
     def __init__(self):
         self._node: Node = None
-        self._nodes: set[Node] = set()
-        self._node_heartbeats = {}
-        self._node_heartbeats_sent = {}
-        self._node_heartbeats_received = {}
+        # Nodes and heartbeats are read and written by several threads at once
+        self._membership = MembershipStore()
         self.current_leader: Node = None
 
     @property
-    def nodes(self):
-        return self._nodes
+    def membership(self) -> Membership:
+        return self._membership.snapshot
+
+    @property
+    def nodes(self) -> frozenset[Node]:
+        return self._membership.snapshot.nodes
+
+    @property
+    def heartbeats(self) -> dict[str, float]:
+        return self._membership.snapshot.heartbeats
+
+    @property
+    def heartbeats_sent(self) -> dict[str, int]:
+        return self._membership.snapshot.sent
+
+    @property
+    def heartbeats_received(self) -> dict[str, int]:
+        return self._membership.snapshot.received
 
     def register_heartbeat(self, socket: str):
-        self._node_heartbeats[socket] = int(time.time())
+        self._membership.register_heartbeat(socket, time.monotonic())
 
     def count_heartbeats_sent(self, socket: str):
-        if socket in self._node_heartbeats:
-            if socket in self._node_heartbeats_sent:
-                self._node_heartbeats_sent[socket] += 1
-                self._node_heartbeats_received[socket] += 1
-            else:
-                self._node_heartbeats_sent[socket] = 1
-                self._node_heartbeats_received[socket] = 1
+        self._membership.count_heartbeat_sent(socket)
+
+    def update_heartbeats_received(self, socket: str, count: int):
+        self._membership.update_received(socket, count)
+
+    # Remove the nodes that did not send a heartbeat since `deadline`
+    def expire_nodes(self, deadline: float) -> list[tuple[str, Node | None]]:
+        return self._membership.expire(deadline)
+
+    def remove_member(self, socket: str) -> Node | None:
+        return self._membership.remove_member(socket)
 
     @nodes.setter
     def nodes(self, new_nodes: set[Node]):
-        self._nodes = new_nodes
+        self._membership.set_nodes(new_nodes)
 
     @property
     def node(self):
@@ -42,24 +61,25 @@ class ControlPlane:
 
     def register_node(self, node: Node):
         logging.info(f"Registering node {node}")
-        self._nodes.add(node)
+        self._membership.add_nodes({node})
+
+    def register_nodes(self, nodes: set[Node]):
+        self._membership.add_nodes(nodes)
 
     def remove_node(self, node: Node):
-        self._nodes.remove(node)
+        self._membership.remove_node(node)
 
     def get_node_from_socket(self, socket: str) -> Node | None:
-        ip, port = socket.split(":")
-        for node in self.nodes:
-            if node.ip == ip and node.port == int(port):
-                return node
-            else:
-                continue
+        return self.membership.index.get(parse_socket(socket))
+
+    def get_node(self, ip: str, port: int) -> Node | None:
+        return self.membership.index.get((ip, port))
 
     def get_leader(self) -> Node | None:
         return self.current_leader
 
-    def get_nodes_sorted(self) -> list[Node]:
-        return sorted(list(self._node_heartbeats))
+    def get_nodes_sorted(self) -> list[str]:
+        return self.membership.ring.sockets
 
     def make_leader(self, node: Node):
         logging.info(f"Node {node.ip}:{node.port} has been appointed the new leader")
@@ -69,51 +89,45 @@ class ControlPlane:
         node.leader = True
         self.current_leader = node
 
+    # Node that leads a room, rooms move to other nodes as nodes join and leave
+    def room_owner(self, room: str) -> Node | None:
+        membership = self.membership
+        socket = membership.rooms.owner(room)
+        return None if socket is None else membership.index.get(parse_socket(socket))
+
+    # Forward an election message around the ring, away from the node that sent it. All lookups use
+    # one snapshot and its cached ring, so this takes constant time regardless of the cluster size.
     def get_next_neighbour(self, sender_node: Node):
-        sender_ring_index = self.get_nodes_sorted().index(
-            f"{sender_node.ip}:{sender_node.port}"
-        )
-
-        if (
-            self.ring_index(self.node) == 0
-            and sender_ring_index != len(self.get_nodes_sorted()) - 1
-        ):
-            return self.get_node_from_socket(
-                self.get_nodes_sorted()[len(self.get_nodes_sorted()) - 1]
-            )
-        elif (
-            self.ring_index(self.node) == len(self.get_nodes_sorted()) - 1
-            and sender_ring_index != 0
-        ):
-            return self.get_node_from_socket(self.get_nodes_sorted()[0])
-        elif (
-            self.ring_index(self.node) == 0
-            and sender_ring_index == len(self.get_nodes_sorted()) - 1
-        ):
-            return self.right_neighbour(self.node)
-        elif (
-            self.ring_index(self.node) == len(self.get_nodes_sorted()) - 1
-            and sender_ring_index == 0
-        ):
-            return self.left_neighbour(self.node)
-        elif sender_ring_index < self.ring_index(self.node):
-            return self.right_neighbour(self.node)
+        membership = self.membership
+        ring = membership.ring
+        sender_ring_index = ring.index(f"{sender_node.ip}:{sender_node.port}")
+        own_ring_index = ring.index(f"{self.node.ip}:{self.node.port}")
+        last = len(ring) - 1
+
+        if own_ring_index == 0 and sender_ring_index != last:
+            neighbour = ring.at(last)
+        elif own_ring_index == last and sender_ring_index != 0:
+            neighbour = ring.at(0)
+        elif own_ring_index == 0 and sender_ring_index == last:
+            neighbour = ring.at(own_ring_index + 1)
+        elif own_ring_index == last and sender_ring_index == 0:
+            neighbour = ring.at(own_ring_index - 1)
+        elif sender_ring_index < own_ring_index:
+            neighbour = ring.at(own_ring_index + 1)
         else:
-            return self.left_neighbour(self.node)
+            neighbour = ring.at(own_ring_index - 1)
+
+        return membership.index.get(parse_socket(neighbour))
 
     def ring_index(self, node: Node):
-        return self.get_nodes_sorted().index(f"{node.ip}:{node.port}")
+        return self.membership.ring.index(f"{node.ip}:{node.port}")
 
     def left_neighbour(self, node: Node):
-        logging.info(f"Nodes: {self.nodes}")
-        left_neighbour = self.get_nodes_sorted()[
-            (self.ring_index(node) - 1) % len(self.nodes)
-        ]
-        return self.get_node_from_socket(left_neighbour)
+        membership = self.membership
+        left_neighbour = membership.ring.at(membership.ring.index(f"{node.ip}:{node.port}") - 1)
+        return membership.index.get(parse_socket(left_neighbour))
 
     def right_neighbour(self, node: Node):
-        logging.info(f"Nodes: {self.nodes}")
-        right_neighbour = self.get_nodes_sorted()[
-            (self.ring_index(node) + 1) % len(self.nodes)
-        ]
-        return self.get_node_from_socket(right_neighbour)
+        membership = self.membership
+        right_neighbour = membership.ring.at(membership.ring.index(f"{node.ip}:{node.port}") + 1)
+        return membership.index.get(parse_socket(right_neighbour))
@@ -0,0 +1,122 @@
+import logging
+import queue
+import time
+from threading import Thread, Lock
+from network import Message, OpCode
+import metrics
+
+QUEUE_DEPTH = metrics.gauge("qhub_dispatch_queue_depth", "Messages waiting for a worker", ("lane",))
+QUEUE_WAIT = metrics.histogram(
+    "qhub_dispatch_queue_wait_seconds", "Time a message waited for a worker", (0.0001, 0.001, 0.01, 0.1, 1, 10), ("lane",)
+)
+DROPPED = metrics.counter("qhub_dispatch_dropped_total", "Messages dropped because their queue was full", ("lane", "opcode"))
+BLOCKED = metrics.counter(
+    "qhub_dispatch_blocked_total", "Times the receiving thread had to wait for space in a full queue", ("lane",)
+)
+
+# What happens to a message when the queue of its lane is full
+BLOCK = "block"  # The receiving thread waits, so the backlog builds up in the socket buffer
+DROP_NEWEST = "drop_newest"
+DROP_OLDEST = "drop_oldest"  # For periodic messages like heartbeats, where only the latest one matters
+
+# name, opcodes, workers, policy
+# Sequenced operations (questions and votes) share one lane and one worker, so they are applied in order.
+# Handlers on other lanes that read the application state take its lock, see `api.STATE_OPCODES`.
+LANES = [
+    (
+        "heartbeat",
+        {OpCode.HEARTBEAT, OpCode.HEARTBEAT_ACK, OpCode.HEARTBEAT_NEG_ACK, OpCode.PING, OpCode.PING_REQ, OpCode.PING_ACK},
+        2,
+        DROP_OLDEST,
+    ),
+    (
+        "control",
+        {
+            OpCode.ELECTION_VOTE, OpCode.ELECTION_REPLY, OpCode.ELECTION_RESULT,
+            OpCode.HELLO, OpCode.HELLO_SERVER, OpCode.HELLO_REPLY,
+        },
+        1,
+        BLOCK,
+    ),
+    # Clients retry reads at another server, so an overloaded server rather drops them than delaying writes
+    ("reads", {OpCode.READ_REQUEST}, 2, DROP_OLDEST),
+    ("operations", None, 1, BLOCK),
+]
+
+
+# A group of workers with one bounded queue each. Messages of the same sender always go to the same
+# worker, so they are handled in the order they were received.
+class Lane:
+    def __init__(self, name: str, workers: int, size: int, policy: str):
+        self.name = name
+        self.policy = policy
+        self.queues: list[queue.Queue] = [queue.Queue(size) for _ in range(workers)]
+        self._lock = Lock()
+
+        for index, q in enumerate(self.queues):
+            Thread(target=self._worker_target, args=(q,), name=f"{name}-{index}", daemon=True).start()
+
+    @property
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+    def submit(self, key: str, opcode: OpCode, task):
+        q = self.queues[hash(key) % len(self.queues)]
+        item = (opcode, time.monotonic(), task)
+
+        try:
+            q.put_nowait(item)
+        except queue.Full:
+            if self.policy == BLOCK:
+                BLOCKED.inc(self.name)
+                q.put(item)
+            elif self.policy == DROP_NEWEST:
+                DROPPED.inc(self.name, opcode.value)
+            else:
+                # Several receiving threads can make room in the same queue at once
+                with self._lock:
+                    while True:
+                        try:
+                            q.put_nowait(item)
+                            break
+                        except queue.Full:
+                            try:
+                                dropped, _, _ = q.get_nowait()
+                                DROPPED.inc(self.name, dropped.value)
+                            except queue.Empty:
+                                pass
+
+        QUEUE_DEPTH.set(self.depth, self.name)
+
+    def _worker_target(self, q: queue.Queue):
+        while True:
+            opcode, received, task = q.get()
+            QUEUE_DEPTH.set(self.depth, self.name)
+            QUEUE_WAIT.observe(time.monotonic() - received, self.name)
+
+            try:
+                task()
+            except Exception:
+                # A failing handler must not take the worker down with it
+                logging.exception(f"Handling message of type {opcode.value} failed")
+
+
+# Routes every message to the lane of its opcode, so a slow election does not hold up heartbeats
+# and votes
+class Dispatcher:
+    def __init__(self, size: int = 1024):
+        self.lanes: dict[str, Lane] = {}
+        self.routes: dict[OpCode, Lane] = {}
+        self.default = None
+
+        for name, opcodes, workers, policy in LANES:
+            lane = self.lanes[name] = Lane(name, workers, size, policy)
+            if opcodes is None:
+                self.default = lane
+            else:
+                for opcode in opcodes:
+                    self.routes[opcode] = lane
+
+    def submit(self, message: Message, ip: str, task):
+        lane = self.routes.get(message.opcode, self.default)
+        lane.submit(f"{ip}:{message.port}", message.opcode, task)
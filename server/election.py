@@ -1,8 +1,43 @@
 import uuid
+import time
 from control_plane import ControlPlane
 import logging
 from network import Message, OpCode
 import json
+import metrics
+
+ELECTION_DURATION = metrics.histogram(
+    "qhub_election_duration_seconds",
+    "Time from the first election activity a node sees until it knows the new leader",
+    (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    ("algorithm",),
+)
+ELECTION_MESSAGES = metrics.counter("qhub_election_messages_total", "Election messages received", ("algorithm", "opcode"))
+ELECTIONS = metrics.counter("qhub_elections_total", "Completed elections", ("algorithm",))
+ELECTION_OPCODES = {OpCode.ELECTION_VOTE, OpCode.ELECTION_REPLY, OpCode.ELECTION_RESULT}
+
+
+# Measures elections as seen by this node, so the election algorithms can be compared
+class ElectionStats:
+    def __init__(self, algorithm: str = "ring"):
+        self.algorithm = algorithm
+        self.started: float | None = None
+
+    def start(self):
+        if self.started is None:
+            self.started = time.monotonic()
+
+    def message(self, opcode: OpCode):
+        ELECTION_MESSAGES.inc(self.algorithm, opcode.value)
+
+    def finish(self):
+        if self.started is not None:
+            ELECTION_DURATION.observe(time.monotonic() - self.started, self.algorithm)
+            ELECTIONS.inc(self.algorithm)
+            self.started = None
+
+
+stats = ElectionStats()
 
 
 class ElectionData:
@@ -33,11 +68,12 @@ class Election:
 
     def initiate_election(self):
         logging.info("Starting a new election")
+        stats.start()
 
-        if len(self.cp._node_heartbeats) == 0:
+        if len(self.cp.heartbeats) == 0:
             logging.info("We are the only node")
             node = self.cp.get_node_from_socket(
-                next(iter(self.cp._node_heartbeats.keys()))
+                next(iter(self.cp.heartbeats.keys()))
             )
             self.make_leader(node)
             return
@@ -6,9 +6,16 @@ import time
 import node
 import control_plane
 import api
-from network import Message, OpCode, INTERFACE
+from network import Message, OpCode, INTERFACE, WIRE_FORMATS, TRANSPORTS, configure_wire_format, configure_transport, configure_reliable, configure_buffers, configure_sender
 from election import Election
 from application_state import ApplicationState
+from storage import Storage
+import runtime
+from runtime import RUNTIMES
+from dispatch import Dispatcher
+from reliable import ReliableChannel
+from sender import OutboundSender
+import metrics
 import socket
 
 def find_available_port(start_port, max_attempts=10):
@@ -25,12 +32,49 @@ def main():
     parser = argparse.ArgumentParser(prog="Server")
 
     parser.add_argument("--port", default=9765, type=int)
-    parser.add_argument("--delay", default=1, type=int)
+    parser.add_argument("--delay", default=1, type=float, help="seconds between heartbeats")
     parser.add_argument("--loglevel", default="INFO", type=str)
+    parser.add_argument("--wire-format", default="auto", choices=WIRE_FORMATS)
+    parser.add_argument("--data-dir", default=None, type=str)
+    parser.add_argument("--snapshot-interval", default=10000, type=int)
+    parser.add_argument("--commit-interval", default=5, type=float, help="milliseconds")
+    parser.add_argument("--vote-batch-window", default=10, type=float, help="milliseconds, 0 broadcasts every vote on its own")
+    parser.add_argument("--vote-batch-size", default=50, type=int)
+    parser.add_argument("--runtime", default="threaded", choices=RUNTIMES)
+    parser.add_argument("--dispatch", default="queued", choices=["inline", "queued"], help="threaded runtime only")
+    parser.add_argument("--queue-size", default=1024, type=int)
+    parser.add_argument("--receive-batch", default=64, type=int, help="datagrams read per wakeup, threaded runtime only")
+    parser.add_argument("--failure-detector", default="heartbeat", choices=["heartbeat", "phi", "swim"])
+    parser.add_argument("--phi-threshold", default=8.0, type=float)
+    parser.add_argument("--election", default="ring", choices=["ring", "bully"])
+    parser.add_argument("--election-delay", default=1.0, type=float, help="seconds, ring election only")
+    parser.add_argument("--election-timeout", default=0.5, type=float, help="seconds, bully election only")
+    parser.add_argument("--room-claim-timeout", default=0.5, type=float, help="seconds a new room owner waits for the other servers")
+    parser.add_argument("--read-lease", default=None, type=float, help="seconds, defaults to two heartbeat intervals")
+    parser.add_argument("--delivery", default="reliable", choices=["reliable", "best-effort"])
+    parser.add_argument("--swim-indirect-probes", default=3, type=int)
+    parser.add_argument("--swim-suspicion-multiplier", default=4, type=int)
+    parser.add_argument("--transport", default="broadcast", choices=TRANSPORTS)
+    parser.add_argument("--multicast-ttl", default=1, type=int, help="hops, multicast transport only")
+    parser.add_argument("--multicast-interface", default=None, type=str, help="address of the interface, multicast transport only")
+    parser.add_argument("--outbound", default="queued", choices=["direct", "queued"], help="send from the calling thread or from per destination queues")
+    parser.add_argument("--mtu", default=1400, type=int, help="bytes, queued messages are coalesced up to it")
+    parser.add_argument("--send-queue-size", default=1024, type=int, help="messages per destination")
+    parser.add_argument("--send-rate", default=0, type=float, help="datagrams per second and destination, 0 does not pace")
+    parser.add_argument("--sndbuf", default=0, type=int, help="bytes, 0 keeps the default of the operating system")
+    parser.add_argument("--rcvbuf", default=0, type=int, help="bytes, 0 keeps the default of the operating system")
+    parser.add_argument("--metrics-port", default=None, type=int, help="serves Prometheus metrics on /metrics if set")
 
     args = parser.parse_args()
 
     logging.basicConfig(level=args.loglevel)
+    configure_wire_format(args.wire_format)
+    configure_transport(args.transport, args.multicast_ttl, args.multicast_interface)
+    configure_buffers(args.sndbuf, args.rcvbuf)
+    if args.outbound == "queued":
+        sender = OutboundSender(args.mtu, args.send_queue_size, args.send_rate)
+        sender.start()
+        configure_sender(sender)
 
     threads = []
 
@@ -43,6 +87,48 @@ def main():
 
     app_state = ApplicationState()
 
+    # Restore the state from the data directory, so only operations after it have to be fetched from the cluster
+    if args.data_dir is not None:
+        storage = Storage(args.data_dir, args.snapshot_interval, args.commit_interval / 1000)
+        storage.recover(app_state)
+        storage.start(app_state.seq)
+        app_state.storage = storage
+
+    if args.metrics_port is not None:
+        metrics.on_collect(lambda: api.collect_state_size(app_state))
+        metrics.serve(args.metrics_port)
+
+    if args.vote_batch_window > 0:
+        api.configure_vote_batching(args.vote_batch_window / 1000, args.vote_batch_size, cp, app_state)
+
+    # The sequence number lets the leader answer with only the missing operations if it still has them
+    hello = Message(OpCode.HELLO, port=cp.node.port, data=json.dumps({**cp.node.__dict__, "seq": app_state.seq}))
+
+    api.ELECTION_DELAY = args.election_delay
+    api.READ_LEASE = 2 * args.delay if args.read_lease is None else args.read_lease
+    api.RECEIVE_BATCH = args.receive_batch
+    if args.election == "bully":
+        api.configure_bully(args.election_timeout, cp)
+    api.configure_room_claims(args.room_claim_timeout, cp, app_state)
+
+    # Reliable messages from other nodes are always understood, best-effort only affects sending
+    api.reliable = ReliableChannel(args.port)
+    if args.delivery == "reliable":
+        configure_reliable(api.reliable)
+
+    if args.failure_detector == "phi":
+        api.configure_phi(args.phi_threshold, args.delay)
+    elif args.failure_detector == "swim":
+        api.configure_swim(args.delay, args.swim_indirect_probes, args.swim_suspicion_multiplier, cp)
+
+    # The asyncio runtime always handles messages inline on its event loop
+    if args.runtime == "threaded" and args.dispatch == "queued":
+        api.dispatcher = Dispatcher(args.queue_size)
+
+    if args.runtime == "asyncio":
+        runtime.run(api.message_handler, args.delay, args.port, cp, election, app_state, hello)
+        return
+
     listener_thread = Thread(
         target=api.broadcast_target, args=(api.message_handler, cp, election, app_state)
     )
@@ -63,7 +149,7 @@ def main():
     heartbeat_thread.start()
     threads.append(heartbeat_thread)
 
-    Message(OpCode.HELLO, port=cp.node.port, data=json.dumps(cp.node.__dict__)).broadcast(2)
+    hello.broadcast(2)
 
     for thread in threads:
         thread.join()
@@ -0,0 +1,179 @@
+import hashlib
+from bisect import bisect
+from threading import Lock
+from node import Node
+
+# Points per node on the hash ring of the rooms, more points spread the rooms more evenly
+ROOM_POINTS = 64
+
+
+# Sockets of all nodes with a heartbeat in ring order, which is the order elections are routed in
+class Ring:
+    def __init__(self, sockets):
+        self.sockets: list[str] = sorted(sockets)
+        self.positions: dict[str, int] = {socket: index for index, socket in enumerate(self.sockets)}
+
+    def __len__(self) -> int:
+        return len(self.sockets)
+
+    def index(self, socket: str) -> int:
+        return self.positions[socket]
+
+    def at(self, index: int) -> str:
+        return self.sockets[index % len(self.sockets)]
+
+
+def ring_hash(key: str) -> int:
+    # Python's hash() differs between processes, every node has to place the rooms in the same spot
+    return int.from_bytes(hashlib.md5(key.encode("UTF-8")).digest()[:8], "big")
+
+
+# Consistent hashing of the rooms onto the nodes. A node that joins or leaves only takes over or hands
+# off the rooms next to its own points, all other rooms keep their node.
+class HashRing:
+    def __init__(self, sockets):
+        points = sorted((ring_hash(f"{socket}#{point}"), socket) for socket in sockets for point in range(ROOM_POINTS))
+        self.hashes = [point for point, _ in points]
+        self.sockets = [socket for _, socket in points]
+
+    def owner(self, room: str) -> str | None:
+        if not self.sockets:
+            return None
+        return self.sockets[bisect(self.hashes, ring_hash(room)) % len(self.sockets)]
+
+
+# An immutable view of the cluster membership. Readers take the current snapshot and can iterate it
+# as long as they like, since every change publishes a new snapshot instead of modifying this one.
+# The collections must therefore never be modified in place.
+class Membership:
+    def __init__(
+        self,
+        nodes: frozenset[Node] = frozenset(),
+        heartbeats: dict[str, float] | None = None,
+        sent: dict[str, int] | None = None,
+        received: dict[str, int] | None = None,
+    ):
+        self.nodes = nodes
+        # Monotonic time of the last heartbeat per socket
+        self.heartbeats = {} if heartbeats is None else heartbeats
+        # Heartbeat counters per socket that are exchanged with the other nodes
+        self.sent = {} if sent is None else sent
+        self.received = {} if received is None else received
+        # Built on first use and handed on to the next snapshot as long as the members stay the same
+        self._index: dict[tuple[str, int], Node] | None = None
+        self._ring: Ring | None = None
+        self._rooms: HashRing | None = None
+
+    @property
+    def index(self) -> dict[tuple[str, int], Node]:
+        if self._index is None:
+            self._index = {(node.ip, node.port): node for node in self.nodes}
+        return self._index
+
+    @property
+    def ring(self) -> Ring:
+        if self._ring is None:
+            self._ring = Ring(self.heartbeats)
+        return self._ring
+
+    @property
+    def rooms(self) -> HashRing:
+        if self._rooms is None:
+            self._rooms = HashRing(f"{node.ip}:{node.port}" for node in self.nodes)
+        return self._rooms
+
+    # `same_ring` tells that the heartbeats changed, but not the sockets they belong to
+    def replace(self, same_ring: bool = False, **changes) -> "Membership":
+        membership = Membership(
+            changes.get("nodes", self.nodes),
+            changes.get("heartbeats", self.heartbeats),
+            changes.get("sent", self.sent),
+            changes.get("received", self.received),
+        )
+        if "nodes" not in changes:
+            membership._index = self._index
+            membership._rooms = self._rooms
+        if "heartbeats" not in changes or same_ring:
+            membership._ring = self._ring
+        return membership
+
+
+# Copy-on-write store for the membership. Reading `snapshot` never blocks, all changes go through
+# the methods below, which copy the affected collection and publish a new snapshot under one lock.
+class MembershipStore:
+    def __init__(self):
+        self._lock = Lock()
+        self.snapshot = Membership()
+
+    def set_nodes(self, nodes: set[Node]):
+        with self._lock:
+            self.snapshot = self.snapshot.replace(nodes=frozenset(nodes))
+
+    # A node that joins again under the same socket replaces the old entry
+    def add_nodes(self, nodes: set[Node]):
+        with self._lock:
+            sockets = {(node.ip, node.port) for node in nodes}
+            kept = {node for node in self.snapshot.nodes if (node.ip, node.port) not in sockets}
+            self.snapshot = self.snapshot.replace(nodes=frozenset(kept | nodes))
+
+    def remove_node(self, node: Node):
+        with self._lock:
+            if node not in self.snapshot.nodes:
+                raise KeyError(node)
+            self.snapshot = self.snapshot.replace(nodes=self.snapshot.nodes - {node})
+
+    def register_heartbeat(self, socket: str, time: float):
+        with self._lock:
+            current = self.snapshot
+            self.snapshot = current.replace(
+                same_ring=socket in current.heartbeats, heartbeats={**current.heartbeats, socket: time}
+            )
+
+    def count_heartbeat_sent(self, socket: str):
+        with self._lock:
+            current = self.snapshot
+            if socket not in current.heartbeats:
+                return
+            self.snapshot = current.replace(
+                sent={**current.sent, socket: current.sent.get(socket, 0) + 1},
+                received={**current.received, socket: current.received.get(socket, 0) + 1},
+            )
+
+    # Counters only move forward, older values from delayed heartbeats are ignored
+    def update_received(self, socket: str, count: int):
+        with self._lock:
+            current = self.snapshot
+            if count > current.received.get(socket, count - 1):
+                self.snapshot = current.replace(received={**current.received, socket: count})
+
+    # Removes the node and the heartbeat of a socket and returns the node, if there was one
+    def remove_member(self, socket: str) -> Node | None:
+        with self._lock:
+            current = self.snapshot
+            node = current.index.get(parse_socket(socket))
+            self.snapshot = current.replace(
+                nodes=current.nodes if node is None else current.nodes - {node},
+                heartbeats={other: hb for other, hb in current.heartbeats.items() if other != socket},
+            )
+            return node
+
+    # Removes every node whose last heartbeat is older than `deadline` and returns their sockets
+    # with the removed node (None for sockets without a registered node)
+    def expire(self, deadline: float) -> list[tuple[str, Node | None]]:
+        with self._lock:
+            current = self.snapshot
+            expired = [socket for socket, hb in current.heartbeats.items() if hb < deadline]
+            if not expired:
+                return []
+
+            removed = [(socket, current.index.get(parse_socket(socket))) for socket in expired]
+            self.snapshot = current.replace(
+                nodes=current.nodes - {node for _, node in removed if node is not None},
+                heartbeats={socket: hb for socket, hb in current.heartbeats.items() if hb >= deadline},
+            )
+            return removed
+
+
+def parse_socket(socket: str) -> tuple[str, int]:
+    ip, port = socket.rsplit(":", 1)
+    return ip, int(port)
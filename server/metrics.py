@@ -0,0 +1,173 @@
+import logging
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+# Metrics are registered once by name and shared by everyone that asks for the same name
+REGISTRY: dict[str, "Counter | Gauge | Histogram"] = {}
+registry_lock = Lock()
+# Update gauges that are cheaper to compute when they are read than on every change
+COLLECTORS: list = []
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple[str, ...], float] = {}
+        self._lock = Lock()
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values: str) -> float:
+        return self.values.get(label_values, 0)
+
+
+class Gauge:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def set(self, value: float, *label_values: str):
+        self.values[label_values] = value
+
+    def get(self, *label_values: str) -> float:
+        return self.values.get(label_values, 0)
+
+
+class HistogramValue:
+    def __init__(self, buckets: int):
+        self.counts = [0] * (buckets + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...], labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values: dict[tuple[str, ...], HistogramValue] = {}
+        self._lock = Lock()
+
+    def observe(self, value: float, *label_values: str):
+        # Counts are kept per bucket and only accumulated when they are read
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self.values.get(label_values)
+            if histogram is None:
+                histogram = self.values[label_values] = HistogramValue(len(self.buckets))
+            histogram.counts[index] += 1
+            histogram.sum += value
+            histogram.count += 1
+
+    def mean(self, *label_values: str) -> float:
+        histogram = self.values.get(label_values)
+        return histogram.sum / histogram.count if histogram and histogram.count else 0.0
+
+
+def counter(name: str, help: str, labels: tuple[str, ...] = ()) -> Counter:
+    with registry_lock:
+        if name not in REGISTRY:
+            REGISTRY[name] = Counter(name, help, labels)
+        return REGISTRY[name]
+
+
+def gauge(name: str, help: str, labels: tuple[str, ...] = ()) -> Gauge:
+    with registry_lock:
+        if name not in REGISTRY:
+            REGISTRY[name] = Gauge(name, help, labels)
+        return REGISTRY[name]
+
+
+def histogram(name: str, help: str, buckets: tuple[float, ...], labels: tuple[str, ...] = ()) -> Histogram:
+    with registry_lock:
+        if name not in REGISTRY:
+            REGISTRY[name] = Histogram(name, help, buckets, labels)
+        return REGISTRY[name]
+
+
+def on_collect(collector):
+    COLLECTORS.append(collector)
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float) -> str:
+    value = float(value)
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+# All metrics in the Prometheus text format
+def render() -> str:
+    for collector in COLLECTORS:
+        try:
+            collector()
+        except Exception:
+            logging.exception("Collecting metrics failed")
+
+    lines = []
+    with registry_lock:
+        metrics = sorted(REGISTRY.values(), key=lambda metric: metric.name)
+    for metric in metrics:
+        kind = {Counter: "counter", Gauge: "gauge", Histogram: "histogram"}[type(metric)]
+        lines.append(f"# HELP {metric.name} {escape(metric.help)}")
+        lines.append(f"# TYPE {metric.name} {kind}")
+        # Copied first, other threads keep adding label values while we read them
+        for label_values, value in sorted(list(metric.values.items())):
+            if kind != "histogram":
+                lines.append(f"{metric.name}{format_labels(metric.labels, label_values)} {format_value(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip((*metric.buckets, float("inf")), list(value.counts)):
+                cumulative += count
+                le = f'le="{format_value(bound)}"'
+                lines.append(f"{metric.name}_bucket{format_labels(metric.labels, label_values, le)} {cumulative}")
+            lines.append(f"{metric.name}_sum{format_labels(metric.labels, label_values)} {format_value(value.sum)}")
+            lines.append(f"{metric.name}_count{format_labels(metric.labels, label_values)} {value.count}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("UTF-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Scrapes are not worth a log line each
+    def log_message(self, format, *args):
+        pass
+
+
+# Serves /metrics on its own port, for processes without a web app
+def serve(port: int, host: str = "") -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving metrics on http://{host or '0.0.0.0'}:{port}/metrics")
+    return server
@@ -0,0 +1,33 @@
+from collections import deque
+from itertools import islice
+
+
+# The most recent QUESTION and VOTE operations in sequence order. Nodes that missed a few
+# operations get only those instead of the whole application state. Once an operation has been
+# dropped from the log, everyone behind it has to fall back to a snapshot.
+class OperationLog:
+    def __init__(self, capacity: int = 10000, seq: int = 0):
+        self.capacity = capacity
+        # Time of the last request for missing operations
+        self.sync_requested = 0.0
+        self.reset(seq)
+
+    # Start over after the state was replaced by a snapshot that contains everything up to seq
+    def reset(self, seq: int):
+        self._operations: deque[tuple[int, str, str]] = deque(maxlen=self.capacity)
+        self._base = seq
+
+    def append(self, seq: int, opcode: str, data: str):
+        if len(self._operations) == self.capacity:
+            self._base = self._operations[0][0]
+        self._operations.append((seq, opcode, data))
+
+    @property
+    def last_seq(self) -> int:
+        return self._operations[-1][0] if self._operations else self._base
+
+    # Operations after seq or None if some of them are no longer in the log
+    def since(self, seq: int) -> list[tuple[int, str, str]] | None:
+        if seq < self._base or seq > self.last_seq:
+            return None
+        return list(islice(self._operations, seq - self._base, None))
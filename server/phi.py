@@ -0,0 +1,84 @@
+import math
+import time
+from collections import deque
+from threading import Lock
+
+
+# Inter-arrival times of the heartbeats of one peer
+class ArrivalWindow:
+    def __init__(self, size: int, first_interval: float):
+        self.intervals: deque[float] = deque(maxlen=size)
+        self.sum = 0.0
+        self.squares = 0.0
+        self.last: float | None = None
+        # Until the first interval is measured, heartbeats are expected at the configured rate
+        self.add(first_interval)
+
+    def add(self, interval: float):
+        if len(self.intervals) == self.intervals.maxlen:
+            dropped = self.intervals[0]
+            self.sum -= dropped
+            self.squares -= dropped * dropped
+        self.intervals.append(interval)
+        self.sum += interval
+        self.squares += interval * interval
+
+    @property
+    def mean(self) -> float:
+        return self.sum / len(self.intervals)
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(max(self.squares / len(self.intervals) - self.mean ** 2, 0.0))
+
+
+# Phi accrual failure detector (Hayashibara et al., 2004). Instead of a fixed timeout, it learns the
+# distribution of the heartbeat inter-arrival times of every peer and expresses how unlikely it is that
+# a heartbeat is still on its way as phi = -log10(P(next heartbeat arrives later than now)).
+# A phi of 8 means a false suspicion about once every 10^8 heartbeats.
+class PhiAccrualDetector:
+    def __init__(self, threshold: float = 8.0, interval: float = 1.0, window: int = 1000, min_std: float = 0.05):
+        self.threshold = threshold
+        self.interval = interval
+        self.window = window
+        # Keeps perfectly regular heartbeats from making phi explode on the slightest jitter
+        self.min_std = min_std
+        self._windows: dict[str, ArrivalWindow] = {}
+        self._lock = Lock()
+
+    def heartbeat(self, socket: str, now: float | None = None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            window = self._windows.get(socket)
+            if window is None:
+                window = self._windows[socket] = ArrivalWindow(self.window, self.interval)
+            elif window.last is not None:
+                window.add(now - window.last)
+            window.last = now
+
+    def phi(self, socket: str, now: float | None = None) -> float:
+        now = time.monotonic() if now is None else now
+        window = self._windows.get(socket)
+        if window is None or window.last is None:
+            return 0.0
+
+        elapsed = now - window.last
+        # The next heartbeat is not overdue yet. With slow heartbeats the exponent below would overflow.
+        if elapsed <= window.mean:
+            return 0.0
+        std = max(window.std, self.min_std)
+        # Logistic approximation of the normal distribution, as used by Akka and Cassandra:
+        # phi = -log10(e / (1 + e)) with e = exp(-x), computed without e so it cannot underflow to 0
+        y = (elapsed - window.mean) / std
+        x = y * (1.5976 + 0.070566 * y * y)
+        return (x + math.log1p(math.exp(-x))) / math.log(10)
+
+    def suspects(self, now: float | None = None) -> list[str]:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            sockets = list(self._windows)
+        return [socket for socket in sockets if self.phi(socket, now) > self.threshold]
+
+    def remove(self, socket: str):
+        with self._lock:
+            self._windows.pop(socket, None)
@@ -0,0 +1,62 @@
+import time
+from threading import Lock
+from control_plane import ControlPlane
+from application_state import ApplicationState
+
+# Answers to a read request
+READ_OK = "ok"
+# The state is older than the client allows, the client asks another server
+READ_STALE = "stale"
+# Lease reads are only answered by the leader
+READ_NOT_LEADER = "not_leader"
+
+
+# How far the state of a follower is behind the leader. The leader announces its sequence number with
+# every heartbeat. Once the follower applied all operations up to an announced number, its state was
+# current at the time of that announcement, so the staleness is the time since then.
+class Freshness:
+    def __init__(self):
+        self.announced_seq = 0
+        self.announced_at: float | None = None
+        self.synced_at: float | None = None
+        self._lock = Lock()
+
+    def announce(self, seq: int, app_seq: int, now: float | None = None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            # The previous announcement may have been caught up with in the meantime
+            if self.announced_at is not None and app_seq >= self.announced_seq:
+                self.synced_at = self.announced_at
+            self.announced_seq = seq
+            self.announced_at = now
+            if app_seq >= seq:
+                self.synced_at = now
+
+    def staleness(self, app_seq: int, now: float | None = None) -> float:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self.announced_at is not None and app_seq >= self.announced_seq:
+                return now - self.announced_at
+            if self.synced_at is None:
+                return float("inf")
+            return now - self.synced_at
+
+
+# The leader knows its state is current as long as a majority of the cluster still follows it. The
+# staleness is the time since the most recent heartbeats of a majority, including its own.
+def leader_staleness(cp: ControlPlane, now: float | None = None) -> float:
+    now = time.monotonic() if now is None else now
+    majority = len(cp.nodes) // 2 + 1
+    heard = sorted(cp.heartbeats.values(), reverse=True)
+    if len(heard) < majority:
+        return float("inf")
+    return max(now - heard[majority - 1], 0.0)
+
+
+# Questions ranked by votes, the same order and fields the clients serve. The ranking is kept up to date
+# on every change, so a read costs O(k) for a page of k questions.
+def read_page(app_state: ApplicationState, offset: int = 0, limit: int | None = None) -> list[dict]:
+    return [
+        {"uuid": question.uuid, "text": question.text, "votes": question.vote_count}
+        for question in app_state.ranking.page(offset, limit)
+    ]
@@ -0,0 +1,39 @@
+import socket
+
+# Largest UDP payload, a datagram is only read into the buffer if it fits behind the previous ones
+MAX_DATAGRAM = 65535
+# Not every platform can read from a blocking socket without waiting, those read one datagram per call
+NONBLOCKING_FLAG = getattr(socket, "MSG_DONTWAIT", None)
+
+
+# Reads datagrams into one preallocated buffer instead of allocating a new bytes object per datagram.
+# Python has no recvmmsg, so a batch is the datagram we waited for plus all datagrams that are already
+# queued on the socket, read with MSG_DONTWAIT back to back into the buffer. The messages are parsed
+# straight from slices of the buffer, which are only valid until the next call to `receive`.
+# The socket has to be blocking, on a socket with a timeout MSG_DONTWAIT still waits for the timeout.
+class BatchReceiver:
+    def __init__(self, sock: socket.socket, batch: int = 64, size: int = 1 << 20):
+        self.sock = sock
+        self.batch = batch if NONBLOCKING_FLAG is not None else 1
+        self.buffer = bytearray(max(size, MAX_DATAGRAM))
+        self.view = memoryview(self.buffer)
+
+    def receive(self) -> list[tuple[memoryview, str]]:
+        receive_into = self.sock.recvfrom_into
+        length, (ip, _) = receive_into(self.view, MAX_DATAGRAM)
+        datagrams = [(self.view[:length], ip)] if length else []
+        offset = length
+        last = len(self.buffer) - MAX_DATAGRAM
+
+        for _ in range(self.batch - 1):
+            if offset > last:
+                break
+            free = self.view[offset:]
+            try:
+                length, (ip, _) = receive_into(free, MAX_DATAGRAM, NONBLOCKING_FLAG)
+            except BlockingIOError:
+                break
+            if length:
+                datagrams.append((free[:length], ip))
+                offset += length
+        return datagrams
@@ -0,0 +1,182 @@
+import logging
+import random
+import threading
+import time
+from network import Message, OpCode
+
+# First retransmit after this many seconds, every further one waits twice as long
+RETRANSMIT_TIMEOUT = 0.2
+MAX_RETRANSMITS = 8
+# Messages after a gap that are held back per sender until the gap is filled
+REORDER_WINDOW = 1024
+# Out of order sequence numbers reported in one acknowledgement
+MAX_SELECTIVE_ACKS = 32
+# Senders whose receive state is kept, the oldest one is forgotten first
+MAX_INCOMING = 1024
+
+
+def start_timer(delay: float, callback):
+    timer = threading.Timer(delay, callback)
+    timer.daemon = True
+    timer.start()
+
+
+class Pending:
+    def __init__(self, message: Message):
+        self.message = message
+        self.sent = time.monotonic()
+        self.attempts = 0
+
+    @property
+    def due(self) -> float:
+        return self.sent + RETRANSMIT_TIMEOUT * 2 ** self.attempts
+
+
+class Outgoing:
+    def __init__(self):
+        self.seq = 0
+        # Sent but not yet acknowledged messages in sequence order
+        self.unacked: dict[int, Pending] = {}
+        self.timer = False
+
+    # Lowest sequence number the receiver still has to wait for
+    @property
+    def base(self) -> int:
+        return next(iter(self.unacked), self.seq + 1)
+
+
+class Incoming:
+    def __init__(self, expected: int):
+        self.expected = expected
+        self.buffer: dict[int, Message] = {}
+
+
+# Reliable unicast on top of UDP. Every message to a peer gets the next sequence number of that peer
+# and is retransmitted until the peer acknowledges it. The receiver delivers messages exactly once and
+# in order, holding back messages after a gap in a bounded reorder buffer. Acknowledgements are
+# cumulative and list the sequence numbers received after a gap, so those are not sent again.
+#
+# Every process uses a random session id, so a restarted sender does not run into the duplicate
+# detection of its old sequence numbers.
+class ReliableChannel:
+    def __init__(self, local_port: int, schedule=start_timer):
+        self.local_port = local_port
+        self.session = random.getrandbits(32)
+        # Runs a callback after a delay, the asyncio runtime replaces the thread based timer
+        self.schedule = schedule
+        self._outgoing: dict[tuple[str, int], Outgoing] = {}
+        self._incoming: dict[tuple[str, int, int], Incoming] = {}
+        self._lock = threading.Lock()
+        self.retransmits = 0
+        self.duplicates = 0
+        self.given_up = 0
+
+    def send(self, message: Message, ip: str, port: int):
+        # Fail right away instead of retransmitting to nowhere, e.g. while the leader is not known yet
+        if ip is None or port is None:
+            raise ValueError(f"No destination for {message.opcode.value}")
+
+        peer = (ip, port)
+        with self._lock:
+            outgoing = self._outgoing.get(peer)
+            if outgoing is None:
+                outgoing = self._outgoing[peer] = Outgoing()
+            outgoing.seq += 1
+            seq = outgoing.seq
+            outgoing.unacked[seq] = Pending(message)
+            base = outgoing.base
+            start = not outgoing.timer
+            outgoing.timer = True
+
+        if start:
+            self.schedule(RETRANSMIT_TIMEOUT, lambda: self._retransmit(peer))
+        self._envelope(message, seq, base).send(ip, port)
+
+    def _envelope(self, message: Message, seq: int, base: int) -> Message:
+        data = {"session": self.session, "seq": seq, "base": base, "opcode": message.opcode.value, "data": message.data}
+        return Message(opcode=OpCode.RELIABLE_DATA, port=self.local_port, data=data)
+
+    def _retransmit(self, peer: tuple[str, int]):
+        now = time.monotonic()
+        resend = []
+        with self._lock:
+            outgoing = self._outgoing[peer]
+            for seq, pending in list(outgoing.unacked.items()):
+                if pending.due > now:
+                    continue
+                if pending.attempts >= MAX_RETRANSMITS:
+                    # The receiver skips the gap once the base of later messages moved past it
+                    del outgoing.unacked[seq]
+                    self.given_up += 1
+                    logging.info(f"Giving up on {pending.message.opcode.value} {seq} to {peer[0]}:{peer[1]}")
+                    continue
+                pending.attempts += 1
+                pending.sent = now
+                resend.append((seq, pending.message))
+
+            base = outgoing.base
+            delay = None
+            if outgoing.unacked:
+                delay = max(min(pending.due for pending in outgoing.unacked.values()) - now, 0.01)
+            else:
+                outgoing.timer = False
+
+        for seq, message in resend:
+            self.retransmits += 1
+            self._envelope(message, seq, base).send(*peer)
+        if delay is not None:
+            self.schedule(delay, lambda: self._retransmit(peer))
+
+    # Returns the messages that can be delivered now, in order
+    def receive(self, message: Message, ip: str) -> list[Message]:
+        data = message.data
+        key = (ip, message.port, data["session"])
+        seq = data["seq"]
+        delivered = []
+
+        with self._lock:
+            incoming = self._incoming.get(key)
+            if incoming is None:
+                if len(self._incoming) >= MAX_INCOMING:
+                    del self._incoming[next(iter(self._incoming))]
+                incoming = self._incoming[key] = Incoming(data["base"])
+
+            # The sender gave up on the missing messages before its base, so there is nothing left to
+            # wait for. What arrived after the gap is delivered.
+            if data["base"] > incoming.expected:
+                for held in sorted(held for held in incoming.buffer if held < data["base"]):
+                    delivered.append(incoming.buffer.pop(held))
+                incoming.expected = data["base"]
+
+            if seq < incoming.expected or seq in incoming.buffer:
+                self.duplicates += 1
+            elif seq < incoming.expected + REORDER_WINDOW:
+                incoming.buffer[seq] = Message(OpCode(data["opcode"]), data["data"], message.port)
+
+            while incoming.expected in incoming.buffer:
+                delivered.append(incoming.buffer.pop(incoming.expected))
+                incoming.expected += 1
+
+            ack = {
+                "session": data["session"],
+                "ack": incoming.expected - 1,
+                "sack": sorted(incoming.buffer)[:MAX_SELECTIVE_ACKS],
+            }
+
+        Message(opcode=OpCode.RELIABLE_ACK, port=self.local_port, data=ack).send(ip, message.port)
+        return delivered
+
+    def ack(self, message: Message, ip: str):
+        data = message.data
+        # Acknowledgements for other sessions belong to another worker process sharing the port
+        if data["session"] != self.session:
+            return
+
+        with self._lock:
+            outgoing = self._outgoing.get((ip, message.port))
+            if outgoing is None:
+                return
+            while outgoing.unacked and next(iter(outgoing.unacked)) <= data["ack"]:
+                del outgoing.unacked[next(iter(outgoing.unacked))]
+            for seq in data["sack"]:
+                outgoing.unacked.pop(seq, None)
@@ -0,0 +1,50 @@
+from collections import OrderedDict
+from threading import Lock
+
+# Request ids remembered for deduplication, the oldest one is forgotten first
+MAX_REQUESTS = 65536
+
+
+# Client request ids of the operations that were applied or are about to be. Toggling a vote is not
+# idempotent, so a request the client retries after a lost acknowledgement must not be applied again.
+# Followers record the ids of the operations they apply as well, so a new leader still knows them.
+class RequestTable:
+    def __init__(self, capacity: int = MAX_REQUESTS):
+        self.capacity = capacity
+        # Sequence number of the operation, None while it waits to be sequenced (e.g. in a vote batch)
+        self._requests: OrderedDict[str, int | None] = OrderedDict()
+        # Where to send the acknowledgement once the operation is sequenced
+        self._reply_to: dict[str, tuple[str, int]] = {}
+        self._lock = Lock()
+
+    # Returns False if the request is already known, then it must not be applied again
+    def start(self, request_id: str, reply_to: tuple[str, int]) -> bool:
+        with self._lock:
+            if request_id in self._requests:
+                return False
+            self._add(request_id, None)
+            self._reply_to[request_id] = reply_to
+            return True
+
+    def result(self, request_id: str) -> int | None:
+        with self._lock:
+            return self._requests.get(request_id)
+
+    # Returns where to send the acknowledgement, if the client waits for one here
+    def complete(self, request_id: str, seq: int) -> tuple[str, int] | None:
+        with self._lock:
+            self._add(request_id, seq)
+            return self._reply_to.pop(request_id, None)
+
+    # The request was not applied after all, a retry is handled like a new request
+    def forget(self, request_id: str):
+        with self._lock:
+            self._requests.pop(request_id, None)
+            self._reply_to.pop(request_id, None)
+
+    def _add(self, request_id: str, seq: int | None):
+        self._requests[request_id] = seq
+        self._requests.move_to_end(request_id)
+        while len(self._requests) > self.capacity:
+            forgotten, _ = self._requests.popitem(last=False)
+            self._reply_to.pop(forgotten, None)
@@ -0,0 +1,74 @@
+import asyncio
+import logging
+from control_plane import ControlPlane
+from election import Election
+from application_state import ApplicationState
+from network import Message
+import api
+import transfer
+
+RUNTIMES = ["threaded", "asyncio"]
+
+
+# Receives datagrams on the event loop and runs the handlers one after another on the loop thread,
+# so handlers never race each other on the control plane or the application state
+class ServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, callback, cp: ControlPlane, election: Election, app_state: ApplicationState):
+        self.callback = callback
+        self.cp = cp
+        self.election = election
+        self.app_state = app_state
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]):
+        if not data:
+            return
+        ip, _ = addr
+        try:
+            for msg in Message.unmarshal_datagram(data, ip):
+                self.callback(msg, ip, self.cp, self.election, self.app_state)
+        except Exception:
+            # A single bad message must not take down the whole loop
+            logging.exception(f"Handling message from {ip} failed")
+
+    def error_received(self, exc: Exception):
+        logging.info(f"Receiving failed: {exc}")
+
+
+async def heartbeat_task(delay: float, cp: ControlPlane, app_state: ApplicationState):
+    while True:
+        api.heartbeat_tick(cp, app_state)
+        await asyncio.sleep(delay)
+        api.leadership_check(cp)
+
+
+async def serve(callback, delay: float, lport: int, cp: ControlPlane, election: Election, app_state: ApplicationState, hello: Message):
+    loop = asyncio.get_running_loop()
+
+    # Delayed work runs as timers on the loop instead of blocking it
+    api.defer = loop.call_later
+    if api.vote_batcher is not None:
+        api.vote_batcher.schedule = loop.call_later
+    if api.failure_detector is not None:
+        api.failure_detector.schedule = loop.call_later
+    if api.reliable is not None:
+        api.reliable.schedule = loop.call_later
+    if api.bully is not None:
+        api.bully.schedule = loop.call_later
+    if api.room_claims is not None:
+        api.room_claims.schedule = loop.call_later
+    transfer.schedule = loop.call_later
+
+    await loop.create_datagram_endpoint(
+        lambda: ServerProtocol(callback, cp, election, app_state), sock=api.broadcast_socket()
+    )
+    await loop.create_datagram_endpoint(
+        lambda: ServerProtocol(callback, cp, election, app_state), sock=api.unicast_socket(lport)
+    )
+
+    hello.broadcast(2)
+
+    await heartbeat_task(delay, cp, app_state)
+
+
+def run(callback, delay: float, lport: int, cp: ControlPlane, election: Election, app_state: ApplicationState, hello: Message):
+    asyncio.run(serve(callback, delay, lport, cp, election, app_state, hello))
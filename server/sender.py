@@ -0,0 +1,131 @@
+import logging
+import socket
+import time
+from collections import deque
+from threading import Condition, Thread
+import metrics
+from network import OpCode, pack_bundle, BUNDLE_OVERHEAD, FRAME_OVERHEAD, sock as network_socket
+
+# IPv4 and UDP headers, the rest of the MTU is left for the datagram
+HEADERS_SIZE = 28
+
+OUTBOUND_DEPTH = metrics.gauge("qhub_outbound_queue_depth", "Messages waiting in the outbound queues")
+OUTBOUND_DROPS = metrics.counter("qhub_outbound_drops_total", "Messages dropped because their outbound queue was full", ("opcode",))
+OUTBOUND_MESSAGES = metrics.counter("qhub_outbound_messages_total", "Messages sent by the outbound sender")
+OUTBOUND_DATAGRAMS = metrics.counter("qhub_outbound_datagrams_total", "Datagrams sent by the outbound sender")
+OUTBOUND_ERRORS = metrics.counter("qhub_outbound_errors_total", "Datagrams the socket refused to send")
+
+
+class Destination:
+    def __init__(self, rate: float, now: float):
+        self.queue: deque[tuple[bytes, bool]] = deque()
+        # Token bucket of the pacing, up to 10ms worth of datagrams are sent back to back
+        self.burst = max(rate / 100, 1)
+        self.tokens = self.burst
+        self.refilled = now
+        self.dropping = False
+
+    def refill(self, rate: float, now: float):
+        self.tokens = min(self.tokens + (now - self.refilled) * rate, self.burst)
+        self.refilled = now
+
+
+# Sends the datagrams of all threads from one thread. Every destination has its own bounded queue, a
+# slow or unreachable peer only fills its own queue and messages to it are dropped once it is full.
+# Small messages that wait for the same destination are coalesced into one datagram of up to the MTU,
+# if the receivers understand bundles. With `rate` set, at most that many datagrams per second are
+# sent to a destination, so bursts do not overflow the receive buffer of the peer.
+class OutboundSender:
+    def __init__(self, mtu: int = 1400, queue_size: int = 1024, rate: float = 0, sock: socket.socket = network_socket):
+        self.sock = sock
+        self.max_datagram = mtu - HEADERS_SIZE
+        self.queue_size = queue_size
+        self.rate = rate
+
+    # Also called in forked processes, which inherit the queues but not the thread
+    def start(self):
+        self.destinations: dict[tuple[str, int], Destination] = {}
+        self.depth = 0
+        self._ready = Condition()
+        Thread(target=self._run, daemon=True).start()
+
+    # Returns whether the message was queued
+    def send(self, payload: bytes, address: tuple[str, int], opcode: OpCode, bundle: bool = False) -> bool:
+        with self._ready:
+            destination = self.destinations.get(address)
+            if destination is None:
+                destination = self.destinations[address] = Destination(self.rate, time.monotonic())
+
+            if len(destination.queue) >= self.queue_size:
+                if not destination.dropping:
+                    logging.warning(f"Outbound queue to {address[0]}:{address[1]} is full, dropping messages")
+                    destination.dropping = True
+                OUTBOUND_DROPS.inc(opcode.value)
+                return False
+
+            destination.dropping = False
+            destination.queue.append((payload, bundle))
+            self.depth += 1
+            OUTBOUND_DEPTH.set(self.depth)
+            self._ready.notify()
+        return True
+
+    def _run(self):
+        while True:
+            with self._ready:
+                datagrams, wait = self._collect(time.monotonic())
+                if not datagrams:
+                    self._ready.wait(wait)
+                    continue
+
+            for datagram, address, messages in datagrams:
+                try:
+                    self.sock.sendto(datagram, address)
+                except OSError as e:
+                    OUTBOUND_ERRORS.inc()
+                    logging.info(f"Sending to {address[0]}:{address[1]} failed: {e}")
+                    continue
+                OUTBOUND_DATAGRAMS.inc()
+                OUTBOUND_MESSAGES.inc(amount=messages)
+
+    # Takes one datagram per destination, so every destination gets its turn. Returns the datagrams and,
+    # if there are none, how long to wait for the pacing of the queued destinations.
+    def _collect(self, now: float) -> tuple[list[tuple[bytes, tuple[str, int], int]], float | None]:
+        datagrams = []
+        wait = None
+        for address, destination in list(self.destinations.items()):
+            if not destination.queue:
+                # Forget idle destinations, so clients that left do not pile up
+                del self.destinations[address]
+                continue
+
+            if self.rate:
+                destination.refill(self.rate, now)
+                if destination.tokens < 1:
+                    delay = (1 - destination.tokens) / self.rate
+                    wait = delay if wait is None else min(wait, delay)
+                    continue
+                destination.tokens -= 1
+
+            datagram, messages = self._coalesce(destination.queue)
+            self.depth -= messages
+            datagrams.append((datagram, address, messages))
+
+        OUTBOUND_DEPTH.set(self.depth)
+        return datagrams, wait
+
+    def _coalesce(self, queue: deque[tuple[bytes, bool]]) -> tuple[bytes, int]:
+        payload, bundle = queue.popleft()
+        size = BUNDLE_OVERHEAD + FRAME_OVERHEAD + len(payload)
+        if not bundle or not queue or size > self.max_datagram:
+            return payload, 1
+
+        payloads = [payload]
+        while queue and queue[0][1] and size + FRAME_OVERHEAD + len(queue[0][0]) <= self.max_datagram:
+            payload, _ = queue.popleft()
+            payloads.append(payload)
+            size += FRAME_OVERHEAD + len(payload)
+
+        if len(payloads) == 1:
+            return payloads[0], 1
+        return pack_bundle(payloads), len(payloads)
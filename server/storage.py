@@ -0,0 +1,200 @@
+import json
+import logging
+import mmap
+import os
+import queue
+import time
+from threading import Thread
+from application_state import ApplicationState, Question, Vote
+
+SNAPSHOT_PREFIX = "snapshot-"
+WAL_PREFIX = "wal-"
+
+
+class Snapshot:
+    def __init__(self, seq: int, questions: list[dict]):
+        self.seq = seq
+        self.questions = questions
+
+
+# Durable copy of the application state in a data directory. Every applied QUESTION and VOTE operation
+# is appended to a write-ahead log, and every `snapshot_interval` operations the whole state is written
+# to a snapshot, after which older log segments are deleted.
+#
+# All writes happen on one writer thread. It collects everything queued within `commit_interval`
+# seconds and syncs it with a single fsync, so operations become durable within one commit interval
+# without every single operation waiting for the disk.
+class Storage:
+    def __init__(self, path: str, snapshot_interval: int = 10000, commit_interval: float = 0.005):
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self.commit_interval = commit_interval
+        self.operations_since_snapshot = 0
+        self._queue: queue.Queue[tuple | Snapshot] = queue.Queue()
+        self._wal = None
+        os.makedirs(path, exist_ok=True)
+
+    def start(self, seq: int):
+        self._open_segment(seq)
+        Thread(target=self._writer_target, daemon=True).start()
+
+    def append(self, seq: int, opcode: str, data: str):
+        self._queue.put((seq, opcode, data))
+        self.operations_since_snapshot += 1
+
+    def maybe_snapshot(self, app_state: ApplicationState):
+        if self.operations_since_snapshot >= self.snapshot_interval:
+            self.snapshot(app_state)
+
+    # The questions are copied right away, encoding and writing happens on the writer thread
+    def snapshot(self, app_state: ApplicationState):
+        self.operations_since_snapshot = 0
+        self._queue.put(Snapshot(app_state.seq, [question.to_dict() for question in app_state.questions]))
+
+    # Load the newest snapshot and replay the operations logged after it
+    def recover(self, app_state: ApplicationState):
+        started = time.monotonic()
+
+        snapshots = self._files(SNAPSHOT_PREFIX)
+        if snapshots:
+            self._load_snapshot(snapshots[-1][1], app_state)
+        snapshot_seq = app_state.seq
+
+        replayed = 0
+        for _, segment in self._files(WAL_PREFIX):
+            for seq, opcode, data in read_operations(segment):
+                if seq <= app_state.seq:
+                    continue
+                replay(app_state, seq, opcode, data)
+                replayed += 1
+
+        self.operations_since_snapshot = replayed
+        logging.info(
+            f"Recovered {len(app_state.questions)} questions from snapshot {snapshot_seq} and {replayed} logged operations "
+            f"up to operation {app_state.seq} in {time.monotonic() - started:.3f}s"
+        )
+
+    def _load_snapshot(self, path: str, app_state: ApplicationState):
+        lines = read_lines(path)
+        header = next(lines, None)
+        if header is None:
+            return
+        app_state.questions = [Question(**question) for question in lines]
+        app_state.seq = header["seq"]
+        app_state.operations.reset(app_state.seq)
+
+    def _files(self, prefix: str) -> list[tuple[int, str]]:
+        files = []
+        for name in os.listdir(self.path):
+            if name.startswith(prefix) and not name.endswith(".tmp"):
+                files.append((int(name[len(prefix):].split(".")[0]), os.path.join(self.path, name)))
+        return sorted(files)
+
+    # A segment contains the operations after the sequence number in its name
+    def _open_segment(self, seq: int, truncate: bool = False):
+        if self._wal is not None:
+            self._wal.close()
+        self._wal = open(os.path.join(self.path, f"{WAL_PREFIX}{seq:020d}.log"), "wb+" if truncate else "ab+")
+        # Terminate a torn last line, so it does not swallow the next entry
+        if self._wal.tell() > 0:
+            self._wal.seek(-1, os.SEEK_END)
+            if self._wal.read(1) != b"\n":
+                self._wal.write(b"\n")
+
+    def _writer_target(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.commit_interval
+            while (timeout := deadline - time.monotonic()) > 0:
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            try:
+                self._write(batch)
+            except OSError as e:
+                logging.error(f"Writing to the data directory failed: {e}")
+
+    def _write(self, batch: list):
+        lines = []
+        for item in batch:
+            if isinstance(item, Snapshot):
+                # Everything queued before the snapshot belongs to the old segment
+                self._commit(lines)
+                lines = []
+                self._write_snapshot(item)
+            else:
+                # The data is already JSON without line breaks, so it is stored as it is next to seq and opcode
+                seq, opcode, data = item
+                lines.append(f"{seq}\t{opcode}\t{data}\n".encode("UTF-8"))
+        self._commit(lines)
+
+    def _commit(self, lines: list[bytes]):
+        if not lines:
+            return
+        self._wal.write(b"".join(lines))
+        self._wal.flush()
+        os.fsync(self._wal.fileno())
+
+    def _write_snapshot(self, snapshot: Snapshot):
+        path = os.path.join(self.path, f"{SNAPSHOT_PREFIX}{snapshot.seq:020d}.jsonl")
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(json.dumps({"seq": snapshot.seq, "questions": len(snapshot.questions)}).encode("UTF-8") + b"\n")
+            for question in snapshot.questions:
+                f.write(json.dumps(question, separators=(",", ":")).encode("UTF-8") + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{path}.tmp", path)
+
+        # Operations after the snapshot are only queued after it, so the new segment starts out empty
+        self._open_segment(snapshot.seq, truncate=True)
+
+        # Compaction: the snapshot and the new segment replace everything else
+        for seq, old in self._files(SNAPSHOT_PREFIX) + self._files(WAL_PREFIX):
+            if seq != snapshot.seq:
+                os.remove(old)
+        logging.info(f"Wrote snapshot at operation {snapshot.seq}")
+
+
+def read_raw_lines(path: str):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            while line := m.readline():
+                yield line
+
+
+# Yields the JSON lines of a file. Torn lines from a crash during a write are skipped.
+def read_lines(path: str):
+    for line in read_raw_lines(path):
+        try:
+            yield json.loads(line)
+        except ValueError:
+            logging.info(f"Ignoring incomplete entry in {path}")
+
+
+def read_operations(path: str):
+    for line in read_raw_lines(path):
+        try:
+            seq, opcode, data = line.decode("UTF-8").rstrip("\n").split("\t", 2)
+            yield int(seq), opcode, data
+        except ValueError:
+            logging.info(f"Ignoring incomplete entry in {path}")
+
+
+def replay(app_state: ApplicationState, seq: int, opcode: str, data: str):
+    try:
+        msg = json.loads(data)
+    except ValueError:
+        logging.info(f"Ignoring incomplete operation {seq}")
+        return
+    if opcode == "question":
+        app_state.add_question(Question(msg["text"], msg["votes"], msg["uuid"]))
+    elif opcode == "vote":
+        question = app_state.get_question_from_uuid(msg["question_uuid"])
+        if question is not None:
+            app_state.toggle_vote(question, Vote(msg["socket"], msg["question_uuid"]))
+    app_state.seq = seq
+    app_state.operations.append(seq, opcode, data)
@@ -0,0 +1,270 @@
+import logging
+import math
+import random
+import time
+from threading import Lock
+from control_plane import ControlPlane
+from network import Message, OpCode
+from node import Node
+from batcher import start_timer
+import metrics
+
+PROBES = metrics.counter("qhub_swim_probes_total", "Probes by outcome", ("result",))
+SUSPECTED = metrics.counter("qhub_swim_suspected_total", "Members that were suspected to have failed")
+CONFIRMED = metrics.counter("qhub_swim_confirmed_total", "Members that were declared dead")
+
+ALIVE = "alive"
+SUSPECT = "suspect"
+DEAD = "dead"
+
+# Membership updates piggybacked on a single message, which keeps the message size constant
+MAX_PIGGYBACK = 6
+
+
+class Member:
+    def __init__(self, incarnation: int = 0):
+        self.status = ALIVE
+        self.incarnation = incarnation
+        self.suspected_at = 0
+
+
+class Probe:
+    def __init__(self, target: str, requester: tuple[str, int, int] | None = None):
+        self.target = target
+        self.acked = False
+        # For indirect probes the node that asked us, and the sequence number it is waiting for
+        self.requester = requester
+
+
+# SWIM failure detector (Das et al., 2002). Every period each node pings one member, picked in a
+# shuffled round robin order. Without an answer within `ping_timeout`, `indirect` other members are
+# asked to ping it as well. A member that did not answer at the end of the period is suspected and
+# declared dead if it does not refute the suspicion within the suspicion timeout. Membership changes
+# are piggybacked on the probes, so every node sends a constant number of messages per period
+# regardless of the cluster size.
+class Swim:
+    def __init__(self, cp: ControlPlane, period: float, lost, indirect: int = 3, suspicion_multiplier: int = 4, schedule=start_timer):
+        self.cp = cp
+        self.period = period
+        self.ping_timeout = period / 3
+        self.indirect = indirect
+        self.suspicion_multiplier = suspicion_multiplier
+        # Called with the socket of a member that was declared dead
+        self.lost = lost
+        # Runs a callback after a delay, the asyncio runtime replaces the thread based timer
+        self.schedule = schedule
+        self.incarnation = 0
+        self.members: dict[str, Member] = {}
+        self.probes: dict[int, Probe] = {}
+        # Updates still to be piggybacked and how many more times
+        self.updates: dict[str, list] = {}
+        self._targets: list[str] = []
+        # Members declared dead while holding the lock, reported to `lost` once it is released
+        self._dead: list[str] = []
+        self._seq = 0
+        self._lock = Lock()
+
+    @property
+    def local_socket(self) -> str:
+        return f"{self.cp.node.ip}:{self.cp.node.port}"
+
+    # Each update is passed on about log(N) times, which is enough to reach every member with high probability
+    def _transmissions(self) -> int:
+        return self.suspicion_multiplier * max(1, math.ceil(math.log2(len(self.members) + 2)))
+
+    def _suspicion_timeout(self) -> float:
+        return self.suspicion_multiplier * max(1, math.ceil(math.log10(len(self.members) + 2))) * self.period
+
+    def _sync_members(self):
+        sockets = set(self.cp.membership.ring.sockets)
+        sockets.discard(self.local_socket)
+        for socket in sockets - self.members.keys():
+            self.members[socket] = Member()
+        for socket in self.members.keys() - sockets:
+            del self.members[socket]
+
+    def _next_target(self) -> str | None:
+        while self._targets:
+            target = self._targets.pop()
+            if target in self.members:
+                return target
+        if not self.members:
+            return None
+        self._targets = list(self.members)
+        random.shuffle(self._targets)
+        return self._targets.pop()
+
+    def _next_seq(self) -> int:
+        self._seq += 1
+        return self._seq
+
+    def tick(self):
+        with self._lock:
+            self._sync_members()
+            self._expire_suspects()
+
+            target = self._next_target()
+            if target is not None:
+                seq = self._next_seq()
+                self.probes[seq] = Probe(target)
+                self._send(OpCode.PING, target, {"seq": seq})
+
+        self._report_dead()
+        if target is None:
+            return
+        self.schedule(self.ping_timeout, lambda: self._probe_indirectly(seq))
+        self.schedule(self.period, lambda: self._finish_probe(seq))
+
+    def _probe_indirectly(self, seq: int):
+        with self._lock:
+            probe = self.probes.get(seq)
+            if probe is None or probe.acked:
+                return
+            helpers = [socket for socket in self.members if socket != probe.target and self.members[socket].status == ALIVE]
+            for helper in random.sample(helpers, min(self.indirect, len(helpers))):
+                self._send(OpCode.PING_REQ, helper, {"seq": seq, "target": probe.target})
+
+    def _finish_probe(self, seq: int):
+        with self._lock:
+            probe = self.probes.pop(seq, None)
+            if probe is None:
+                return
+            PROBES.inc("ack" if probe.acked else "timeout")
+            member = self.members.get(probe.target)
+            if not probe.acked and member is not None and member.status == ALIVE:
+                self._suspect(probe.target, member.incarnation)
+
+    def _suspect(self, socket: str, incarnation: int):
+        member = self.members[socket]
+        member.status = SUSPECT
+        member.incarnation = incarnation
+        member.suspected_at = time.monotonic()
+        SUSPECTED.inc()
+        logging.info(f"Suspecting {socket} to have failed")
+        self._disseminate(socket, SUSPECT, incarnation)
+
+    def _expire_suspects(self):
+        deadline = time.monotonic() - self._suspicion_timeout()
+        for socket, member in list(self.members.items()):
+            if member.status == SUSPECT and member.suspected_at < deadline:
+                self._confirm(socket, member.incarnation)
+
+    def _confirm(self, socket: str, incarnation: int):
+        self.members.pop(socket, None)
+        CONFIRMED.inc()
+        logging.info(f"Declaring {socket} dead")
+        self._disseminate(socket, DEAD, incarnation)
+        self._dead.append(socket)
+
+    # Handling a lost member takes the locks of the control plane and may start an election, neither of
+    # which may happen while holding our lock
+    def _report_dead(self):
+        with self._lock:
+            dead, self._dead = self._dead, []
+        for socket in dead:
+            self.lost(socket)
+
+    def _disseminate(self, socket: str, status: str, incarnation: int):
+        node = self.cp.get_node_from_socket(socket)
+        update = {"socket": socket, "status": status, "incarnation": incarnation, "uuid": None if node is None else node.uuid}
+        self.updates[socket] = [update, self._transmissions()]
+
+    def _piggyback(self) -> list[dict]:
+        # Updates that were passed on the least often go first
+        selected = sorted(self.updates.items(), key=lambda item: -item[1][1])[:MAX_PIGGYBACK]
+        for socket, entry in selected:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self.updates[socket]
+        return [entry[0] for _, entry in selected]
+
+    def _send(self, opcode: OpCode, socket: str, data: dict):
+        ip, port = socket.rsplit(":", 1)
+        Message(opcode=opcode, port=self.cp.node.port, data={**data, "updates": self._piggyback()}).send(ip, int(port))
+
+    # Membership updates that arrived piggybacked on any of the SWIM messages
+    def _apply_updates(self, updates: list[dict]):
+        for update in updates:
+            socket, status, incarnation = update["socket"], update["status"], update["incarnation"]
+
+            if socket == self.local_socket:
+                # Someone thinks we failed, a higher incarnation number overrides that everywhere
+                if status != ALIVE and incarnation >= self.incarnation:
+                    self.incarnation = incarnation + 1
+                    self._disseminate(socket, ALIVE, self.incarnation)
+                continue
+
+            member = self.members.get(socket)
+            if status == ALIVE:
+                if member is None:
+                    self._join(socket, update["uuid"], incarnation)
+                elif incarnation > member.incarnation:
+                    member.status = ALIVE
+                    member.incarnation = incarnation
+                    self._disseminate(socket, ALIVE, incarnation)
+            elif status == SUSPECT:
+                if member is not None and (
+                    incarnation > member.incarnation or (incarnation == member.incarnation and member.status == ALIVE)
+                ):
+                    self._suspect(socket, incarnation)
+            elif member is not None:
+                self._confirm(socket, incarnation)
+
+    def _join(self, socket: str, uuid: str | None, incarnation: int):
+        ip, port = socket.rsplit(":", 1)
+        if self.cp.get_node_from_socket(socket) is None:
+            self.cp.register_node(Node(ip, int(port), uuid=uuid))
+        self.cp.register_heartbeat(socket)
+        self.members[socket] = Member(incarnation)
+        self._disseminate(socket, ALIVE, incarnation)
+
+    # Any message from a member shows that it is alive. Members that were declared dead have to
+    # rejoin with a higher incarnation number first.
+    def _heard_from(self, socket: str):
+        if self.cp.get_node_from_socket(socket) is not None:
+            self.cp.register_heartbeat(socket)
+
+    def ping_handler(self, message: Message, ip: str):
+        sender = f"{ip}:{message.port}"
+        with self._lock:
+            self._heard_from(sender)
+            self._apply_updates(message.data["updates"])
+            self._send(OpCode.PING_ACK, sender, {"seq": message.data["seq"], "target": self.local_socket})
+        self._report_dead()
+
+    def ping_req_handler(self, message: Message, ip: str):
+        with self._lock:
+            self._heard_from(f"{ip}:{message.port}")
+            self._apply_updates(message.data["updates"])
+            seq = self._next_seq()
+            self.probes[seq] = Probe(message.data["target"], (ip, message.port, message.data["seq"]))
+            self._send(OpCode.PING, message.data["target"], {"seq": seq})
+        self._report_dead()
+
+        # Forget the indirect probe if the target does not answer
+        self.schedule(self.period, lambda: self.probes.pop(seq, None))
+
+    def ping_ack_handler(self, message: Message, ip: str):
+        with self._lock:
+            self._heard_from(f"{ip}:{message.port}")
+            self._apply_updates(message.data["updates"])
+            self._acked(message.data["seq"], message.data["target"])
+        self._report_dead()
+
+    def _acked(self, seq: int, target: str):
+        probe = self.probes.get(seq)
+        if probe is None or probe.target != target:
+            return
+
+        probe.acked = True
+        member = self.members.get(probe.target)
+        if member is not None and member.status == SUSPECT:
+            # The answer only clears our own suspicion. An ALIVE update at the same incarnation would be
+            # ignored by the other members, the suspect refutes the suspicion that is still being passed on
+            # with a higher incarnation itself.
+            member.status = ALIVE
+
+        if probe.requester is not None:
+            del self.probes[seq]
+            requester_ip, requester_port, requester_seq = probe.requester
+            self._send(OpCode.PING_ACK, f"{requester_ip}:{requester_port}", {"seq": requester_seq, "target": probe.target})
@@ -0,0 +1,199 @@
+import base64
+import json
+import logging
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from uuid import uuid4
+from network import Message, OpCode
+
+# Payload bytes per chunk, small enough that a chunk stays below the MTU after base64 encoding
+CHUNK_SIZE = 1024
+# Sent transfers kept around to answer retransmit requests
+MAX_SENT_TRANSFERS = 16
+SENT_TRANSFER_TTL = 30
+# Limits for reassembly, so a joining node never buffers more than this
+MAX_INCOMING_TRANSFERS = 4
+MAX_TRANSFER_CHUNKS = 65536
+# Time without progress before missing chunks are requested again, and how often before giving up
+RETRANSMIT_TIMEOUT = 0.5
+MAX_RETRANSMITS = 10
+# Pause after every burst of chunks so the receive buffer of the receiver does not overflow
+PACING_BURST = 64
+PACING_DELAY = 0.002
+
+
+def start_timer(delay: float, callback):
+    timer = threading.Timer(delay, callback)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+# Runs a callback after a delay and returns a handle to cancel it. Used for retransmits and for the pauses
+# between bursts, the asyncio runtime of the server replaces the thread based timer with one on its loop.
+schedule = start_timer
+
+
+class OutgoingTransfer:
+    def __init__(self, chunks: list[dict]):
+        self.chunks = chunks
+        self.created = time.monotonic()
+
+
+class IncomingTransfer:
+    def __init__(self, transfer_id: str, ip: str, port: int, header: dict):
+        self.id = transfer_id
+        self.ip = ip
+        self.port = port
+        self.opcode = OpCode(header["opcode"])
+        self.text = header["text"]
+        self.compressed = header["compressed"]
+        self.chunks: list[bytes | None] = [None] * header["count"]
+        self.received = 0
+        self.retransmits = 0
+        self.progress = time.monotonic()
+        self.timer = None
+
+    def missing(self) -> list[int]:
+        return [index for index, chunk in enumerate(self.chunks) if chunk is None]
+
+    def payload(self):
+        body = b"".join(self.chunks)
+        if self.compressed:
+            body = zlib.decompress(body)
+        return body.decode("UTF-8") if self.text else json.loads(body)
+
+
+sent_transfers: OrderedDict[str, OutgoingTransfer] = OrderedDict()
+incoming_transfers: dict[str, IncomingTransfer] = {}
+lock = threading.Lock()
+
+
+# Send a message that may be larger than a datagram. Small messages are sent as they are,
+# larger ones are split into sequence numbered STATE_CHUNK messages that the receiver reassembles.
+def send(message: Message, ip: str, port: int, compress: bool = True):
+    text = isinstance(message.data, str)
+    body = message.data.encode("UTF-8") if text else json.dumps(message.data, separators=(",", ":")).encode("UTF-8")
+
+    if len(body) <= CHUNK_SIZE:
+        message.send(ip, port)
+        return
+
+    if compress:
+        body = zlib.compress(body)
+
+    transfer_id = str(uuid4())
+    count = (len(body) + CHUNK_SIZE - 1) // CHUNK_SIZE
+    chunks = [
+        {
+            "id": transfer_id,
+            "opcode": message.opcode.value,
+            "text": text,
+            "compressed": compress,
+            "index": index,
+            "count": count,
+            "chunk": base64.b64encode(body[index * CHUNK_SIZE:(index + 1) * CHUNK_SIZE]).decode("ascii"),
+        }
+        for index in range(count)
+    ]
+
+    with lock:
+        expire_sent_transfers()
+        sent_transfers[transfer_id] = OutgoingTransfer(chunks)
+
+    logging.info(f"Sending {message.opcode.value} in {count} chunks to {ip}:{port}")
+    send_chunks(chunks, range(count), message.port, ip, port)
+
+
+# Sends a burst of chunks right away and the rest after a pause, without blocking the caller in between
+def send_chunks(chunks: list[dict], indices, local_port: int, ip: str, port: int):
+    indices = list(indices)
+    for index in indices[:PACING_BURST]:
+        Message(opcode=OpCode.STATE_CHUNK, port=local_port, data=chunks[index]).send(ip, port)
+    if len(indices) > PACING_BURST:
+        schedule(PACING_DELAY, lambda: send_chunks(chunks, indices[PACING_BURST:], local_port, ip, port))
+
+
+def expire_sent_transfers():
+    now = time.monotonic()
+    for transfer_id, transfer in list(sent_transfers.items()):
+        if len(sent_transfers) > MAX_SENT_TRANSFERS or transfer.created + SENT_TRANSFER_TTL < now:
+            sent_transfers.pop(transfer_id)
+
+
+# Resend the chunks a receiver reported as missing
+def chunk_request_handler(message: Message, ip: str, local_port: int):
+    with lock:
+        transfer = sent_transfers.get(message.data["id"])
+    if transfer is None:
+        logging.info(f"Retransmit requested for unknown transfer {message.data['id']}")
+        return
+
+    indices = [index for index in message.data["missing"] if 0 <= index < len(transfer.chunks)]
+    send_chunks(transfer.chunks, indices, local_port, ip, message.port)
+
+
+# Store a received chunk. Once all chunks arrived, the reassembled message is passed to deliver.
+def chunk_handler(message: Message, ip: str, local_port: int, deliver):
+    data = message.data
+
+    with lock:
+        transfer = incoming_transfers.get(data["id"])
+        if transfer is None:
+            if data["count"] > MAX_TRANSFER_CHUNKS or len(incoming_transfers) >= MAX_INCOMING_TRANSFERS:
+                logging.info(f"Dropping chunk of transfer {data['id']}, too many or too large transfers")
+                return
+            transfer = IncomingTransfer(data["id"], ip, message.port, data)
+            incoming_transfers[transfer.id] = transfer
+            schedule_retransmit(transfer, local_port)
+
+        index = data["index"]
+        if not 0 <= index < len(transfer.chunks) or transfer.chunks[index] is not None:
+            return
+
+        transfer.chunks[index] = base64.b64decode(data["chunk"])
+        transfer.received += 1
+        transfer.progress = time.monotonic()
+
+        if transfer.received < len(transfer.chunks):
+            return
+
+        incoming_transfers.pop(transfer.id)
+        if transfer.timer is not None:
+            transfer.timer.cancel()
+
+    logging.info(f"Received {transfer.opcode.value} in {len(transfer.chunks)} chunks from {ip}:{message.port}")
+    deliver(Message(opcode=transfer.opcode, port=message.port, data=transfer.payload()))
+
+
+def schedule_retransmit(transfer: IncomingTransfer, local_port: int):
+    transfer.timer = schedule(RETRANSMIT_TIMEOUT, lambda: retransmit_target(transfer, local_port))
+
+
+def retransmit_target(transfer: IncomingTransfer, local_port: int):
+    with lock:
+        if transfer.id not in incoming_transfers:
+            return
+
+        if time.monotonic() - transfer.progress < RETRANSMIT_TIMEOUT:
+            schedule_retransmit(transfer, local_port)
+            return
+
+        if transfer.retransmits >= MAX_RETRANSMITS:
+            logging.info(f"Giving up on transfer {transfer.id}, {len(transfer.missing())} chunks missing")
+            incoming_transfers.pop(transfer.id)
+            return
+
+        transfer.retransmits += 1
+        missing = transfer.missing()
+        schedule_retransmit(transfer, local_port)
+
+    # Requests are kept small enough to fit into a single datagram
+    for start in range(0, len(missing), 128):
+        Message(
+            opcode=OpCode.STATE_CHUNK_REQUEST,
+            port=local_port,
+            data={"id": transfer.id, "missing": missing[start:start + 128]},
+        ).send(transfer.ip, transfer.port)